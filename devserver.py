@@ -32,7 +32,8 @@ def serve_cinemas():
 
 @app.route("/thumbnails/<path:filename>")
 def serve_thumbnail(filename):
-    return send_from_directory(THUMBNAILS_DIR, filename)
+    # Thumbnails are sharded into subdirectories by the start of their name
+    return send_from_directory(THUMBNAILS_DIR / filename[:2], filename)
 
 
 app.run(host="0.0.0.0", port=8080)
@@ -12,47 +12,50 @@ import humanize
 import requests
 from rich import print
 
+from cinescrapers import thumbnail_service
 from cinescrapers.cinema_details import CINEMAS
-from cinescrapers.cinemap import generate_cinema_map
 from cinescrapers.cinescrapers_types import EnrichedShowTime, ShowTime
-from cinescrapers.film_identification import get_best_tmdb_match
+from cinescrapers.exceptions import ImageDownloadError, TMDBCacheMiss
+from cinescrapers.fuzzy_title_index import add_tmdb_title, load_fuzzy_title_index
+from cinescrapers.image_store import (
+    IMAGES_CACHE,
+    collect_garbage,
+    download_source_image,
+    get_source_image_path,
+    get_thumbnail_folder,
+    get_thumbnail_path,
+    lookup_source_url,
+    migrate_flat_layout,
+)
 from cinescrapers.indexnow import submit_to_indexnow
-from cinescrapers.thumbnailing import smart_square_thumbnail
+from cinescrapers.match_scoring import get_match_score, get_release_year
+from cinescrapers.perceptual_hash import get_canonical_image
+from cinescrapers.thumbnailing import THUMBNAIL_VARIANTS, export_yolo_onnx
 from cinescrapers.title_normalization import normalize_title
-from cinescrapers.upload import get_s3_client, upload_file
+from cinescrapers.tmdb_id_cache import (
+    LEGACY_TMDB_ID_CACHE,
+    cache_tmdb_ids,
+    count_cached_tmdb_ids,
+    get_backed_off_movie_keys,
+    get_cached_tmdb_ids,
+    import_json_cache,
+    record_no_match,
+)
 from cinescrapers.utils import get_hashed
 
-IMAGES_CACHE = Path(__file__).parent / "scraped_images" / "source_images"
-IMAGES_CACHE.mkdir(parents=True, exist_ok=True)
-THUMBNAILS_FOLDER = Path(__file__).parent / "scraped_images" / "thumbnails"
-THUMBNAILS_FOLDER.mkdir(parents=True, exist_ok=True)
-TMDB_ID_CACHE = Path(__file__).parent / "tmdb_id_cache.json"
-if not TMDB_ID_CACHE.exists():
-    # Create the cache file if it doesn't exist
-    TMDB_ID_CACHE.write_text("{}")
-
 # How long since the last update before we need to refresh a cinema's listings
 MAX_STALENESS = datetime.timedelta(days=5)
 
 
 def get_scrapers() -> list[str]:
-    """Get a list of available scraper names."""
+    """Get a list of available scraper names. The scraper modules (and their
+    dependencies, like playwright) don't get imported until they're run."""
     scrapers_dir = Path(__file__).parent / "scrapers"
-    possible_scrapers = [
+    return [
         folder.name
         for folder in scrapers_dir.iterdir()
         if folder.is_dir() and (folder / "scrape.py").is_file()
     ]
-    scrapers = []
-    for possible_scraper in possible_scrapers:
-        module_path = f"cinescrapers.scrapers.{possible_scraper}.scrape"
-        try:
-            importlib.import_module(module_path)
-        except ImportError as e:
-            print(f"Failed to import {possible_scraper}: {e}")
-        else:
-            scrapers.append(possible_scraper)
-    return scrapers
 
 
 def get_scraper(scraper_name: str) -> Callable:
@@ -183,6 +186,39 @@ def get_unique_identifier(st: ShowTime) -> str:
     return get_hashed(f"{st.cinema_shortcode}-{st.title}-{st.datetime}")
 
 
+def get_movie_key(norm_title: str, description: str, image_src: str | None) -> str:
+    """Identify the film a showtime is for, so we only have to match each
+    film against TMDB once"""
+    # I think we can assume that movie listings with the same norm_title,
+    # description and image are pretty definitely for the same movie
+    return get_hashed(f"{norm_title}-{description}-{image_src}")
+
+
+def store_tmdb_candidates(
+    cursor: sqlite3.Cursor, movie_key: str, candidates: list[dict]
+) -> None:
+    """Save the TMDB films a movie key could be, and their similarity
+    features"""
+    cursor.execute("DELETE FROM tmdb_candidates WHERE movie_key = ?", (movie_key,))
+    cursor.executemany(
+        """
+        INSERT OR REPLACE INTO tmdb_candidates (movie_key, tmdb_id, title, release_year, overview_similarity, image_similarity)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """,
+        [
+            (
+                movie_key,
+                c["id"],
+                c["title"],
+                get_release_year(c.get("release_date")),
+                c["overview_similarity"],
+                c["image_similarity"],
+            )
+            for c in candidates
+        ],
+    )
+
+
 def ensure_showtimes_table_exists():
     with sqlite3.connect("showtimes.db") as conn:
         cursor = conn.cursor()
@@ -201,23 +237,54 @@ def ensure_showtimes_table_exists():
                 release_year INTEGER,
                 last_updated TEXT NOT NULL,
                 scraper TEXT NOT NULL,
-                tmdb_id INTEGER
+                tmdb_id INTEGER,
+                movie_key TEXT
             )
         """
         )
+        columns = [row[1] for row in cursor.execute("PRAGMA table_info(showtimes)")]
+        if "movie_key" not in columns:
+            # Databases from before we stored the key
+            cursor.execute("ALTER TABLE showtimes ADD COLUMN movie_key TEXT")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS showtimes_movie_key ON showtimes (movie_key)"
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tmdb_candidates (
+                movie_key TEXT NOT NULL,
+                tmdb_id INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                release_year INTEGER,
+                overview_similarity REAL NOT NULL,
+                image_similarity REAL NOT NULL,
+                PRIMARY KEY (movie_key, tmdb_id)
+            )
+        """
+        )
+        rows = cursor.execute(
+            "SELECT id, norm_title, description, image_src FROM showtimes WHERE movie_key IS NULL"
+        ).fetchall()
+        cursor.executemany(
+            "UPDATE showtimes SET movie_key = ? WHERE id = ?",
+            [(get_movie_key(*row[1:]), row[0]) for row in rows],
+        )
 
 
-def get_thumbnail(showtime: ShowTime) -> str | None:
-    """Grab a copy of the showtime's image and try to thumbnail it"""
+def get_thumbnail(
+    showtime: ShowTime, pending: dict[str, concurrent.futures.Future] | None = None
+) -> str | None:
+    """Grab a copy of the showtime's image and try to thumbnail it. If
+    `pending` is given, the thumbnail rendering job is added to it, keyed by
+    thumbnail, instead of being waited for."""
 
     if showtime.image_src is None:
         return None
     if showtime.image_src.startswith("data:"):
         # Maybe we could do something with this, for now let's just skip it
         return None
-    filename = get_hashed(showtime.image_src)
-    filepath = IMAGES_CACHE / filename
-    if not filepath.exists():
+    content_hash = lookup_source_url(showtime.image_src)
+    if content_hash is None:
         # Add headers to mimic a browser request
         headers = {
             "User-Agent": (
@@ -242,50 +309,48 @@ def get_thumbnail(showtime: ShowTime) -> str | None:
         except Exception:
             pass
 
-        response = requests.get(showtime.image_src, headers=headers, timeout=10)
-        if not response.ok:
-            print(
-                f"Failed to fetch '{showtime.image_src}' for {showtime.title} ({showtime.cinema_shortcode}) ({response.status_code})"
-            )
-            return None
-
-        # Check if the response content is actually an image by examining the file signature
-        content = response.content
-        if len(content) < 8:
-            print(
-                f"Response too short to be an image for '{showtime.image_src}' for {showtime.title} ({showtime.cinema_shortcode})"
-            )
-            return None
-
-        # Check common image file signatures (magic numbers)
-        image_signatures = [
-            b"\xff\xd8\xff",  # JPEG
-            b"\x89PNG\r\n\x1a\n",  # PNG
-            b"GIF87a",  # GIF87a
-            b"GIF89a",  # GIF89a
-            b"RIFF",  # WebP (starts with RIFF, followed by WEBP later)
-            b"\x00\x00\x01\x00",  # ICO
-            b"BM",  # BMP
-        ]
-
-        is_image = any(content.startswith(sig) for sig in image_signatures)
-        # Special case for WebP which has RIFF header but needs to check for WEBP signature too
-        if content.startswith(b"RIFF") and len(content) >= 12:
-            is_image = content[8:12] == b"WEBP"
-
-        if not is_image:
-            content_type = response.headers.get("content-type", "unknown")
+        try:
+            content_hash = download_source_image(showtime.image_src, headers)
+        except ImageDownloadError as e:
             print(
-                f"Response is not an image (content-type: {content_type}, no image signature found) for '{showtime.image_src}' for {showtime.title} ({showtime.cinema_shortcode})"
+                f"Failed to fetch '{showtime.image_src}' for {showtime.title} ({showtime.cinema_shortcode}): {e}"
             )
             return None
-
-        with filepath.open("wb") as f:
-            f.write(content)
-    thumbnail_filepath = THUMBNAILS_FOLDER / f"{filepath.stem}.jpg"
-    if not thumbnail_filepath.exists():
-        smart_square_thumbnail(filepath, thumbnail_filepath, 150)
-    return thumbnail_filepath.stem
+    # If we've seen this poster before (maybe resized, or from another
+    # cinema), use the thumbnail we already have
+    thumbnail = get_canonical_image(content_hash)
+    missing_variants = [
+        v
+        for v in THUMBNAIL_VARIANTS
+        if not get_thumbnail_path(v.filename(thumbnail)).exists()
+    ]
+    if missing_variants:
+        job = thumbnail_service.submit_thumbnail_job(
+            get_source_image_path(thumbnail),
+            get_thumbnail_folder(thumbnail),
+            thumbnail,
+            missing_variants,
+        )
+        if pending is None:
+            job.result()
+        else:
+            pending[thumbnail] = job
+    return thumbnail
+
+
+def get_thumbnail_variants(thumbnail: str) -> list[dict]:
+    """List the rendered variants of a thumbnail, so the frontend can build a
+    srcset from them"""
+    return [
+        {
+            "name": v.suffix,
+            "file": v.filename(thumbnail),
+            "width": v.size,
+            "type": v.mimetype,
+        }
+        for v in THUMBNAIL_VARIANTS
+        if get_thumbnail_path(v.filename(thumbnail)).exists()
+    ]
 
 
 def scrape_to_sqlite(scraper_name: str) -> None:
@@ -300,8 +365,10 @@ def scrape_to_sqlite(scraper_name: str) -> None:
 
     now = datetime.datetime.now()
     enriched_showtimes = []
+    # Let the thumbnail workers get on with rendering while we download
+    pending_thumbnails: dict[str, concurrent.futures.Future] = {}
     for showtime in showtimes:
-        thumbnail = get_thumbnail(showtime)
+        thumbnail = get_thumbnail(showtime, pending_thumbnails)
         if thumbnail is None:
             print(
                 f"Failed to get thumbnail for {showtime.title} {showtime.image_src}, ({scraper_name})"
@@ -322,16 +389,34 @@ def scrape_to_sqlite(scraper_name: str) -> None:
             )
         )
 
-    rows = [s.model_dump(mode="json") for s in enriched_showtimes]
+    failed_thumbnails = set()
+    for thumbnail, job in pending_thumbnails.items():
+        try:
+            job.result()
+        except thumbnail_service.RENDER_ERRORS as e:
+            print(f"Failed to render thumbnail {thumbnail}: {e} ({scraper_name})")
+            failed_thumbnails.add(thumbnail)
+    for showtime in enriched_showtimes:
+        if showtime.thumbnail in failed_thumbnails:
+            showtime.thumbnail = None
+
+    rows = [
+        {
+            **s.model_dump(mode="json"),
+            "movie_key": get_movie_key(s.norm_title, s.description, s.image_src),
+        }
+        for s in enriched_showtimes
+    ]
 
     ensure_showtimes_table_exists()
     with sqlite3.connect("showtimes.db") as conn:
         cursor = conn.cursor()
         query = """
-            INSERT INTO showtimes (id, cinema_shortcode, title, norm_title, link, datetime, description, image_src, thumbnail, release_year, last_updated, scraper)
-            VALUES (:id, :cinema_shortcode, :title, :norm_title, :link, :datetime, :description, :image_src, :thumbnail, :release_year, :last_updated, :scraper)
+            INSERT INTO showtimes (id, cinema_shortcode, title, norm_title, link, datetime, description, image_src, thumbnail, release_year, last_updated, scraper, movie_key)
+            VALUES (:id, :cinema_shortcode, :title, :norm_title, :link, :datetime, :description, :image_src, :thumbnail, :release_year, :last_updated, :scraper, :movie_key)
             ON CONFLICT(id) DO UPDATE SET
                 link = excluded.link,
+                movie_key = excluded.movie_key,
                 norm_title = excluded.norm_title,
                 description = excluded.description,
                 image_src = excluded.image_src,
@@ -381,10 +466,20 @@ def export_json() -> None:
     current_showtimes = grab_current_showtimes()
     # Check each showtime has a valid cinema shortcode:
     showtimes_json = []
+    thumbnail_variants: dict[str, list[dict]] = {}
     for showtime in current_showtimes:
         assert showtime.cinema_shortcode in cinema_shortcodes
         showtime.description = showtime.description[:210]
-        showtimes_json.append(showtime.model_dump(mode="json"))
+        showtime_json = showtime.model_dump(mode="json")
+        if showtime.thumbnail:
+            if showtime.thumbnail not in thumbnail_variants:
+                thumbnail_variants[showtime.thumbnail] = get_thumbnail_variants(
+                    showtime.thumbnail
+                )
+            showtime_json["thumbnail_variants"] = thumbnail_variants[showtime.thumbnail]
+        else:
+            showtime_json["thumbnail_variants"] = []
+        showtimes_json.append(showtime_json)
 
     showtimes_file = Path(__file__).parent / "cinescrapers.json"
     with showtimes_file.open("w") as f:
@@ -404,66 +499,254 @@ def export_json_cmd():
 
 
 @cli.command("grab_tmdb_ids")
-def grab_tmdb_ids_cmd():
+@click.option(
+    "--offline",
+    is_flag=True,
+    help="Only use cached TMDB responses, skip films that would need the API",
+)
+@click.option(
+    "--retry-unmatched",
+    is_flag=True,
+    help="Try films we recently failed to match again, rather than waiting",
+)
+def grab_tmdb_ids_cmd(offline: bool, retry_unmatched: bool):
     """Grab TMDB IDs for all showtimes"""
+    # This pulls in torch, CLIP etc. so only import it when we need it
+    from cinescrapers.film_identification import get_tmdb_candidates
+    from cinescrapers.tmdb_client import TMDB_MAX_CONCURRENCY, get_tmdb_client
+
     t1 = time.perf_counter()
-    tmdb_id_cache = json.loads(TMDB_ID_CACHE.read_text())
+    tmdb_client = get_tmdb_client(offline=offline)
+    if LEGACY_TMDB_ID_CACHE.exists() and not count_cached_tmdb_ids():
+        print(
+            f"[yellow]{LEGACY_TMDB_ID_CACHE} hasn't been imported, run import-tmdb-id-cache[/yellow]"
+        )
+    ensure_showtimes_table_exists()
     with sqlite3.connect("showtimes.db") as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM showtimes")
-        rows = cursor.fetchall()
-        num_showtimes = len(rows)
-        num_found = 0
-        for i, row in enumerate(rows):
-            print(f"{i} of {num_showtimes}, {row['title']}")
-            showtime = EnrichedShowTime(**row)
-
-            # I think we can assume that movie listings with the same
-            # norm_title, description and image are pretty definitely for the
-            # same movie
-            movie_id_str = (
-                f"{showtime.norm_title}-{showtime.description}-{showtime.image_src}"
+        # Rows for films we've already identified (eg. new screenings of a
+        # film we matched on an earlier run) just need the ID copying over
+        cursor.execute(
+            """
+            UPDATE showtimes SET tmdb_id = (
+                SELECT matched.tmdb_id FROM showtimes AS matched
+                WHERE matched.movie_key = showtimes.movie_key
+                AND matched.tmdb_id IS NOT NULL
             )
-            movie_hash = get_hashed(movie_id_str)
-            print(f"{showtime.norm_title} -> {movie_hash}")
-
-            if showtime.tmdb_id:
-                print("Skipping, db already has TMDB ID")
-                # The tmdb_id for this db row is already in the db
-                num_found += 1
-                continue
-            if movie_hash in tmdb_id_cache.keys():
-                print(f"'{showtime.norm_title}' Found in file cache")
-                showtime_tmdb_id = tmdb_id_cache[movie_hash]
-            else:
-                print(
-                    f"'{showtime.norm_title}' Not found in file cache, searching TMDB"
-                )
-                best_match = get_best_tmdb_match(showtime, IMAGES_CACHE)
-                if best_match:
+            WHERE tmdb_id IS NULL AND movie_key IN (
+                SELECT movie_key FROM showtimes WHERE tmdb_id IS NOT NULL
+            )
+        """
+        )
+        print(
+            f"Copied TMDB IDs to {cursor.rowcount} showtimes of films already in the db"
+        )
+        unmatched_keys = [
+            row["movie_key"]
+            for row in cursor.execute(
+                "SELECT DISTINCT movie_key FROM showtimes WHERE tmdb_id IS NULL"
+            )
+        ]
+        cached_tmdb_ids = get_cached_tmdb_ids(unmatched_keys)
+        cursor.executemany(
+            "UPDATE showtimes SET tmdb_id = ? WHERE movie_key = ? AND tmdb_id IS NULL",
+            [(tmdb_id, key) for key, tmdb_id in cached_tmdb_ids.items()],
+        )
+        print(f"Found {len(cached_tmdb_ids)} films in TMDB ID cache")
+        cursor.connection.commit()
+
+        # One showtime for each film we still need to identify
+        cursor.execute(
+            """
+            SELECT * FROM showtimes WHERE rowid IN (
+                SELECT MIN(rowid) FROM showtimes
+                WHERE tmdb_id IS NULL
+                GROUP BY movie_key
+            )
+        """
+        )
+        to_match = {
+            row["movie_key"]: EnrichedShowTime(**row) for row in cursor.fetchall()
+        }
+        if not retry_unmatched:
+            # Films we've failed to match recently are likely to be live
+            # events etc. that aren't on TMDB, so give them a rest
+            backed_off = get_backed_off_movie_keys(list(to_match))
+            to_match = {
+                key: showtime
+                for key, showtime in to_match.items()
+                if key not in backed_off
+            }
+            print(f"Skipping {len(backed_off)} films we recently failed to match")
+
+        # Near misses for titles we've already seen don't need searching for
+        title_index = load_fuzzy_title_index(conn)
+        print(f"Loaded {len(title_index)} titles into fuzzy title index")
+
+        print(f"Searching TMDB for {len(to_match)} films")
+        # The TMDB client rate limits itself, so we can match several
+        # films at once
+        with concurrent.futures.ThreadPoolExecutor(TMDB_MAX_CONCURRENCY) as executor:
+            future_to_key = {
+                executor.submit(
+                    get_tmdb_candidates, showtime, IMAGES_CACHE, title_index
+                ): movie_key
+                for movie_key, showtime in to_match.items()
+            }
+            for i, future in enumerate(concurrent.futures.as_completed(future_to_key)):
+                movie_key = future_to_key[future]
+                showtime = to_match[movie_key]
+                try:
+                    candidates = future.result()
+                except TMDBCacheMiss:
+                    print(f"Skipping {showtime.norm_title}, not in the TMDB cache")
+                    continue
+                except (requests.RequestException, OSError, ValueError) as e:
+                    # TMDB still failing after retries, a broken poster etc.
+                    # shouldn't lose the other films' matches. We'll try this
+                    # one again next time.
+                    print(f"[red]Failed to match {showtime.norm_title}: {e!r}[/red]")
+                    continue
+                # Keep all the candidates, so we can rescore them later
+                store_tmdb_candidates(cursor, movie_key, candidates)
+                if candidates:
+                    best_match = max(candidates, key=lambda c: c["similarity_score"])
                     showtime_tmdb_id = best_match["id"]
+                    cursor.execute(
+                        "UPDATE showtimes SET tmdb_id = ? WHERE movie_key = ? AND tmdb_id IS NULL",
+                        (showtime_tmdb_id, movie_key),
+                    )
+                    print(
+                        f"Found TMDB ID: {showtime_tmdb_id} for {showtime.norm_title} ({cursor.rowcount} showtimes)"
+                    )
+                    cache_tmdb_ids({movie_key: showtime_tmdb_id})
+                    title_index.add(showtime.norm_title, showtime_tmdb_id)
+                    add_tmdb_title(title_index, best_match["title"], showtime_tmdb_id)
                 else:
-                    showtime_tmdb_id = None
-            if showtime_tmdb_id:
-                num_found += 1
-                print(f"Found TMDB ID: {showtime_tmdb_id} for {showtime.norm_title}")
-                cursor.execute(
-                    "UPDATE showtimes SET tmdb_id = ? WHERE id = ?",
-                    (showtime_tmdb_id, showtime.id),
-                )
-                tmdb_id_cache[movie_hash] = showtime_tmdb_id
+                    record_no_match(movie_key)
 
-            if not i % 100:
-                cursor.connection.commit()
-                print("writing file cache")
-                TMDB_ID_CACHE.write_text(json.dumps(tmdb_id_cache, indent=2))
+                if not i % 100:
+                    cursor.connection.commit()
 
-        TMDB_ID_CACHE.write_text(json.dumps(tmdb_id_cache, indent=2))
         cursor.connection.commit()
+        num_showtimes, num_found = cursor.execute(
+            "SELECT COUNT(*), COUNT(tmdb_id) FROM showtimes"
+        ).fetchone()
     print(
         f"Found {num_found} TMDB IDs of {num_showtimes} showtimes ({num_found / num_showtimes * 100:.2f}%) in {humanize.naturaldelta(time.perf_counter() - t1)}."
     )
+    if tmdb_client.cache is not None:
+        cache = tmdb_client.cache
+        print(
+            f"TMDB cache: {cache.hits} hits, {cache.misses} misses ({cache.get_hit_rate() * 100:.1f}% hit rate)"
+        )
+
+
+@cli.command("backfill-image-embeddings")
+@click.option("--batch-size", default=32, help="How many images to run CLIP on at once")
+def backfill_image_embeddings_cmd(batch_size: int):
+    """Work out CLIP embeddings for every TMDB and scraped image we have"""
+    from cinescrapers.film_identification import (
+        TMDB_IMAGE_PATH,
+        backfill_image_embeddings,
+    )
+
+    t1 = time.perf_counter()
+    image_paths = sorted(
+        path
+        for folder in (TMDB_IMAGE_PATH, IMAGES_CACHE)
+        for path in folder.rglob("*")
+        if path.is_file() and path.suffix != ".tmp"
+    )
+    print(f"Checking {len(image_paths)} images")
+    num_added = backfill_image_embeddings(image_paths, batch_size=batch_size)
+    print(
+        f"Added {num_added} embeddings in {humanize.naturaldelta(time.perf_counter() - t1)}"
+    )
+
+
+@cli.command("import-tmdb-ids")
+@click.argument("export_path", type=click.Path(exists=True, path_type=Path))
+def import_tmdb_ids_cmd(export_path: Path):
+    """Build the local title index from a TMDB daily movie ID export
+    (movie_ids_MM_DD_YYYY.json.gz)"""
+    from cinescrapers.tmdb_title_index import import_tmdb_id_export
+
+    t1 = time.perf_counter()
+    num_imported = import_tmdb_id_export(export_path)
+    print(
+        f"Imported {num_imported} films in {humanize.naturaldelta(time.perf_counter() - t1)}"
+    )
+
+
+@cli.command("embedding-server")
+def embedding_server_cmd():
+    """Keep the film identification models loaded, and serve embeddings to
+    grab_tmdb_ids etc."""
+    from cinescrapers.embedding_server import serve
+
+    serve()
+
+
+@cli.command("tmdb-cache-stats")
+def tmdb_cache_stats_cmd():
+    """Show what's in the TMDB response cache"""
+    from cinescrapers.tmdb_cache import TMDBResponseCache
+
+    summary = TMDBResponseCache().get_summary()
+    if not summary:
+        print("The TMDB cache is empty")
+    for endpoint_group, num_entries, num_expired in summary:
+        print(f"{endpoint_group}: {num_entries} responses, {num_expired} expired")
+
+
+@cli.command("rescore")
+@click.option("--dry-run", is_flag=True, help="Just report what would change")
+def rescore_cmd(dry_run: bool):
+    """Pick the best TMDB match for every film again from the stored
+    candidates, eg. after changing how they're scored"""
+    t1 = time.perf_counter()
+    ensure_showtimes_table_exists()
+    with sqlite3.connect("showtimes.db") as conn:
+        best_matches: dict[str, tuple[float, int]] = {}
+        for movie_key, tmdb_id, *features in conn.execute(
+            "SELECT movie_key, tmdb_id, overview_similarity, image_similarity, release_year FROM tmdb_candidates"
+        ):
+            score = get_match_score(*features)
+            if movie_key not in best_matches or score > best_matches[movie_key][0]:
+                best_matches[movie_key] = (score, tmdb_id)
+        current = dict(
+            conn.execute(
+                "SELECT movie_key, tmdb_id FROM showtimes WHERE tmdb_id IS NOT NULL GROUP BY movie_key"
+            )
+        )
+        changes = [
+            (tmdb_id, movie_key)
+            for movie_key, (_, tmdb_id) in best_matches.items()
+            if current.get(movie_key) != tmdb_id
+        ]
+        print(
+            f"Rescored {len(best_matches)} films in {humanize.naturaldelta(time.perf_counter() - t1)}, {len(changes)} have a different best match"
+        )
+        if dry_run:
+            return
+        conn.executemany(
+            "UPDATE showtimes SET tmdb_id = ? WHERE movie_key = ?", changes
+        )
+    cache_tmdb_ids({movie_key: tmdb_id for tmdb_id, movie_key in changes})
+
+
+@cli.command("import-tmdb-id-cache")
+@click.argument(
+    "json_path",
+    type=click.Path(exists=True, path_type=Path),
+    default=LEGACY_TMDB_ID_CACHE,
+)
+def import_tmdb_id_cache_cmd(json_path: Path):
+    """Import TMDB IDs from the old tmdb_id_cache.json"""
+    num_imported = import_json_cache(json_path)
+    print(f"Imported {num_imported} TMDB IDs from {json_path}")
 
 
 @cli.command("list-scrapers")
@@ -540,6 +823,7 @@ def refresh_cmd(scrape_all: bool = False):
 
                 traceback.print_exc()
                 failed.append(scraper)
+    thumbnail_service.shutdown()
     if failed:
         print(f"Failed: {failed}")
     else:
@@ -553,6 +837,8 @@ def upload():
     # NOTE: These files are gzipped by default before uploading. To make that work,
     # on Chromium, I had to create a cloudflare rule to add the
     # "content-encoding: gzip" header.
+    from cinescrapers.cinemap import generate_cinema_map
+    from cinescrapers.upload import get_s3_client, upload_file
 
     s3_client = get_s3_client()
     cinemas_json_path = Path(__file__).parent / "cinemas.json"
@@ -587,26 +873,76 @@ def upload():
         map_html_path.name,
     )
 
-    # One day, it might be better to only upload the thumbnails for
-    # "current" showtimes, and to clear out old thumbnails. But this will
-    # be OK for now I think.
     paginator = s3_client.get_paginator("list_objects_v2")
-    existing_thumbnail_files = []
+    existing_thumbnail_files = set()
     for page in paginator.paginate(Bucket="cinescrapers", Prefix="thumbnails/"):
         for obj in page.get("Contents", []):
-            existing_thumbnail_files.append(obj["Key"][len("thumbnails/") :])
+            existing_thumbnail_files.add(obj["Key"][len("thumbnails/") :])
+
+    # Only upload thumbnails for current showtimes. They're sharded into
+    # subdirectories locally, but the bucket keeps them flat.
+    current_thumbnails = {st.thumbnail for st in grab_current_showtimes()}
+    for thumbnail in sorted(t for t in current_thumbnails if t):
+        for variant in THUMBNAIL_VARIANTS:
+            filename = variant.filename(thumbnail)
+            path = get_thumbnail_path(filename)
+            if filename in existing_thumbnail_files:
+                print("skipping already-uploaded file")
+            elif path.exists():
+                upload_file(s3_client, path, f"thumbnails/{filename}")
+
+
+@cli.command("gc")
+@click.option("--dry-run", is_flag=True, help="Just list what would be deleted")
+def gc_cmd(dry_run: bool = False):
+    """Delete cached images and thumbnails that no current showtime uses"""
+    this_morning = datetime.datetime.combine(
+        datetime.datetime.now().date(), datetime.time.min
+    )
+    with sqlite3.connect("showtimes.db") as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT DISTINCT thumbnail FROM showtimes WHERE datetime >= ?",
+            (this_morning.isoformat(timespec="seconds"),),
+        )
+        referenced = {thumbnail for (thumbnail,) in cursor.fetchall() if thumbnail}
+    num_deleted, freed = collect_garbage(referenced, dry_run=dry_run)
+    if dry_run:
+        print(f"Would delete {num_deleted} images")
+    else:
+        print(f"Deleted {num_deleted} images, freeing {humanize.naturalsize(freed)}")
+
+
+@cli.command("migrate-image-store")
+def migrate_image_store_cmd():
+    """Move cached images from the old flat layout into the sharded store"""
+    ensure_showtimes_table_exists()
+    with sqlite3.connect("showtimes.db") as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT DISTINCT image_src FROM showtimes WHERE image_src IS NOT NULL"
+        )
+        source_urls = [url for (url,) in cursor.fetchall()]
+        renamed = migrate_flat_layout(source_urls)
+        cursor.executemany(
+            "UPDATE showtimes SET thumbnail = ? WHERE thumbnail = ?",
+            [(new, old) for old, new in renamed.items()],
+        )
+    print(f"Migrated {len(renamed)} images")
 
-    for path in THUMBNAILS_FOLDER.iterdir():
-        if path.name in existing_thumbnail_files:
-            print("skipping already-uploaded file")
-        else:
-            s3_key = f"thumbnails/{path.name}"
-            upload_file(s3_client, path, s3_key)
+
+@cli.command("export-yolo-onnx")
+def export_yolo_onnx_cmd():
+    """Export the YOLO model to ONNX, for faster thumbnail cropping"""
+    path = export_yolo_onnx()
+    print(f"Exported YOLO model to {path}")
 
 
 @cli.command("generate-map")
 def generate_map_cmd():
     """Generate an interactive map of all cinemas"""
+    from cinescrapers.cinemap import generate_cinema_map
+
     generate_cinema_map()
 
 
@@ -662,6 +998,7 @@ def submit_indexnow_cmd():
 def scrape_cmd(scraper):
     """Run scraper"""
     scrape_to_sqlite(scraper)
+    thumbnail_service.shutdown()
 
 
 if __name__ == "__main__":
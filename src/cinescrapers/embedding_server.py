@@ -0,0 +1,207 @@
+"""A resident process that keeps the embedding models loaded.
+
+Loading MiniLM and CLIP takes several seconds, and every grab_tmdb_ids run
+(and every test run) pays that again. `python -m cinescrapers embedding-server`
+loads them once and answers embedding requests on a Unix socket. The
+film_identification module uses the server when it's running, and loads the
+models itself when it isn't.
+
+Messages are a 4 byte length, a JSON header of that length, then
+header["payload_length"] bytes of payload. Requests have no payload: the
+header has the kind of embedding ("text" or "image"), the model name and a
+list of inputs (texts, or image file paths). The response payload is the
+float32 embeddings, one row per input, with their shape in the header.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+import threading
+from collections.abc import Callable
+from pathlib import Path
+
+import numpy as np
+from rich import print
+
+
+def get_default_socket_path() -> Path:
+    """Somewhere only we can get to: the per-user runtime directory if
+    there is one, otherwise a folder of our own in the temp directory"""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return Path(runtime_dir) / "cinescrapers-embeddings.sock"
+    return (
+        Path(tempfile.gettempdir()) / f"cinescrapers-{os.getuid()}" / "embeddings.sock"
+    )
+
+
+EMBEDDING_SERVER_SOCKET = Path(
+    os.environ.get("CINESCRAPERS_EMBEDDING_SOCKET", get_default_socket_path())
+)
+# How long to wait for the server before working out embeddings ourselves.
+# A big batch of images takes a while on CPU, but not this long.
+EMBEDDING_SERVER_TIMEOUT = 120
+# Encoders for each kind of embedding: (model name, function from a list of
+# inputs to an array of embeddings)
+Encoders = dict[str, tuple[str, Callable[[list[str]], np.ndarray]]]
+
+HEADER_LENGTH = struct.Struct("!I")
+
+
+def send_message(sock: socket.socket, header: dict, payload: bytes = b"") -> None:
+    header_bytes = json.dumps({**header, "payload_length": len(payload)}).encode()
+    sock.sendall(HEADER_LENGTH.pack(len(header_bytes)) + header_bytes + payload)
+
+
+def recv_exactly(sock: socket.socket, num_bytes: int) -> bytes:
+    chunks = []
+    while num_bytes:
+        chunk = sock.recv(min(num_bytes, 1024 * 1024))
+        if not chunk:
+            raise ConnectionError("Connection closed mid-message")
+        chunks.append(chunk)
+        num_bytes -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_message(sock: socket.socket) -> tuple[dict, bytes]:
+    (header_length,) = HEADER_LENGTH.unpack(recv_exactly(sock, HEADER_LENGTH.size))
+    header = json.loads(recv_exactly(sock, header_length))
+    return header, recv_exactly(sock, header["payload_length"])
+
+
+class EmbeddingRequestHandler(socketserver.BaseRequestHandler):
+    server: "EmbeddingServer"
+
+    def handle(self):
+        header, _ = recv_message(self.request)
+        kind = header.get("kind")
+        if kind not in self.server.encoders:
+            send_message(self.request, {"error": f"Unknown embedding kind {kind}"})
+            return
+        model_name, encode = self.server.encoders[kind]
+        if header.get("model") != model_name:
+            send_message(
+                self.request,
+                {"error": f"Serving {model_name}, not {header.get('model')}"},
+            )
+            return
+        try:
+            # The models use all the cores by themselves, so there's nothing
+            # to gain from running two requests at once
+            with self.server.lock:
+                vectors = np.asarray(encode(header["inputs"]), dtype=np.float32)
+        except (OSError, ValueError, RuntimeError) as e:
+            # Eg. an image that isn't an image, or a tensor error from the model
+            send_message(self.request, {"error": repr(e)})
+            return
+        send_message(self.request, {"shape": list(vectors.shape)}, vectors.tobytes())
+
+
+class EmbeddingServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: Path, encoders: Encoders):
+        self.encoders = encoders
+        self.lock = threading.Lock()
+        socket_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if socket_path.parent.lstat().st_uid != os.getuid():
+            # Whoever owns the folder could swap the socket for their own
+            raise PermissionError(f"{socket_path.parent} isn't our folder")
+        remove_stale_socket(socket_path)
+        super().__init__(str(socket_path), EmbeddingRequestHandler)
+
+    def server_bind(self):
+        # Create the socket with no permissions for anyone else, rather than
+        # chmodding it afterwards, when someone else could have connected
+        old_umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(old_umask)
+
+
+def remove_stale_socket(socket_path: Path) -> None:
+    """Remove a socket left behind by a server that didn't shut down
+    cleanly, as long as it's a socket and it's ours"""
+    try:
+        st = socket_path.lstat()
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        raise PermissionError(
+            f"{socket_path} isn't one of our sockets, not removing it"
+        )
+    socket_path.unlink()
+
+
+def get_model_encoders() -> Encoders:
+    """Load the models film_identification uses"""
+    from PIL import Image
+
+    from cinescrapers import film_identification as fi
+
+    similarity_model = fi.get_similarity_model()
+    fi.load_clip_model()
+    return {
+        "text": (
+            fi.get_model_key(fi.SIMILARITY_MODEL_NAME),
+            lambda texts: similarity_model.encode(texts, convert_to_numpy=True),
+        ),
+        "image": (
+            fi.get_model_key(fi.CLIP_MODEL_NAME),
+            lambda paths: (
+                fi.get_clip_embeddings([Image.open(p) for p in paths])
+                .float()
+                .cpu()
+                .numpy()
+            ),
+        ),
+    }
+
+
+def serve(socket_path: Path | None = None, encoders: Encoders | None = None) -> None:
+    socket_path = socket_path or EMBEDDING_SERVER_SOCKET
+    print("Loading models")
+    encoders = encoders or get_model_encoders()
+    with EmbeddingServer(socket_path, encoders) as server:
+        print(f"Serving embeddings on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            socket_path.unlink(missing_ok=True)
+
+
+def request_embeddings(
+    kind: str, model_name: str, inputs: list[str], socket_path: Path | None = None
+) -> np.ndarray | None:
+    """Ask the embedding server to embed some inputs. Returns None if the
+    server isn't running, can't do it, or is taking too long."""
+    socket_path = socket_path or EMBEDDING_SERVER_SOCKET
+    try:
+        owner = socket_path.lstat().st_uid
+    except FileNotFoundError:
+        return None
+    if owner != os.getuid():
+        # Don't send our inputs to someone else's server, or trust its answers
+        print(f"[red]{socket_path} belongs to someone else, not using it[/red]")
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(EMBEDDING_SERVER_TIMEOUT)
+            sock.connect(str(socket_path))
+            send_message(sock, {"kind": kind, "model": model_name, "inputs": inputs})
+            header, payload = recv_message(sock)
+    except TimeoutError:
+        print("[red]Embedding server timed out[/red]")
+        return None
+    except OSError:
+        return None
+    if "error" in header:
+        print(f"[red]Embedding server error: {header['error']}[/red]")
+        return None
+    return np.frombuffer(payload, dtype=np.float32).reshape(header["shape"])
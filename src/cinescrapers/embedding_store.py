@@ -0,0 +1,171 @@
+"""Persistent stores of the embeddings film identification uses.
+
+Working out an embedding means running a model, which is by far the slowest
+part of matching a film, and we see the same descriptions and TMDB overviews
+run after run. Embeddings are stored as float16 (half the size, and plenty of
+precision for cosine similarity), keyed on a hash of their input and the name
+of the model that produced them.
+"""
+
+import sqlite3
+import threading
+from collections.abc import Callable
+from pathlib import Path
+
+import numpy as np
+
+from cinescrapers.utils import get_hashed
+
+EMBEDDINGS_DB = Path(__file__).parent / "embeddings.db"
+IMAGE_EMBEDDINGS_FOLDER = Path(__file__).parent / "image_embeddings"
+
+
+def get_embeddings_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(EMBEDDINGS_DB, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS text_embeddings (
+            model TEXT NOT NULL,
+            text_hash TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            PRIMARY KEY (model, text_hash)
+        )
+    """
+    )
+    return conn
+
+
+def get_text_embeddings(
+    texts: list[str], model_name: str, encode: Callable[[list[str]], np.ndarray]
+) -> np.ndarray:
+    """Get the embeddings of some texts, as an array with a row per text.
+    Any we haven't seen before are encoded in one call to encode()."""
+    text_hashes = [get_hashed(text) for text in texts]
+    vectors: dict[str, np.ndarray] = {}
+    with get_embeddings_connection() as conn:
+        for text_hash in set(text_hashes):
+            row = conn.execute(
+                "SELECT vector FROM text_embeddings WHERE model = ? AND text_hash = ?",
+                (model_name, text_hash),
+            ).fetchone()
+            if row is not None:
+                vectors[text_hash] = np.frombuffer(row[0], dtype=np.float16)
+
+    missing = {h: text for h, text in zip(text_hashes, texts) if h not in vectors}
+    if missing:
+        encoded = np.asarray(encode(list(missing.values())), dtype=np.float16)
+        vectors.update(zip(missing, encoded))
+        with get_embeddings_connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO text_embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                [(model_name, h, vectors[h].tobytes()) for h in missing],
+            )
+    return np.stack([vectors[h] for h in text_hashes]).astype(np.float32)
+
+
+class ImageEmbeddingStore:
+    """Image embeddings from one model, keyed on the image's content hash.
+
+    The vectors are appended to a flat float16 file that we memory map, so
+    looking one up doesn't mean reading them all in, and an sqlite index maps
+    content hashes to rows. Rows are handed out under the index's write lock,
+    so several processes can add embeddings at once.
+    """
+
+    def __init__(
+        self, model_name: str, dimensions: int, folder: Path = IMAGE_EMBEDDINGS_FOLDER
+    ):
+        self.dimensions = dimensions
+        # Model names can have slashes in, eg. "ViT-B/32"
+        self.folder = folder / model_name.replace("/", "-")
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.folder / "vectors.f16"
+        self.vectors_path.touch()
+        self.index_db = self.folder / "index.db"
+        self.lock = threading.Lock()
+        self.vectors = self.load_vectors()
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS image_embeddings (
+                    content_hash TEXT PRIMARY KEY,
+                    row INTEGER NOT NULL
+                )
+            """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS image_embeddings_row ON image_embeddings (row)"
+            )
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.index_db, timeout=30)
+
+    def load_vectors(self) -> np.ndarray:
+        row_bytes = self.dimensions * np.dtype(np.float16).itemsize
+        num_rows = self.vectors_path.stat().st_size // row_bytes
+        if num_rows == 0:
+            # Can't memory map an empty file
+            return np.empty((0, self.dimensions), dtype=np.float16)
+        return np.memmap(
+            self.vectors_path,
+            dtype=np.float16,
+            mode="r",
+            shape=(num_rows, self.dimensions),
+        )
+
+    def get_row(self, content_hash: str) -> int | None:
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT row FROM image_embeddings WHERE content_hash = ?",
+                (content_hash,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def __contains__(self, content_hash: str) -> bool:
+        return self.get_row(content_hash) is not None
+
+    def get(self, content_hash: str) -> np.ndarray | None:
+        row = self.get_row(content_hash)
+        if row is None:
+            return None
+        with self.lock:
+            if row >= len(self.vectors):
+                # Added since we mapped the file
+                self.vectors = self.load_vectors()
+            vectors = self.vectors
+        return np.array(vectors[row], dtype=np.float32)
+
+    def get_vectors(self, rows: np.ndarray) -> np.ndarray:
+        """The vectors in some rows, as float32"""
+        with self.lock:
+            if len(rows) and rows.max() >= len(self.vectors):
+                self.vectors = self.load_vectors()
+            vectors = self.vectors
+        return np.asarray(vectors[rows], dtype=np.float32)
+
+    def add(self, content_hash: str, vector: np.ndarray) -> None:
+        vector = np.asarray(vector, dtype=np.float16).reshape(self.dimensions)
+        row_bytes = self.dimensions * np.dtype(np.float16).itemsize
+        with self.lock, self.connect() as conn:
+            # Take the write lock before picking a row, so another process
+            # adding an embedding can't pick the same one
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute(
+                "SELECT 1 FROM image_embeddings WHERE content_hash = ?",
+                (content_hash,),
+            ).fetchone():
+                return
+            (row,) = conn.execute(
+                """
+                INSERT INTO image_embeddings (content_hash, row)
+                SELECT ?, COALESCE(MAX(row) + 1, 0) FROM image_embeddings
+                RETURNING row
+            """,
+                (content_hash,),
+            ).fetchone()
+            # If we crash before committing, the next add overwrites this
+            with self.vectors_path.open("r+b") as f:
+                f.seek(row * row_bytes)
+                f.write(vector.tobytes())
@@ -7,6 +7,20 @@ class TooManyRequestsError(Exception):
 
     pass
 
+
 class EmptyPage(Exception):
     """We got an empty page (which probably means we ran out of pages while
-    hitting an API)"""
\ No newline at end of file
+    hitting an API)"""
+
+
+class ImageDownloadError(Exception):
+    """We couldn't download an image, or what we got wasn't an image"""
+
+
+class TMDBCacheMiss(Exception):
+    """We're in offline mode and the TMDB response we need isn't cached"""
+
+
+class TMDBNotFound(Exception):
+    """TMDB doesn't have what we asked for (eg. a film that's been deleted or
+    merged into another)"""
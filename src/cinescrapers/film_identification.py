@@ -1,9 +1,12 @@
-import datetime
+import concurrent.futures
+import functools
 import os
-from io import BytesIO
+import tempfile
+import threading
 from pathlib import Path
 
 import clip
+import numpy as np
 import requests
 import torch
 from PIL import Image
@@ -11,197 +14,500 @@ from rich import print
 from sentence_transformers import SentenceTransformer
 
 from cinescrapers.cinescrapers_types import EnrichedShowTime
+from cinescrapers.embedding_server import request_embeddings
+from cinescrapers.embedding_store import ImageEmbeddingStore, get_text_embeddings
+from cinescrapers.exceptions import TMDBNotFound
+from cinescrapers.fuzzy_title_index import FuzzyTitleIndex
+from cinescrapers.image_store import find_source_image
+from cinescrapers.match_scoring import get_match_score, get_release_year
+from cinescrapers.perceptual_hash import fingerprints_match, get_file_fingerprint
+from cinescrapers.poster_index import PosterIndex
 from cinescrapers.title_normalization import normalize_title
+from cinescrapers.tmdb_client import get_tmdb_client
+from cinescrapers.tmdb_title_index import find_films_by_title
+from cinescrapers.utils import get_hashed_bytes
 
-TMDB_API_KEY = os.environ["TMDB_API_KEY"]
-TMDB_BASE_URL = "https://api.themoviedb.org/3"
 TMDB_IMAGE_PATH = Path(__file__).parent / "tmdb_images"
 TMDB_IMAGE_PATH.mkdir(exist_ok=True)
-last_year = datetime.datetime.now().year - 1
-
-
-def tmdb_image_from_path(image_path: str) -> Image.Image:
-    """Fetch an image from TMDB using the image path"""
+# Searches for generic titles ("Home", "Love") can go on for dozens of pages,
+# but by then we're well past anything that could be the film we want
+TMDB_SEARCH_MAX_PAGES = 3
+# Release years in showtimes aren't super-reliable, so films released this
+# many years either side of it are candidates too
+RELEASE_YEAR_WINDOW = 1
+SIMILARITY_MODEL_NAME = "all-MiniLM-L6-v2"
+CLIP_MODEL_NAME = "ViT-B/32"
+CLIP_EMBEDDING_DIMENSIONS = 512
+# "float32", or "int8" to run the models with dynamically quantized weights,
+# which is quicker on CPU but gives slightly different embeddings (see
+# tests/film_id/test_quantization.py for how different)
+EMBEDDING_BACKEND = os.environ.get("CINESCRAPERS_EMBEDDING_BACKEND", "float32")
+# Poster and backdrop downloads come from TMDB's CDN, which isn't rate limited
+TMDB_IMAGE_DOWNLOAD_CONCURRENCY = 16
+# If more films than this share a title, the local title index isn't much
+# help, and TMDB's search ranking is a better place to start
+LOCAL_INDEX_MAX_CANDIDATES = 5
+# How many near-miss titles to take films from, from the titles we've seen
+FUZZY_INDEX_MAX_TITLES = 3
+# A film found without searching (eg. one whose original title matches)
+# needs to score at least this for us to trust it's the right one. Otherwise
+# we search TMDB as well, in case it's a different film with that title.
+LOCAL_MATCH_MIN_SCORE = 0.3
+# When we can't find a film by title, how many films with similar posters to
+# try, and how similar their posters need to be
+POSTER_INDEX_MAX_CANDIDATES = 5
+POSTER_INDEX_MIN_SIMILARITY = 0.85
+# A TMDB poster that looks like the showtime's image by perceptual hash counts
+# as the same picture if CLIP agrees they're at least this similar
+SAME_POSTER_MIN_SIMILARITY = 0.9
+# We match several films at once in threads, make sure we only load each
+# model once
+_model_lock = threading.Lock()
+
+
+def get_tmdb_image_file(image_path: str) -> Path:
+    """Download an image from TMDB using the image path, if we haven't
+    already, and return where it is on disk"""
     # The image paths returned by the API are relative and need to be
     # prefixed
     assert image_path.startswith("/")
     image_filename = image_path.split("/")[-1]
     image_filepath = TMDB_IMAGE_PATH / image_filename
-    if image_filepath.exists():
-        im = Image.open(image_filepath)
-    else:
+    if not image_filepath.exists():
         image_url = f"https://image.tmdb.org/t/p/w500{image_path}"
-        response = requests.get(image_url)
-        response.raise_for_status()
-        image_buffer = BytesIO(response.content)
-        image_filepath.write_bytes(image_buffer.getvalue())
-        image_buffer.seek(0)
-        im = Image.open(image_buffer)
-    return im
+        content = get_tmdb_client().get_image(image_url)
+        # Several threads may be downloading images, make sure none of them
+        # ever sees a partial file
+        fd, tmp_name = tempfile.mkstemp(dir=TMDB_IMAGE_PATH, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        Path(tmp_name).replace(image_filepath)
+    return image_filepath
+
+
+@functools.lru_cache(maxsize=1)
+def get_image_download_executor() -> concurrent.futures.ThreadPoolExecutor:
+    # Shared by all the films being matched at once, so we never have more
+    # than this many downloads going
+    return concurrent.futures.ThreadPoolExecutor(TMDB_IMAGE_DOWNLOAD_CONCURRENCY)
+
+
+def prefetch_tmdb_images(tmdb_results: list[dict]) -> None:
+    """Download all the posters and backdrops for some search results at
+    once, rather than one at a time as we score them"""
+    image_paths = {
+        r[key]
+        for r in tmdb_results
+        for key in ("poster_path", "backdrop_path")
+        if r.get(key)
+    }
+    missing = [
+        p for p in image_paths if not (TMDB_IMAGE_PATH / p.split("/")[-1]).exists()
+    ]
+    executor = get_image_download_executor()
+    for future in [executor.submit(get_tmdb_image_file, p) for p in missing]:
+        try:
+            future.result()
+        except requests.RequestException as e:
+            # Scoring will try again and fail properly if it needs to
+            print(f"Failed to prefetch TMDB image: {e}")
+
+
+def filter_by_release_year(
+    candidates: list[dict], release_year: int | None
+) -> list[dict]:
+    if not release_year:
+        return candidates
+    return [
+        c
+        for c in candidates
+        if c.get("release_date")
+        and abs(int(c["release_date"][:4]) - release_year) <= RELEASE_YEAR_WINDOW
+    ]
+
+
+def deduplicate_by_id(tmdb_results: list[dict]) -> list[dict]:
+    # The same film can turn up on more than one page, or in more than one
+    # year's search
+    return list({r["id"]: r for r in tmdb_results}.values())
 
 
-def search_tmdb_by_title(title, year: int | None = None) -> list[dict]:
-    """Search TMDB for a movie by title and optional year"""
-    search_url = f"{TMDB_BASE_URL}/search/movie"
-    params = {"api_key": TMDB_API_KEY, "query": title}
+def search_tmdb_by_title(
+    title,
+    year: int | None = None,
+    max_pages: int = TMDB_SEARCH_MAX_PAGES,
+    stop_on_exact_match: bool = True,
+) -> list[dict]:
+    """Search TMDB for a movie by title and optional year.
+
+    Results come back most relevant first, so we only fetch up to max_pages
+    pages. With stop_on_exact_match we also stop as soon as we've seen the
+    last exact (normalized) title match, as the rest will just be films with
+    the title somewhere in their names.
+    """
+    if max_pages < 1:
+        raise ValueError(f"max_pages must be at least 1, not {max_pages}")
+    client = get_tmdb_client()
+    params = {"query": title}
 
     if year:
         params["primary_release_year"] = str(year)
 
-    response = requests.get(search_url, params=params)
-    response.raise_for_status()
-    response_data = response.json()
+    response_data = client.get("search/movie", params)
 
-    results = []
     total_pages = response_data.get("total_pages", 0)
     if total_pages == 0:
         print(f"No results found for '{title}'")
         return []
 
-    for page in range(1, total_pages + 1):
-        params["page"] = page
-        response = requests.get(search_url, params=params)
-        response.raise_for_status()
-        response_data = response.json()
-        if response_data["results"]:
-            results.extend(response_data["results"])
-    print(f"Found {len(results)} results for {title} (year: {year})")
+    norm_title = normalize_title(title)
+    results = []
+    seen_exact_match = False
+    for page in range(1, min(total_pages, max_pages) + 1):
+        if page > 1:
+            params["page"] = page
+            response_data = client.get("search/movie", params)
+        page_results = response_data["results"]
+        results.extend(page_results)
+        if not stop_on_exact_match:
+            continue
+        is_exact = [normalize_title(r["title"]) == norm_title for r in page_results]
+        seen_exact_match = seen_exact_match or any(is_exact)
+        if seen_exact_match and not all(is_exact):
+            break
+    print(
+        f"Found {len(results)} results for {title} (year: {year}, {page} of {total_pages} pages)"
+    )
 
     return results
 
 
-def get_tmdb_movie_details(tmdb_id) -> dict:
-    """Get detailed movie information from TMDB by movie ID"""
-    details_url = f"{TMDB_BASE_URL}/movie/{tmdb_id}"
-    params = {"api_key": TMDB_API_KEY}
-
-    response = requests.get(details_url, params=params)
-    response.raise_for_status()
-    return response.json()
-
-
-def get_similarity_model():
-    """Load the SentenceTransformer model for text similarity"""
-    if not hasattr(get_similarity_model, "_model"):
-        get_similarity_model._model = SentenceTransformer("all-MiniLM-L6-v2")
-    return get_similarity_model._model
+def search_tmdb_by_title_and_year(
+    title, year: int, max_pages: int = TMDB_SEARCH_MAX_PAGES
+) -> list[dict]:
+    """Search TMDB for films with a title released around a year.
 
+    We search once without the year and filter the results ourselves, unless
+    there are too many to page through, in which case we search each year in
+    the window separately.
+    """
+    client = get_tmdb_client()
+    params = {"query": title}
+    response_data = client.get("search/movie", params)
+    total_pages = response_data.get("total_pages", 0)
+    if total_pages > max_pages:
+        print(f"Too many results for {title}, searching by year")
+        tmdb_results = [
+            result
+            for search_year in range(
+                year - RELEASE_YEAR_WINDOW, year + RELEASE_YEAR_WINDOW + 1
+            )
+            for result in search_tmdb_by_title(title, search_year, max_pages)
+        ]
+    else:
+        tmdb_results = list(response_data.get("results", []))
+        for page in range(2, total_pages + 1):
+            response_data = client.get("search/movie", {**params, "page": page})
+            tmdb_results.extend(response_data["results"])
+        tmdb_results = filter_by_release_year(tmdb_results, year)
+        print(
+            f"Found {len(tmdb_results)} results for {title} around {year} ({total_pages} pages)"
+        )
+    return deduplicate_by_id(tmdb_results)
 
-def get_sentence_embedding(text: str) -> torch.Tensor:
-    """Get embedding for a given text using SentenceTransformer"""
 
-    similarity_model = get_similarity_model()
-    embedding = similarity_model.encode(text, convert_to_tensor=True)
-    return embedding
+def get_tmdb_movie_details(tmdb_id) -> dict:
+    """Get detailed movie information from TMDB by movie ID"""
+    return get_tmdb_client().get(f"movie/{tmdb_id}")
+
+
+def get_known_films_details(tmdb_ids) -> list[dict]:
+    """Get the details of films whose IDs we found in our own indexes,
+    skipping any that TMDB has deleted or merged since"""
+    films = []
+    for tmdb_id in tmdb_ids:
+        try:
+            films.append(get_tmdb_movie_details(tmdb_id))
+        except TMDBNotFound:
+            print(f"TMDB film {tmdb_id} not found, skipping it")
+    return films
+
+
+def get_model_key(model_name: str, backend: str = EMBEDDING_BACKEND) -> str:
+    """What a model's embeddings are stored (and served) under. Quantized
+    models give slightly different embeddings, so keep them apart."""
+    if backend == "float32":
+        return model_name
+    return f"{model_name}-{backend}"
+
+
+def quantize_model(model: torch.nn.Module, backend: str) -> torch.nn.Module:
+    if backend == "float32":
+        return model
+    if backend == "int8":
+        # The linear layers are nearly all of the work in both models
+        return torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    raise ValueError(f"Unknown embedding backend {backend}")
 
 
-def get_clip_embedding(im: Image.Image) -> torch.Tensor:
-    """Get CLIP embedding for an image"""
-    if not hasattr(get_clip_embedding, "_cache"):
-        model, preprocess = clip.load("ViT-B/32")
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        get_clip_embedding._cache = (model, preprocess, device)
-    model, preprocess, device = get_clip_embedding._cache
-    image = preprocess(im).unsqueeze(0).to(device)  # type: ignore
+def get_similarity_model(backend: str = EMBEDDING_BACKEND):
+    """Load the SentenceTransformer model for text similarity"""
+    with _model_lock:
+        if not hasattr(get_similarity_model, "_models"):
+            get_similarity_model._models = {}
+        if backend not in get_similarity_model._models:
+            # Quantized models only run on the CPU
+            device = "cpu" if backend != "float32" else None
+            model = SentenceTransformer(SIMILARITY_MODEL_NAME, device=device)
+            get_similarity_model._models[backend] = quantize_model(model, backend)
+    return get_similarity_model._models[backend]
+
+
+def get_sentence_embeddings(texts: list[str]) -> torch.Tensor:
+    """Get normalized embeddings for some texts using SentenceTransformer,
+    one row per text. We only run the model (once) for texts we haven't seen
+    before."""
+    embeddings = get_text_embeddings(
+        texts, get_model_key(SIMILARITY_MODEL_NAME), encode_texts
+    )
+    return torch.nn.functional.normalize(torch.from_numpy(embeddings), dim=-1)
+
+
+def encode_texts(texts: list[str]) -> np.ndarray:
+    """Run texts through the SentenceTransformer model, on the embedding
+    server if it's running"""
+    vectors = request_embeddings("text", get_model_key(SIMILARITY_MODEL_NAME), texts)
+    if vectors is None:
+        vectors = get_similarity_model().encode(texts, convert_to_numpy=True)
+    return vectors
+
+
+def load_clip_model(backend: str = EMBEDDING_BACKEND):
+    with _model_lock:
+        if not hasattr(load_clip_model, "_models"):
+            load_clip_model._models = {}
+        if backend not in load_clip_model._models:
+            if backend == "float32" and torch.cuda.is_available():
+                device = "cuda"
+            else:
+                device = "cpu"
+            model, preprocess = clip.load(CLIP_MODEL_NAME, device=device)
+            model = quantize_model(model, backend)
+            load_clip_model._models[backend] = (model, preprocess, device)
+    return load_clip_model._models[backend]
+
+
+def get_clip_embeddings(
+    images: list[Image.Image], backend: str = EMBEDDING_BACKEND
+) -> torch.Tensor:
+    """Get normalized CLIP embeddings for a batch of images"""
+    model, preprocess, device = load_clip_model(backend)
+    batch = torch.stack([preprocess(im) for im in images]).to(device)  # type: ignore
     with torch.no_grad():
-        image_features = model.encode_image(image)
+        image_features = model.encode_image(batch)
     return image_features / image_features.norm(dim=-1, keepdim=True)
 
 
-def get_similarity_score(
-    showtime: EnrichedShowTime, tmdb_data: dict, images_cache: Path
-) -> float:
-    """Calculate cosine similarity score between text and image embeddings"""
-
-    description_embedding = get_sentence_embedding(showtime.description)
-    tmdb_overview_embedding = get_sentence_embedding(tmdb_data["overview"])
-    overview_similarity = torch.nn.functional.cosine_similarity(
-        description_embedding, tmdb_overview_embedding, dim=0
-    ).item()
-
-    showtime_image_src = showtime.thumbnail
-    showtime_image_embedding = None
-    if showtime_image_src:
-        image_src_path = images_cache / showtime_image_src
-        if image_src_path.exists():
-            im = Image.open(image_src_path)
-            showtime_image_embedding = get_clip_embedding(im)
-        else:
-            print("Does not exist:", image_src_path)
-
-    if showtime_image_embedding is None:
-        max_image_similarity = 0
-    else:
-        # print("Checking result:", result)
-        poster_path = tmdb_data.get("poster_path")
-        backdrop_path = tmdb_data.get("backdrop_path")
-        poster_similarity = None
-        backdrop_similarity = None
-
-        if poster_path:
-            im = tmdb_image_from_path(poster_path)
-            poster_embedding = get_clip_embedding(im)
-            poster_similarity = torch.nn.functional.cosine_similarity(
-                showtime_image_embedding, poster_embedding
-            )
-        if backdrop_path:
-            im = tmdb_image_from_path(backdrop_path)
-            backdrop_embedding = get_clip_embedding(im)
-            backdrop_similarity = torch.nn.functional.cosine_similarity(
-                showtime_image_embedding, backdrop_embedding
-            )
-        print(f"Poster similarity: {poster_similarity}")
-        print(f"Backdrop similarity: {backdrop_similarity}")
-        max_image_similarity = max(
-            poster_similarity.item() if poster_similarity is not None else 0,
-            backdrop_similarity.item() if backdrop_similarity is not None else 0,
+@functools.lru_cache(maxsize=1)
+def get_image_embedding_store() -> ImageEmbeddingStore:
+    return ImageEmbeddingStore(
+        get_model_key(CLIP_MODEL_NAME), CLIP_EMBEDDING_DIMENSIONS
+    )
+
+
+def encode_image_files(image_paths: list[Path]) -> np.ndarray:
+    """Run image files through CLIP, on the embedding server if it's
+    running"""
+    vectors = request_embeddings(
+        "image",
+        get_model_key(CLIP_MODEL_NAME),
+        [str(path.resolve()) for path in image_paths],
+    )
+    if vectors is None:
+        images = [Image.open(path) for path in image_paths]
+        vectors = get_clip_embeddings(images).float().cpu().numpy()
+    return vectors
+
+
+def get_image_embeddings(image_paths: list[Path]) -> torch.Tensor:
+    """Get CLIP embeddings for some image files, one row per file. Images we
+    haven't seen before go through CLIP together in one batch."""
+    store = get_image_embedding_store()
+    content_hashes = [get_hashed_bytes(path.read_bytes()) for path in image_paths]
+    vectors: dict[str, np.ndarray] = {}
+    for content_hash in set(content_hashes):
+        vector = store.get(content_hash)
+        if vector is not None:
+            vectors[content_hash] = vector
+
+    missing = {
+        h: path for h, path in zip(content_hashes, image_paths) if h not in vectors
+    }
+    if missing:
+        embeddings = encode_image_files(list(missing.values()))
+        for content_hash, vector in zip(missing, embeddings):
+            store.add(content_hash, vector)
+            vectors[content_hash] = vector
+    return torch.from_numpy(np.stack([vectors[h] for h in content_hashes]))
+
+
+def backfill_image_embeddings(image_paths: list[Path], batch_size: int = 32) -> int:
+    """Work out CLIP embeddings for any of the images we don't have them for
+    yet, in batches. Returns how many we added."""
+    store = get_image_embedding_store()
+    to_add: list[tuple[str, Path]] = []
+    num_added = 0
+
+    def flush():
+        nonlocal num_added
+        embeddings = encode_image_files([path for _, path in to_add])
+        for (content_hash, _), vector in zip(to_add, embeddings):
+            store.add(content_hash, vector)
+        num_added += len(to_add)
+        print(f"Added {num_added} embeddings")
+        to_add.clear()
+
+    for image_path in image_paths:
+        content_hash = get_hashed_bytes(image_path.read_bytes())
+        if content_hash in store or any(h == content_hash for h, _ in to_add):
+            continue
+        try:
+            with Image.open(image_path) as im:
+                im.load()
+        except (OSError, Image.DecompressionBombError) as e:
+            print(f"Skipping {image_path}: {e}")
+            continue
+        to_add.append((content_hash, image_path))
+        if len(to_add) >= batch_size:
+            flush()
+    if to_add:
+        flush()
+    return num_added
+
+
+def get_similarity_features(
+    showtime: EnrichedShowTime, candidates: list[dict], images_cache: Path
+) -> list[tuple[float, float]]:
+    """Work out how similar each TMDB candidate's overview and images are to
+    the showtime's description and image, as (overview similarity, image
+    similarity) pairs. All the candidates are done together, so each model
+    only runs once."""
+
+    text_embeddings = get_sentence_embeddings(
+        [showtime.description] + [c.get("overview") or "" for c in candidates]
+    )
+    overview_similarities = text_embeddings[1:] @ text_embeddings[0]
+
+    max_image_similarities = torch.zeros(len(candidates))
+    image_src_path = None
+    if showtime.thumbnail:
+        image_src_path = find_source_image(images_cache, showtime.thumbnail)
+        if image_src_path is None:
+            print("Does not exist:", showtime.thumbnail)
+    if image_src_path is not None:
+        showtime_fingerprint = get_file_fingerprint(image_src_path)
+        # Which candidate each poster or backdrop belongs to
+        image_paths = [image_src_path]
+        image_candidates = []
+        # Whether each one looks like the same picture as the showtime's
+        same_poster = []
+        for i, candidate in enumerate(candidates):
+            for key in ("poster_path", "backdrop_path"):
+                if candidate.get(key):
+                    image_file = get_tmdb_image_file(candidate[key])
+                    image_paths.append(image_file)
+                    image_candidates.append(i)
+                    same_poster.append(
+                        key == "poster_path"
+                        and fingerprints_match(
+                            showtime_fingerprint, get_file_fingerprint(image_file)
+                        )
+                    )
+        image_embeddings = get_image_embeddings(image_paths)
+        image_similarities = image_embeddings[1:] @ image_embeddings[0]
+        # Resizing and recompression cost a little CLIP similarity, but don't
+        # make it a different poster
+        confirmed = torch.tensor(same_poster, dtype=torch.bool) & (
+            image_similarities >= SAME_POSTER_MIN_SIMILARITY
+        )
+        image_similarities[confirmed] = 1.0
+        max_image_similarities.scatter_reduce_(
+            0,
+            torch.tensor(image_candidates, dtype=torch.long),
+            image_similarities,
+            reduce="amax",
         )
 
-    print(f"Max image similarity: {max_image_similarity}")
-
-    # Increase points if films have similar overviews:
-    if overview_similarity > 0.2:
-        overview_similarity_points = (overview_similarity - 0.2) * 1.0 / 0.8
-    else:
-        overview_similarity_points = 0.0
-    print(f"Adding {overview_similarity_points} points for overview similarity")
-
-    # increase points if either image is similar to the showtime image:
-    if max_image_similarity > 0.65:
-        image_similarity_points = (max_image_similarity - 0.65) * 1.0 / 0.35
-    else:
-        image_similarity_points = 0.0
-    print(f"Adding {image_similarity_points} points for image similarity")
+    return list(zip(overview_similarities.tolist(), max_image_similarities.tolist()))
+
+
+def score_candidates(
+    showtime: EnrichedShowTime, candidates: list[dict], images_cache: Path
+) -> None:
+    """Add the similarity features and overall similarity score to each of
+    the candidates"""
+    features = get_similarity_features(showtime, candidates, images_cache)
+    for candidate, (overview_similarity, image_similarity) in zip(candidates, features):
+        candidate["overview_similarity"] = overview_similarity
+        candidate["image_similarity"] = image_similarity
+        candidate["similarity_score"] = get_match_score(
+            overview_similarity,
+            image_similarity,
+            get_release_year(candidate.get("release_date")),
+        )
+        print(
+            f"{candidate['title']} ({candidate.get('release_date')}): overview similarity {overview_similarity:.3f}, "
+            f"image similarity {image_similarity:.3f}, score {candidate['similarity_score']:.3f}"
+        )
 
-    release_date = tmdb_data.get("release_date")
-    recency_points = 0.0
-    if release_date:
-        release_year = int(release_date.split("-")[0])
-        if release_year >= last_year:
-            # If it's a recent film, that makes it more likely to be showing
-            recency_points = 0.05
-    print(f"Adding {recency_points} points for recency")
 
-    return (
-        overview_similarity_points + image_similarity_points + recency_points
-    ) / 2.05
+def get_local_candidates(showtime: EnrichedShowTime) -> list[dict]:
+    """Find the films with exactly the showtime's title in the local title
+    index, and get their details. Returns [] if there aren't any, or if the
+    title is too common for the index to narrow things down."""
+    tmdb_ids = find_films_by_title(showtime.norm_title)
+    if not tmdb_ids or len(tmdb_ids) > LOCAL_INDEX_MAX_CANDIDATES:
+        return []
+    candidates = get_known_films_details(tmdb_ids)
+    candidates = filter_by_release_year(candidates, showtime.release_year)
+    print(f"Found {len(candidates)} films called {showtime.norm_title} in title index")
+    return candidates
+
+
+def get_fuzzy_candidates(
+    showtime: EnrichedShowTime, title_index: FuzzyTitleIndex | None
+) -> list[dict]:
+    """Find the films with titles we've seen that nearly match the
+    showtime's, and get their details"""
+    if title_index is None:
+        return []
+    titles = title_index.search(showtime.norm_title, FUZZY_INDEX_MAX_TITLES)
+    tmdb_ids = sorted(
+        {tmdb_id for _, title in titles for tmdb_id in title_index.get_tmdb_ids(title)}
+    )
+    if not tmdb_ids or len(tmdb_ids) > LOCAL_INDEX_MAX_CANDIDATES:
+        return []
+    candidates = get_known_films_details(tmdb_ids)
+    candidates = filter_by_release_year(candidates, showtime.release_year)
+    print(
+        f"Found {len(candidates)} films with titles like {showtime.norm_title} "
+        f"in fuzzy title index"
+    )
+    return candidates
 
 
-def get_best_tmdb_match(showtime: EnrichedShowTime, images_cache: Path) -> dict | None:
-    """Find the best TMDB match for a showtime data entry"""
+def search_candidates(showtime: EnrichedShowTime) -> list[dict]:
+    """Find candidate films for a showtime using TMDB's search API"""
     if showtime.release_year:
-        # It turns out the release year isn't super-reliable. Let's also try adjacent years
-        tmdb_results = (
-            search_tmdb_by_title(title=showtime.norm_title, year=showtime.release_year)
-            + search_tmdb_by_title(
-                title=showtime.norm_title, year=showtime.release_year - 1
-            )
-            + search_tmdb_by_title(
-                title=showtime.norm_title, year=showtime.release_year + 1
-            )
+        tmdb_results = search_tmdb_by_title_and_year(
+            title=showtime.norm_title, year=showtime.release_year
         )
     else:
-        tmdb_results = search_tmdb_by_title(title=showtime.norm_title)
+        tmdb_results = deduplicate_by_id(
+            search_tmdb_by_title(title=showtime.norm_title)
+        )
 
     # Discard any results that don't have a title (which seems to happen)
     tmdb_results = [r for r in tmdb_results if r["title"].strip()]
@@ -214,19 +520,107 @@ def get_best_tmdb_match(showtime: EnrichedShowTime, images_cache: Path) -> dict
         # If we have no results but we have the year, let's try again but
         # without constraining to identical titles
         tmdb_results_filtered = tmdb_results
-
-    if tmdb_results_filtered == []:
+    return tmdb_results_filtered
+
+
+@functools.lru_cache(maxsize=1)
+def get_poster_index() -> PosterIndex:
+    return PosterIndex(get_image_embedding_store())
+
+
+def index_candidate_images(candidates: list[dict]) -> None:
+    """Add the candidates' posters and backdrops to the poster index, so we
+    can find the films by their images in future"""
+    image_files = {
+        TMDB_IMAGE_PATH / candidate[key].split("/")[-1]: candidate["id"]
+        for candidate in candidates
+        for key in ("poster_path", "backdrop_path")
+        if candidate.get(key)
+    }
+    image_files = {path: id for path, id in image_files.items() if path.exists()}
+    if not image_files:
+        return
+    # Scoring only runs candidates' images through CLIP if the showtime has
+    # an image to compare them with
+    get_image_embeddings(list(image_files))
+    poster_index = get_poster_index()
+    for image_file, tmdb_id in image_files.items():
+        poster_index.add(get_hashed_bytes(image_file.read_bytes()), tmdb_id)
+
+
+def get_image_candidates(showtime: EnrichedShowTime, images_cache: Path) -> list[dict]:
+    """Find films whose posters or backdrops we've seen before that look
+    like the showtime's image, for when we can't find it by title"""
+    if not showtime.thumbnail:
+        return []
+    image_src_path = find_source_image(images_cache, showtime.thumbnail)
+    if image_src_path is None:
+        return []
+    embedding = get_image_embeddings([image_src_path])[0].numpy()
+    matches = [
+        (similarity, tmdb_id)
+        for similarity, tmdb_id in get_poster_index().search(
+            embedding, k=POSTER_INDEX_MAX_CANDIDATES
+        )
+        if similarity >= POSTER_INDEX_MIN_SIMILARITY
+    ]
+    print(f"Found {len(matches)} films with similar posters for {showtime.norm_title}")
+    return get_known_films_details(tmdb_id for _, tmdb_id in matches)
+
+
+def get_tmdb_candidates(
+    showtime: EnrichedShowTime,
+    images_cache: Path,
+    title_index: FuzzyTitleIndex | None = None,
+) -> list[dict]:
+    """Find the TMDB films a showtime could be for, with their similarity
+    features and scores. title_index has the titles of films we've matched
+    before, if we have them."""
+    candidates: list[dict] = []
+
+    def add_candidates(new_candidates: list[dict]) -> None:
+        seen = {c["id"] for c in candidates}
+        new_candidates = deduplicate_by_id(
+            [c for c in new_candidates if c["id"] not in seen]
+        )
+        if new_candidates:
+            prefetch_tmdb_images(new_candidates)
+            score_candidates(showtime, new_candidates, images_cache)
+            candidates.extend(new_candidates)
+
+    # Most titles are an exact match for a film's original title, or nearly
+    # match one we've seen before, in which case we don't need to search, as
+    # long as one of the films found looks right. Otherwise, we keep them as
+    # candidates alongside the search results.
+    for find_candidates in (
+        get_local_candidates,
+        functools.partial(get_fuzzy_candidates, title_index=title_index),
+        search_candidates,
+    ):
+        add_candidates(find_candidates(showtime))
+        if any(c["similarity_score"] >= LOCAL_MATCH_MIN_SCORE for c in candidates):
+            break
+    if not candidates:
+        # If the title gets us nowhere, try the image
+        add_candidates(get_image_candidates(showtime, images_cache))
+
+    if candidates == []:
         print(
             f"No TMDB results found for {showtime.norm_title} ({showtime.release_year})"
         )
-        return None
+        return []
+
+    index_candidate_images(candidates)
+    return candidates
 
-    results_with_scores = []
-    for tmdb_result in tmdb_results_filtered:
-        similarity_score = get_similarity_score(showtime, tmdb_result, images_cache)
-        print(f"Similarity score for {showtime.norm_title}: {similarity_score}")
-        tmdb_result["similarity_score"] = similarity_score
-        results_with_scores.append(tmdb_result)
 
-    results_with_scores.sort(key=lambda x: x["similarity_score"], reverse=True)
-    return results_with_scores[0]
+def get_best_tmdb_match(showtime: EnrichedShowTime, images_cache: Path) -> dict | None:
+    """Find the best TMDB match for a showtime data entry"""
+    candidates = get_tmdb_candidates(showtime, images_cache)
+    if not candidates:
+        return None
+    best_match = max(candidates, key=lambda c: c["similarity_score"])
+    print(
+        f"Best similarity score for {showtime.norm_title}: {best_match['similarity_score']}"
+    )
+    return best_match
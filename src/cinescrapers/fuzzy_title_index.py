@@ -0,0 +1,107 @@
+"""Find titles that nearly match a showtime's, among the ones we've seen.
+
+Exact matching misses near misses like "AMELIE" and "AMELIE THE FABULOUS
+DESTINY OF AMELIE POULAIN", or titles with a stray subtitle. This is an in
+memory trigram index of every (normalized) title we've seen from TMDB or
+matched in our own db, with the TMDB IDs each one went with, so near misses
+can be found without asking TMDB.
+"""
+
+import collections
+import sqlite3
+import threading
+
+from cinescrapers.title_normalization import normalize_title
+
+# How similar (Dice coefficient on trigrams) titles need to be to count
+MIN_TITLE_SIMILARITY = 0.7
+
+
+def get_trigrams(title: str) -> set[str]:
+    # Pad so that the start and end of the title count for more
+    padded = f"  {title} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def is_word_prefix(prefix: str, title: str) -> bool:
+    """Eg. "AMELIE" and "AMELIE THE FABULOUS DESTINY OF AMELIE POULAIN" """
+    return title.startswith(prefix + " ")
+
+
+class FuzzyTitleIndex:
+    def __init__(self):
+        self.tmdb_ids: dict[str, set[int]] = collections.defaultdict(set)
+        self.num_trigrams: dict[str, int] = {}
+        self.titles_by_trigram: dict[str, set[str]] = collections.defaultdict(set)
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.tmdb_ids)
+
+    def add(self, norm_title: str, tmdb_id: int) -> None:
+        with self.lock:
+            self.tmdb_ids[norm_title].add(tmdb_id)
+            if norm_title not in self.num_trigrams:
+                trigrams = get_trigrams(norm_title)
+                self.num_trigrams[norm_title] = len(trigrams)
+                for trigram in trigrams:
+                    self.titles_by_trigram[trigram].add(norm_title)
+
+    def search(self, norm_title: str, max_results: int = 5) -> list[tuple[float, str]]:
+        """Titles similar to norm_title (including itself), as (similarity,
+        title), most similar first. A title that's the other with extra words
+        on the end counts as similar, however many extra words there are."""
+        query = get_trigrams(norm_title)
+        shared_trigrams: collections.Counter[str] = collections.Counter()
+        with self.lock:
+            for trigram in query:
+                shared_trigrams.update(self.titles_by_trigram.get(trigram, ()))
+            num_trigrams = {
+                title: self.num_trigrams[title] for title in shared_trigrams
+            }
+        results = []
+        for title, num_shared in shared_trigrams.items():
+            similarity = 2 * num_shared / (len(query) + num_trigrams[title])
+            if similarity >= MIN_TITLE_SIMILARITY or (
+                # Only possible if one title's trigrams are all in the other
+                num_shared == min(len(query), num_trigrams[title])
+                and (
+                    is_word_prefix(norm_title, title)
+                    or is_word_prefix(title, norm_title)
+                )
+            ):
+                results.append((similarity, title))
+        results.sort(reverse=True)
+        return results[:max_results]
+
+    def get_tmdb_ids(self, norm_title: str) -> set[int]:
+        with self.lock:
+            return set(self.tmdb_ids.get(norm_title, ()))
+
+
+def add_tmdb_title(index: FuzzyTitleIndex, title: str, tmdb_id: int) -> None:
+    try:
+        index.add(normalize_title(title), tmdb_id)
+    except AssertionError:
+        # Titles that are all punctuation normalize to nothing
+        pass
+
+
+def load_fuzzy_title_index(conn: sqlite3.Connection) -> FuzzyTitleIndex:
+    """Build an index of the titles in a showtimes db: those of showtimes
+    we've matched, and TMDB's titles for the films we matched them to"""
+    index = FuzzyTitleIndex()
+    for norm_title, tmdb_id in conn.execute(
+        "SELECT DISTINCT norm_title, tmdb_id FROM showtimes WHERE tmdb_id IS NOT NULL"
+    ):
+        index.add(norm_title, tmdb_id)
+    for title, tmdb_id in conn.execute(
+        """
+        SELECT DISTINCT tmdb_candidates.title, tmdb_candidates.tmdb_id
+        FROM tmdb_candidates JOIN showtimes
+        ON showtimes.movie_key = tmdb_candidates.movie_key
+        AND showtimes.tmdb_id = tmdb_candidates.tmdb_id
+    """
+    ):
+        add_tmdb_title(index, title, tmdb_id)
+    return index
@@ -0,0 +1,315 @@
+"""Local storage for scraped source images and their thumbnails.
+
+Files are content-addressed (named after a hash of the image bytes) and
+sharded into subdirectories by the first couple of characters of the hash, so
+no single directory gets huge. An sqlite index maps each source URL to the
+content it served, and records when it was first and last seen so that `gc`
+can throw away images nothing uses any more.
+"""
+
+import datetime
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+import requests
+
+from cinescrapers.exceptions import ImageDownloadError
+from cinescrapers.utils import format_digest, get_hashed, get_hashed_bytes
+
+IMAGES_ROOT = Path(__file__).parent / "scraped_images"
+IMAGES_CACHE = IMAGES_ROOT / "source_images"
+IMAGES_CACHE.mkdir(parents=True, exist_ok=True)
+THUMBNAILS_FOLDER = IMAGES_ROOT / "thumbnails"
+THUMBNAILS_FOLDER.mkdir(parents=True, exist_ok=True)
+IMAGE_INDEX_DB = IMAGES_ROOT / "image_index.db"
+
+# How many leading characters of the hash to use for the subdirectory name
+SHARD_PREFIX_LENGTH = 2
+# Hashes (and so thumbnail stems) are always this long
+HASH_LENGTH = 32
+# Don't garbage collect anything that was referenced more recently than this
+GC_GRACE_PERIOD = datetime.timedelta(days=7)
+# Give up on downloads bigger than this, it's not going to be a sensible poster
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Common image file signatures (magic numbers)
+IMAGE_SIGNATURES = [
+    b"\xff\xd8\xff",  # JPEG
+    b"\x89PNG\r\n\x1a\n",  # PNG
+    b"GIF87a",  # GIF87a
+    b"GIF89a",  # GIF89a
+    b"RIFF",  # WebP (starts with RIFF, followed by WEBP later)
+    b"\x00\x00\x01\x00",  # ICO
+    b"BM",  # BMP
+]
+
+
+def get_shard_folder(folder: Path, filename: str) -> Path:
+    return folder / filename[:SHARD_PREFIX_LENGTH]
+
+
+def get_sharded_path(folder: Path, filename: str) -> Path:
+    """Where a file lives in the sharded layout"""
+    return get_shard_folder(folder, filename) / filename
+
+
+def find_source_image(images_cache: Path, key: str) -> Path | None:
+    """Find a source image by its key, checking the sharded layout first and
+    then the old flat layout (which the test data still uses)"""
+    for path in (get_sharded_path(images_cache, key), images_cache / key):
+        if path.exists():
+            return path
+    return None
+
+
+def get_index_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(IMAGE_INDEX_DB, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS images (
+            url_hash TEXT PRIMARY KEY,
+            source_url TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            first_referenced TEXT NOT NULL,
+            last_referenced TEXT NOT NULL
+        )
+    """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS images_content_hash ON images (content_hash)"
+    )
+    # Perceptual hashes, for spotting the same poster at different sizes etc.
+    # canonical_hash is the content hash of the image whose thumbnail we use.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS image_phashes (
+            content_hash TEXT PRIMARY KEY,
+            phash TEXT NOT NULL,
+            canonical_hash TEXT NOT NULL
+        )
+    """
+    )
+    return conn
+
+
+def lookup_source_url(source_url: str) -> str | None:
+    """Get the content hash of an image we've already downloaded from
+    source_url, and mark it as referenced. Returns None if we don't have it
+    (any more)."""
+    url_hash = get_hashed(source_url)
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    with get_index_connection() as conn:
+        row = conn.execute(
+            "SELECT content_hash FROM images WHERE url_hash = ?", (url_hash,)
+        ).fetchone()
+        if row is None:
+            return None
+        (content_hash,) = row
+        if not get_sharded_path(IMAGES_CACHE, content_hash).exists():
+            return None
+        conn.execute(
+            "UPDATE images SET last_referenced = ? WHERE url_hash = ?",
+            (now, url_hash),
+        )
+    return content_hash
+
+
+def looks_like_image(head: bytes) -> bool:
+    """Check the first few bytes of a file for an image signature"""
+    if len(head) < 8:
+        return False
+    if head.startswith(b"RIFF"):
+        # WebP has a RIFF header but needs to check for WEBP signature too
+        return head[8:12] == b"WEBP"
+    return any(head.startswith(sig) for sig in IMAGE_SIGNATURES)
+
+
+def store_source_image(
+    source_url: str, content: bytes, url_hash: str | None = None
+) -> str:
+    """Save an image downloaded from source_url and record it in the index.
+    Returns the content hash, which is also used as the thumbnail stem."""
+    content_hash = get_hashed_bytes(content)
+    path = get_sharded_path(IMAGES_CACHE, content_hash)
+    if not path.exists():
+        fd, tmp_name = tempfile.mkstemp(dir=IMAGES_CACHE, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        path.parent.mkdir(exist_ok=True)
+        Path(tmp_name).replace(path)
+    record_source_image(source_url, content_hash, len(content), url_hash)
+    return content_hash
+
+
+def download_source_image(
+    source_url: str, headers: dict[str, str], timeout: float = 10
+) -> str:
+    """Stream an image straight into the store without holding it all in
+    memory. Gives up as soon as it's clear that the response isn't an image,
+    or is too big. The file is written under a temporary name and then
+    renamed, so nothing ever sees a partial download. Returns the content
+    hash."""
+    with requests.get(
+        source_url, headers=headers, timeout=timeout, stream=True
+    ) as response:
+        if not response.ok:
+            raise ImageDownloadError(f"HTTP {response.status_code}")
+        content_type = response.headers.get("content-type", "unknown")
+        content_length = response.headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > MAX_IMAGE_BYTES:
+            raise ImageDownloadError(f"Too big ({content_length} bytes)")
+
+        hasher = hashlib.sha256()
+        size = 0
+        head = b""
+        fd, tmp_name = tempfile.mkstemp(dir=IMAGES_CACHE, suffix=".tmp")
+        tmp_path = Path(tmp_name)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    if len(head) < 12:
+                        head += chunk[: 12 - len(head)]
+                        if len(head) == 12 and not looks_like_image(head):
+                            raise ImageDownloadError(
+                                f"Not an image (content-type: {content_type}, no image signature found)"
+                            )
+                    size += len(chunk)
+                    if size > MAX_IMAGE_BYTES:
+                        raise ImageDownloadError(f"Too big (over {size} bytes)")
+                    hasher.update(chunk)
+                    f.write(chunk)
+            if not looks_like_image(head):
+                raise ImageDownloadError(
+                    f"Not an image (content-type: {content_type}, {size} bytes)"
+                )
+            content_hash = format_digest(hasher.digest())
+            path = get_sharded_path(IMAGES_CACHE, content_hash)
+            path.parent.mkdir(exist_ok=True)
+            tmp_path.replace(path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+    record_source_image(source_url, content_hash, size)
+    return content_hash
+
+
+def record_source_image(
+    source_url: str, content_hash: str, size: int, url_hash: str | None = None
+) -> None:
+    """Add an image to the index, or mark it as seen again"""
+    if url_hash is None:
+        url_hash = get_hashed(source_url)
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    with get_index_connection() as conn:
+        conn.execute(
+            """
+            INSERT INTO images (url_hash, source_url, content_hash, size, first_referenced, last_referenced)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(url_hash) DO UPDATE SET
+                content_hash = excluded.content_hash,
+                size = excluded.size,
+                last_referenced = excluded.last_referenced
+        """,
+            (url_hash, source_url, content_hash, size, now, now),
+        )
+
+
+def get_source_image_path(content_hash: str) -> Path:
+    return get_sharded_path(IMAGES_CACHE, content_hash)
+
+
+def get_thumbnail_path(filename: str) -> Path:
+    return get_sharded_path(THUMBNAILS_FOLDER, filename)
+
+
+def get_thumbnail_folder(stem: str) -> Path:
+    folder = get_shard_folder(THUMBNAILS_FOLDER, stem)
+    folder.mkdir(exist_ok=True)
+    return folder
+
+
+def delete_image(content_hash: str) -> int:
+    """Delete a source image and all of its thumbnails. Returns the number of
+    bytes freed."""
+    freed = 0
+    paths = [get_source_image_path(content_hash)]
+    paths.extend(
+        get_shard_folder(THUMBNAILS_FOLDER, content_hash).glob(f"{content_hash}*")
+    )
+    for path in paths:
+        if path.exists():
+            freed += path.stat().st_size
+            path.unlink()
+    return freed
+
+
+def collect_garbage(referenced: set[str], dry_run: bool = False) -> tuple[int, int]:
+    """Delete every image (and its thumbnails) whose content hash isn't in
+    `referenced` and which hasn't been seen during the grace period. Returns
+    the number of images deleted and the bytes freed."""
+    cutoff = (datetime.datetime.now() - GC_GRACE_PERIOD).isoformat(timespec="seconds")
+    if not dry_run:
+        # Leftovers from downloads that got killed part way through
+        for tmp_path in IMAGES_CACHE.glob("*.tmp"):
+            if tmp_path.stat().st_mtime < time.time() - 3600:
+                tmp_path.unlink(missing_ok=True)
+    with get_index_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT content_hash FROM images
+            GROUP BY content_hash
+            HAVING MAX(last_referenced) < ?
+        """,
+            (cutoff,),
+        ).fetchall()
+        to_delete = [ch for (ch,) in rows if ch not in referenced]
+        freed = 0
+        for content_hash in to_delete:
+            if dry_run:
+                print(f"Would delete {content_hash}")
+                continue
+            freed += delete_image(content_hash)
+            conn.execute("DELETE FROM images WHERE content_hash = ?", (content_hash,))
+            conn.execute(
+                "DELETE FROM image_phashes WHERE content_hash = ?", (content_hash,)
+            )
+    return len(to_delete), freed
+
+
+def migrate_flat_layout(source_urls: list[str]) -> dict[str, str]:
+    """Move images and thumbnails from the old flat layout (named after a
+    hash of the source URL) into the sharded, content-addressed layout.
+    `source_urls` is used to fill in the index's source_url column. Returns a
+    mapping of old thumbnail stem -> new thumbnail stem."""
+    urls_by_hash = {get_hashed(url): url for url in source_urls}
+    renamed = {}
+    for path in list(IMAGES_CACHE.iterdir()):
+        if not path.is_file() or path.name.endswith(".tmp"):
+            continue
+        # The old filename was the hash of the source URL
+        content_hash = store_source_image(
+            urls_by_hash.get(path.name, ""), path.read_bytes(), url_hash=path.name
+        )
+        path.unlink()
+        renamed[path.name] = content_hash
+
+    for path in list(THUMBNAILS_FOLDER.iterdir()):
+        if not path.is_file():
+            continue
+        old_stem, suffix = path.name[:HASH_LENGTH], path.name[HASH_LENGTH:]
+        if old_stem not in renamed:
+            print(f"No source image for thumbnail {path.name}, deleting it")
+            path.unlink()
+            continue
+        new_path = (
+            get_thumbnail_folder(renamed[old_stem]) / f"{renamed[old_stem]}{suffix}"
+        )
+        path.replace(new_path)
+    return renamed
@@ -0,0 +1,51 @@
+"""How TMDB candidates are scored, from the features film identification
+works out for them.
+
+Working out the features means searching TMDB and running the embedding
+models, but combining them is cheap. Keeping this separate (and free of
+heavy imports) means `rescore` can try out changes to the weighting on every
+stored candidate in seconds.
+"""
+
+import datetime
+
+# Similarities below these don't count for anything
+OVERVIEW_SIMILARITY_THRESHOLD = 0.2
+IMAGE_SIMILARITY_THRESHOLD = 0.65
+# If it's a recent film, that makes it more likely to be showing
+RECENCY_POINTS = 0.05
+# The most points a candidate can get, so scores are between 0 and 1
+MAX_POINTS = 1.0 + 1.0 + RECENCY_POINTS
+
+
+def get_release_year(release_date: str | None) -> int | None:
+    """TMDB release dates are "YYYY-MM-DD", or "" if TMDB doesn't know"""
+    if not release_date:
+        return None
+    return int(release_date.split("-")[0])
+
+
+def get_match_score(
+    overview_similarity: float, image_similarity: float, release_year: int | None
+) -> float:
+    """Score a candidate from how similar its overview and images are to the
+    showtime's, and its release year"""
+    # Increase points if films have similar overviews
+    overview_similarity_points = max(
+        (overview_similarity - OVERVIEW_SIMILARITY_THRESHOLD)
+        / (1 - OVERVIEW_SIMILARITY_THRESHOLD),
+        0.0,
+    )
+    # Increase points if either image is similar to the showtime image
+    image_similarity_points = max(
+        (image_similarity - IMAGE_SIMILARITY_THRESHOLD)
+        / (1 - IMAGE_SIMILARITY_THRESHOLD),
+        0.0,
+    )
+    last_year = datetime.datetime.now().year - 1
+    recency_points = 0.0
+    if release_year is not None and release_year >= last_year:
+        recency_points = RECENCY_POINTS
+    return (
+        overview_similarity_points + image_similarity_points + recency_points
+    ) / MAX_POINTS
@@ -0,0 +1,211 @@
+"""Perceptual hashing of source images.
+
+The same poster often reaches us from lots of URLs: CDN resizes, different
+query strings, different cinemas. Those aren't byte-identical so content
+hashing doesn't catch them, but their difference hashes (dHash) are the same
+or nearly so. We keep an index of the dHash of every "canonical" image, and
+map each new image onto the canonical one it looks like, so they all share a
+single thumbnail.
+
+Plain images (dark or minimal posters, flat colour) all have much the same
+dHash, so those are never treated as the same as anything, and neither are
+images with different shapes.
+"""
+
+import functools
+import statistics
+import threading
+from os import PathLike
+from typing import NamedTuple
+
+from PIL import Image
+
+from cinescrapers.image_store import get_index_connection, get_source_image_path
+
+# dHashes this many bits apart (out of 64) or fewer are treated as the same image
+MAX_DISTANCE = 4
+HASH_BITS = 64
+# Images whose 9x8 greyscale pixels vary less than this (standard deviation)
+# are too plain for their dHashes to tell them apart
+MIN_DETAIL = 8.0
+# Same for dHashes with fewer than this many bits set, or unset
+MIN_SET_BITS = 8
+# The same picture resized has (nearly) the same aspect ratio
+MAX_ASPECT_RATIO_DIFFERENCE = 0.05
+
+
+class ImageFingerprint(NamedTuple):
+    dhash: int
+    aspect_ratio: float
+    detail: float
+
+
+def get_small_greyscale(im: Image.Image) -> Image.Image:
+    return im.convert("L").resize((9, 8), Image.LANCZOS)  # type: ignore
+
+
+def get_dhash(im: Image.Image) -> int:
+    """64 bit difference hash: shrink to 9x8 greyscale, then record whether
+    each pixel is brighter than its right-hand neighbour"""
+    pixels = get_small_greyscale(im).tobytes()
+    dhash = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            dhash = (dhash << 1) | (left > right)
+    return dhash
+
+
+def get_file_fingerprint(path: str | PathLike) -> ImageFingerprint:
+    with Image.open(path) as im:
+        aspect_ratio = im.width / im.height
+        # We only need a tiny version, so let JPEGs decode at reduced size
+        im.draft("L", (64, 64))
+        return ImageFingerprint(
+            get_dhash(im),
+            aspect_ratio,
+            statistics.pstdev(get_small_greyscale(im).tobytes()),
+        )
+
+
+def is_distinctive(fingerprint: ImageFingerprint) -> bool:
+    """Is there enough going on in the image for its dHash to mean anything?"""
+    set_bits = fingerprint.dhash.bit_count()
+    return (
+        fingerprint.detail >= MIN_DETAIL
+        and MIN_SET_BITS <= set_bits <= HASH_BITS - MIN_SET_BITS
+    )
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def dhashes_match(a: int, b: int) -> bool:
+    """Are these (very probably) hashes of the same picture, give or take
+    resizing and recompression?"""
+    return hamming_distance(a, b) <= MAX_DISTANCE
+
+
+def fingerprints_match(a: ImageFingerprint, b: ImageFingerprint) -> bool:
+    """Are these (very probably) the same picture? Never true for plain
+    images, which would match each other."""
+    return (
+        is_distinctive(a)
+        and is_distinctive(b)
+        and dhashes_match(a.dhash, b.dhash)
+        and abs(a.aspect_ratio / b.aspect_ratio - 1) <= MAX_ASPECT_RATIO_DIFFERENCE
+    )
+
+
+class PerceptualHashIndex:
+    """In-memory index for finding hashes within MAX_DISTANCE of a query.
+
+    The hash is split into MAX_DISTANCE + 1 bands. If two hashes differ in at
+    most MAX_DISTANCE bits, at least one band must be identical (pigeonhole
+    principle), so we only have to compare against hashes sharing a band."""
+
+    def __init__(self, max_distance: int = MAX_DISTANCE):
+        self.max_distance = max_distance
+        num_bands = max_distance + 1
+        band_width, extra = divmod(HASH_BITS, num_bands)
+        self.bands = []
+        shift = 0
+        for i in range(num_bands):
+            width = band_width + (1 if i < extra else 0)
+            self.bands.append((shift, (1 << width) - 1))
+            shift += width
+        self.buckets: list[dict[int, set[str]]] = [{} for _ in self.bands]
+        self.hashes: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def add(self, key: str, dhash: int) -> None:
+        with self.lock:
+            self.hashes[key] = dhash
+            for (shift, mask), buckets in zip(self.bands, self.buckets):
+                buckets.setdefault((dhash >> shift) & mask, set()).add(key)
+
+    def remove(self, key: str) -> None:
+        with self.lock:
+            dhash = self.hashes.pop(key, None)
+            if dhash is None:
+                return
+            for (shift, mask), buckets in zip(self.bands, self.buckets):
+                buckets.get((dhash >> shift) & mask, set()).discard(key)
+
+    def find(self, dhash: int) -> list[tuple[int, str]]:
+        """Keys of the hashes within max_distance of dhash, as (distance, key)
+        pairs, closest first"""
+        with self.lock:
+            candidates = set()
+            for (shift, mask), buckets in zip(self.bands, self.buckets):
+                candidates |= buckets.get((dhash >> shift) & mask, set())
+            matches = [
+                (hamming_distance(dhash, self.hashes[key]), key) for key in candidates
+            ]
+        return sorted(m for m in matches if m[0] <= self.max_distance)
+
+
+@functools.lru_cache(maxsize=1)
+def get_canonical_index() -> PerceptualHashIndex:
+    """Index of the canonical images' hashes, loaded from the image index db"""
+    index = PerceptualHashIndex()
+    with get_index_connection() as conn:
+        rows = conn.execute(
+            "SELECT content_hash, phash FROM image_phashes WHERE content_hash = canonical_hash"
+        ).fetchall()
+    for content_hash, phash in rows:
+        index.add(content_hash, int(phash, 16))
+    return index
+
+
+# Stops two threads both deciding that the same new poster is canonical
+_canonical_lock = threading.Lock()
+
+
+def get_canonical_image(content_hash: str) -> str:
+    """Get the content hash of the image whose thumbnail should be used for
+    the image with this content hash. That's the first near-identical image we
+    saw, or the image itself if it's new or too plain to tell apart from
+    others."""
+    with get_index_connection() as conn:
+        row = conn.execute(
+            "SELECT canonical_hash FROM image_phashes WHERE content_hash = ?",
+            (content_hash,),
+        ).fetchone()
+    if row is not None and get_source_image_path(row[0]).exists():
+        return row[0]
+
+    fingerprint = get_file_fingerprint(get_source_image_path(content_hash))
+    dhash = fingerprint.dhash
+    distinctive = is_distinctive(fingerprint)
+    index = get_canonical_index()
+    with _canonical_lock:
+        canonical_hash = content_hash
+        matches = index.find(dhash) if distinctive else []
+        for _, candidate in matches:
+            if candidate == content_hash:
+                continue
+            candidate_path = get_source_image_path(candidate)
+            if not candidate_path.exists():
+                # Garbage collected since we loaded the index
+                index.remove(candidate)
+                continue
+            if fingerprints_match(fingerprint, get_file_fingerprint(candidate_path)):
+                canonical_hash = candidate
+                break
+        with get_index_connection() as conn:
+            conn.execute(
+                """
+                INSERT INTO image_phashes (content_hash, phash, canonical_hash)
+                VALUES (?, ?, ?)
+                ON CONFLICT(content_hash) DO UPDATE SET
+                    phash = excluded.phash,
+                    canonical_hash = excluded.canonical_hash
+            """,
+                (content_hash, f"{dhash:016x}", canonical_hash),
+            )
+        if canonical_hash == content_hash and distinctive:
+            index.add(content_hash, dhash)
+    return canonical_hash
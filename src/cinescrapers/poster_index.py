@@ -0,0 +1,191 @@
+"""Find TMDB films by how much their posters look like a showtime's image.
+
+Title search fails for retitled events, festival prefixes, foreign-language
+titles and so on, but the showtime's image is often the film's poster, or a
+still from it. Every poster and backdrop we've scored already has a CLIP
+embedding in the ImageEmbeddingStore. This indexes those rows by TMDB ID.
+
+Once there are enough posters it's an inverted file index: the vectors are
+clustered with k-means, and a search only looks at the clusters nearest to
+the query, which is approximate but doesn't have to look at everything.
+Posters added later go into their nearest existing cluster, and everything
+is re-clustered when the index has doubled in size.
+"""
+
+import sqlite3
+import threading
+
+import numpy as np
+
+from cinescrapers.embedding_store import ImageEmbeddingStore
+
+# Below this many posters, just compare against all of them
+MIN_CLUSTERED_SIZE = 5_000
+# How many of the nearest clusters to search
+NUM_PROBES = 8
+KMEANS_ITERATIONS = 10
+
+
+def kmeans(vectors: np.ndarray, num_clusters: int, seed: int = 0) -> np.ndarray:
+    """Spherical k-means, for normalized vectors. Returns the centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = (vectors @ centroids.T).argmax(axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = ~sums.any(axis=1)
+        # Restart empty clusters from random vectors
+        sums[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+    return centroids
+
+
+class PosterIndex:
+    def __init__(self, store: ImageEmbeddingStore):
+        self.store = store
+        self.index_db = store.folder / "poster_index.db"
+        self.centroids_path = store.folder / "poster_centroids.npy"
+        self.lock = threading.Lock()
+        # Held while re-clustering, so only one thread does it
+        self.cluster_lock = threading.Lock()
+        # In memory copy of the index, see load()
+        self.rows = np.empty(0, dtype=np.int64)
+        self.tmdb_ids = np.empty(0, dtype=np.int64)
+        self.clusters = np.empty(0, dtype=np.int64)
+        self.centroids: np.ndarray | None = None
+        # (number of posters, number when last clustered) as of the last load
+        self.loaded_state: tuple[int, int | None] | None = None
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS posters (
+                    row INTEGER PRIMARY KEY,
+                    tmdb_id INTEGER NOT NULL,
+                    cluster INTEGER
+                )
+            """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS clustering (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    num_posters INTEGER NOT NULL
+                )
+            """
+            )
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.index_db, timeout=30)
+
+    def __len__(self) -> int:
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM posters").fetchone()[0]
+
+    def add(self, content_hash: str, tmdb_id: int) -> None:
+        """Index an image we have an embedding for as belonging to a film"""
+        row = self.store.get_row(content_hash)
+        if row is None:
+            return
+        cluster = None
+        centroids = self.load_centroids()
+        if centroids is not None:
+            vector = self.store.get_vectors(np.array([row]))[0]
+            cluster = int((centroids @ vector).argmax())
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO posters (row, tmdb_id, cluster) VALUES (?, ?, ?)",
+                (row, tmdb_id, cluster),
+            )
+        if self.needs_clustering():
+            with self.cluster_lock:
+                # Another thread may have re-clustered while we waited
+                if self.needs_clustering():
+                    self.cluster()
+
+    def needs_clustering(self) -> bool:
+        """Whether the index is big enough to cluster and has doubled in size
+        since it was last clustered"""
+        with self.connect() as conn:
+            num_posters, num_clustered = conn.execute(
+                "SELECT (SELECT COUNT(*) FROM posters), (SELECT num_posters FROM clustering)"
+            ).fetchone()
+        return num_posters >= MIN_CLUSTERED_SIZE and (
+            num_clustered is None or num_posters >= 2 * num_clustered
+        )
+
+    def load_centroids(self) -> np.ndarray | None:
+        with self.lock:
+            if self.centroids is None and self.centroids_path.exists():
+                self.centroids = np.load(self.centroids_path)
+            return self.centroids
+
+    def cluster(self) -> None:
+        """(Re)build the clusters from everything in the index"""
+        with self.connect() as conn:
+            rows = np.array([r for (r,) in conn.execute("SELECT row FROM posters")])
+        vectors = self.store.get_vectors(rows)
+        centroids = kmeans(vectors, int(np.sqrt(len(rows))))
+        clusters = (vectors @ centroids.T).argmax(axis=1)
+        # Write to a temporary file and rename, so the centroids on disk are
+        # always complete
+        tmp_path = self.centroids_path.with_suffix(".tmp.npy")
+        np.save(tmp_path, centroids)
+        tmp_path.replace(self.centroids_path)
+        with self.connect() as conn:
+            conn.executemany(
+                "UPDATE posters SET cluster = ? WHERE row = ?",
+                zip(clusters.tolist(), rows.tolist()),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO clustering (id, num_posters) VALUES (0, ?)",
+                (len(rows),),
+            )
+        with self.lock:
+            self.centroids = centroids
+            # The in-memory clusters are out of date
+            self.loaded_state = None
+
+    def load(self) -> None:
+        """Refresh the in-memory copy of the index if it's changed. Call with
+        self.lock held."""
+        with self.connect() as conn:
+            state = conn.execute(
+                "SELECT (SELECT COUNT(*) FROM posters), (SELECT num_posters FROM clustering)"
+            ).fetchone()
+            if state == self.loaded_state:
+                return
+            index = np.array(
+                conn.execute(
+                    "SELECT row, tmdb_id, IFNULL(cluster, -1) FROM posters"
+                ).fetchall(),
+                dtype=np.int64,
+            ).reshape(-1, 3)
+        self.centroids = (
+            np.load(self.centroids_path) if self.centroids_path.exists() else None
+        )
+        self.rows, self.tmdb_ids, self.clusters = index.T
+        self.loaded_state = state
+
+    def search(self, vector: np.ndarray, k: int = 5) -> list[tuple[float, int]]:
+        """The k films with the posters most similar to a (normalized) image
+        embedding, as (similarity, TMDB ID), most similar first"""
+        with self.lock:
+            self.load()
+            rows, tmdb_ids, clusters = self.rows, self.tmdb_ids, self.clusters
+            centroids = self.centroids
+        if centroids is not None:
+            nearest_clusters = np.argsort(centroids @ vector)[-NUM_PROBES:]
+            # Posters that haven't been clustered yet are always searched
+            candidates = np.isin(clusters, nearest_clusters) | (clusters == -1)
+            rows, tmdb_ids = rows[candidates], tmdb_ids[candidates]
+        similarities = self.store.get_vectors(rows) @ vector
+        best: dict[int, float] = {}
+        for i in np.argsort(similarities)[::-1]:
+            tmdb_id = int(tmdb_ids[i])
+            if tmdb_id not in best:
+                best[tmdb_id] = float(similarities[i])
+                if len(best) == k:
+                    break
+        return [(similarity, tmdb_id) for tmdb_id, similarity in best.items()]
@@ -0,0 +1,123 @@
+"""A pool of worker processes for rendering thumbnails.
+
+When `refresh` runs all the scrapers at once, they all want thumbnails at the
+same time. Doing that in the scraper threads means they all queue up behind
+the GIL and share one detector. Instead, each worker process loads its own
+detector and face cascade once, and the scraper threads submit jobs to the
+pool and wait for the results.
+"""
+
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from os import PathLike
+from pathlib import Path
+
+from PIL import Image
+from rich import print
+
+from cinescrapers import thumbnailing
+from cinescrapers.thumbnailing import ThumbnailVariant, render_thumbnail_variants
+
+# Most worker processes to start by default. Each one loads its own detector.
+MAX_THUMBNAIL_WORKERS = 4
+# Number of worker processes. 0 renders thumbnails in the calling thread.
+THUMBNAIL_WORKERS = int(
+    os.environ.get(
+        "CINESCRAPERS_THUMBNAIL_WORKERS",
+        min(os.cpu_count() or 1, MAX_THUMBNAIL_WORKERS),
+    )
+)
+
+# What a broken or enormous image, or a worker dying, gets us
+RENDER_ERRORS = (OSError, ValueError, Image.DecompressionBombError, BrokenProcessPool)
+
+_pool: concurrent.futures.ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+# Jobs that have been submitted but not finished, by thumbnail stem, so
+# showtimes that share a poster share a job
+_in_flight: dict[str, concurrent.futures.Future[dict[str, Path]]] = {}
+_in_flight_lock = threading.Lock()
+
+
+def init_worker() -> None:
+    """Load the models as soon as the worker starts, rather than in the middle
+    of the first job"""
+    # One thread per worker, otherwise N workers each try to use every core
+    os.environ["OMP_NUM_THREADS"] = "1"
+    thumbnailing.DETECTOR_THREADS = 1
+    thumbnailing.get_cv2().setNumThreads(1)
+    thumbnailing.get_detector()
+    thumbnailing.get_face_cascade()
+
+
+def get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            num_workers = THUMBNAIL_WORKERS
+            if (
+                thumbnailing.DETECTOR_BACKEND == "onnx"
+                and not thumbnailing.YOLO_ONNX_PATH.exists()
+            ):
+                # Every worker would import torch and load ultralytics instead
+                print(
+                    f"{thumbnailing.YOLO_ONNX_PATH.name} not found (run export-yolo-onnx), "
+                    "using one thumbnail worker"
+                )
+                num_workers = 1
+            # Don't fork, we're likely to be running in a thread pool
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+            )
+        return _pool
+
+
+def submit_thumbnail_job(
+    input_path: str | PathLike,
+    output_folder: Path,
+    stem: str,
+    variants: list[ThumbnailVariant] | None = None,
+) -> concurrent.futures.Future[dict[str, Path]]:
+    """Queue up rendering a source image's thumbnail variants. Safe to call
+    from any thread. If the thumbnail is already being rendered, returns that
+    job instead."""
+    if THUMBNAIL_WORKERS == 0:
+        future: concurrent.futures.Future[dict[str, Path]] = concurrent.futures.Future()
+        try:
+            future.set_result(
+                render_thumbnail_variants(input_path, output_folder, stem, variants)
+            )
+        except RENDER_ERRORS as e:
+            # Hand it back the same way the pool would
+            future.set_exception(e)
+        return future
+    with _in_flight_lock:
+        if stem in _in_flight:
+            return _in_flight[stem]
+        future = get_pool().submit(
+            render_thumbnail_variants, input_path, output_folder, stem, variants
+        )
+        _in_flight[stem] = future
+    # Outside the lock, as this runs straight away if the job's already done
+    future.add_done_callback(functools.partial(forget_job, stem))
+    return future
+
+
+def forget_job(stem: str, future: concurrent.futures.Future) -> None:
+    with _in_flight_lock:
+        if _in_flight.get(stem) is future:
+            del _in_flight[stem]
+
+
+def shutdown() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
@@ -1,9 +1,31 @@
 import functools
+import math
+import os
+import tempfile
+from io import BytesIO
 from os import PathLike
+from pathlib import Path
+from typing import Literal
 
-import cv2
 import numpy as np
 from PIL import Image
+from pydantic import BaseModel
+
+# Don't go below this quality when trying to squeeze a variant into its budget
+MIN_QUALITY = 40
+# YOLO letterboxes everything to this size, so there's no point giving it more
+DETECTOR_INPUT_SIZE = 640
+# YOLOv8's largest stride, inputs need to be a multiple of it
+DETECTOR_STRIDE = 32
+# Which object detector to use for finding crop centres: "onnx" or "ultralytics"
+DETECTOR_BACKEND = os.environ.get("CINESCRAPERS_DETECTOR", "onnx")
+YOLO_ONNX_PATH = Path(__file__).parent / "yolov8n.onnx"
+# Threads for ONNX Runtime to use per detection, 0 means one per core. The
+# thumbnail worker processes set this to 1 so they don't fight each other.
+DETECTOR_THREADS = 0
+# Same defaults as ultralytics' predict()
+DETECTOR_CONFIDENCE_THRESHOLD = 0.25
+DETECTOR_IOU_THRESHOLD = 0.7
 
 
 class ImageCentreNotFound(Exception):
@@ -12,25 +34,194 @@ class ImageCentreNotFound(Exception):
     pass
 
 
+class ThumbnailVariant(BaseModel):
+    """One size/format combination we render for each source image"""
+
+    name: str  # Appended to the thumbnail stem to make the filename
+    size: int
+    format: Literal["JPEG", "WEBP", "AVIF"] = "JPEG"
+    quality: int = 85
+    max_bytes: int | None = None  # Lower the quality until we fit in this
+
+    @property
+    def extension(self) -> str:
+        return {"JPEG": "jpg", "WEBP": "webp", "AVIF": "avif"}[self.format]
+
+    @property
+    def mimetype(self) -> str:
+        return f"image/{self.format.lower()}"
+
+    @property
+    def suffix(self) -> str:
+        """What's appended to the thumbnail stem, eg. "@2x.webp" """
+        return f"{self.name}.{self.extension}"
+
+    def filename(self, stem: str) -> str:
+        return f"{stem}{self.suffix}"
+
+
+# The first variant is the plain "<stem>.jpg" thumbnail that everything used
+# before we had variants, so keep it first.
+THUMBNAIL_VARIANTS = [
+    ThumbnailVariant(name="", size=150, format="JPEG", quality=85, max_bytes=15_000),
+    ThumbnailVariant(name="@2x", size=300, format="JPEG", quality=80, max_bytes=40_000),
+    ThumbnailVariant(name="", size=150, format="WEBP", quality=80, max_bytes=10_000),
+    ThumbnailVariant(name="@2x", size=300, format="WEBP", quality=75, max_bytes=25_000),
+]
+
+
+@functools.cache
+def format_supported(image_format: str) -> bool:
+    """Whether our Pillow build can write the given format (AVIF support
+    depends on how Pillow was built)"""
+    Image.init()
+    return image_format in Image.SAVE
+
+
+@functools.cache
+def get_cv2():
+    """OpenCV is slow to import and only needed for thumbnailing, so this is
+    the one place it gets imported"""
+    import cv2
+
+    return cv2
+
+
 @functools.lru_cache(maxsize=1)
 def get_face_cascade():
+    cv2 = get_cv2()
     haar_filename = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"  # type: ignore
     return cv2.CascadeClassifier(haar_filename)
 
 
+class UltralyticsDetector:
+    """YOLOv8n run through ultralytics / PyTorch"""
+
+    def __init__(self):
+        from ultralytics import YOLO
+
+        self.model = YOLO("yolov8n.pt")
+
+    def detect(self, pil_img: Image.Image) -> np.ndarray:
+        """Returns an (n, 4) array of x1, y1, x2, y2 boxes, most confident first"""
+        results = self.model(pil_img)
+        return results[0].boxes.xyxy.cpu().numpy()
+
+
+def letterbox(
+    pil_img: Image.Image, rect: bool = True
+) -> tuple[np.ndarray, float, int, int]:
+    """Resize and pad the image for YOLO, the same way ultralytics' LetterBox
+    does: to fit in the model's input size, then padded to a multiple of the
+    stride (rect) or to the full square. Returns the input tensor, the resize
+    ratio and the left/top padding."""
+    cv2 = get_cv2()
+    img = np.asarray(pil_img)
+    height, width = img.shape[:2]
+    ratio = min(DETECTOR_INPUT_SIZE / height, DETECTOR_INPUT_SIZE / width)
+    new_width, new_height = round(width * ratio), round(height * ratio)
+    if (new_width, new_height) != (width, height):
+        img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    pad_x = DETECTOR_INPUT_SIZE - new_width
+    pad_y = DETECTOR_INPUT_SIZE - new_height
+    if rect:
+        pad_x, pad_y = pad_x % DETECTOR_STRIDE, pad_y % DETECTOR_STRIDE
+    pad_x, pad_y = pad_x / 2, pad_y / 2
+    top, bottom = round(pad_y - 0.1), round(pad_y + 0.1)
+    left, right = round(pad_x - 0.1), round(pad_x + 0.1)
+    img = cv2.copyMakeBorder(
+        img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114)
+    )
+    tensor = img.transpose(2, 0, 1)[np.newaxis].astype(np.float32) / 255.0
+    return tensor, ratio, left, top
+
+
+class OnnxDetector:
+    """The same YOLOv8n model exported to ONNX and run with ONNX Runtime on the
+    CPU, which starts much faster than importing torch"""
+
+    def __init__(self, model_path: Path = YOLO_ONNX_PATH, num_threads: int = 0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            str(model_path), options, providers=["CPUExecutionProvider"]
+        )
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # Models exported with dynamic=True take any size input, so we can
+        # letterbox to a rectangle like ultralytics does rather than a square
+        self.rect = not all(isinstance(dim, int) for dim in model_input.shape[2:])
+
+    def detect(self, pil_img: Image.Image) -> np.ndarray:
+        """Returns an (n, 4) array of x1, y1, x2, y2 boxes, most confident first"""
+        cv2 = get_cv2()
+        tensor, ratio, left, top = letterbox(pil_img, self.rect)
+        (output,) = self.session.run(None, {self.input_name: tensor})
+        # Output is (1, 4 + num_classes, num_anchors), with boxes as cx, cy, w, h
+        predictions = output[0].T
+        class_scores = predictions[:, 4:]
+        class_ids = class_scores.argmax(axis=1)
+        confidences = class_scores[np.arange(len(class_ids)), class_ids]
+        keep = confidences > DETECTOR_CONFIDENCE_THRESHOLD
+        if not keep.any():
+            return np.zeros((0, 4), dtype=np.float32)
+        predictions, class_ids, confidences = (
+            predictions[keep],
+            class_ids[keep],
+            confidences[keep],
+        )
+        cx, cy, w, h = predictions[:, :4].T
+        xywh = np.stack([cx - w / 2, cy - h / 2, w, h], axis=1)
+        indices = cv2.dnn.NMSBoxesBatched(
+            xywh.tolist(),
+            confidences.tolist(),
+            class_ids.tolist(),
+            DETECTOR_CONFIDENCE_THRESHOLD,
+            DETECTOR_IOU_THRESHOLD,
+        )
+        indices = np.array(indices, dtype=int).flatten()
+        indices = indices[np.argsort(-confidences[indices], kind="stable")]
+        boxes = xywh[indices].copy()
+        boxes[:, 2:] += boxes[:, :2]
+        # Undo the letterboxing to get back to the input image's coordinates
+        boxes[:, [0, 2]] = (boxes[:, [0, 2]] - left) / ratio
+        boxes[:, [1, 3]] = (boxes[:, [1, 3]] - top) / ratio
+        width, height = pil_img.size
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+        return boxes
+
+
 @functools.lru_cache(maxsize=1)
-def get_yolo_model():
+def get_detector(backend: str = DETECTOR_BACKEND) -> UltralyticsDetector | OnnxDetector:
+    if backend == "onnx":
+        if YOLO_ONNX_PATH.exists():
+            return OnnxDetector(num_threads=DETECTOR_THREADS)
+        print(
+            f"{YOLO_ONNX_PATH.name} not found (run export-yolo-onnx), falling back to ultralytics"
+        )
+    elif backend != "ultralytics":
+        raise ValueError(f"Unknown detector backend '{backend}'")
+    return UltralyticsDetector()
+
+
+def export_yolo_onnx() -> Path:
+    """Export the ultralytics YOLOv8n model to ONNX for the onnx backend"""
     from ultralytics import YOLO
 
-    return YOLO("yolov8n.pt")
+    exported = YOLO("yolov8n.pt").export(
+        format="onnx", imgsz=DETECTOR_INPUT_SIZE, dynamic=True
+    )
+    Path(exported).replace(YOLO_ONNX_PATH)
+    return YOLO_ONNX_PATH
 
 
 def get_yolo_centre(pil_img: Image.Image) -> tuple[int, int]:
     """Look for a good image centre to use when cropping the image to a square,
     using YOLO model"""
-    yolo_model = get_yolo_model()
-    results = yolo_model(pil_img)
-    boxes = results[0].boxes.xyxy.cpu().numpy()
+    boxes = get_detector().detect(pil_img)
     print(f"Found {len(boxes)} boxes with YOLO")
     if len(boxes) > 0:
         # Just use the first box, which is expected to have the highest confidence
@@ -44,6 +235,7 @@ def get_yolo_centre(pil_img: Image.Image) -> tuple[int, int]:
 def get_facial_centre(cv_img) -> tuple[int, int]:
     """Look for a good image centre to use when cropping the image to a square,
     using OpenCV Face detection"""
+    cv2 = get_cv2()
     face_cascade = get_face_cascade()
     gray = cv2.cvtColor(cv_img, cv2.COLOR_BGR2GRAY)
     faces = face_cascade.detectMultiScale(gray, 1.3, 5)
@@ -55,27 +247,62 @@ def get_facial_centre(cv_img) -> tuple[int, int]:
     raise ImageCentreNotFound()
 
 
-def smart_square_thumbnail(
-    input_path: str | PathLike, output_path: str | PathLike, size: int
-):
-    """Try to create a sensibly cropped square thumbnail from an image"""
-    pil_img = Image.open(input_path).convert("RGB")
-    cv_img = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
-    height, width = cv_img.shape[:2]
+def load_working_image(input_path: str | PathLike, min_size: int) -> Image.Image:
+    """Decode the image at the lowest resolution that still has a short side
+    of at least min_size (so we can crop a min_size thumbnail) and a long side
+    of at least DETECTOR_INPUT_SIZE. JPEGs are decoded straight to the reduced
+    scale using draft mode, other formats get a cheap integer reduce()."""
+    img = Image.open(input_path)
+    width, height = img.size
+    scale = max(min_size / min(width, height), DETECTOR_INPUT_SIZE / max(width, height))
+    if scale < 1:
+        img.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    factor = min(min(img.size) // min_size, max(img.size) // DETECTOR_INPUT_SIZE)
+    if factor >= 2:
+        img = img.reduce(factor)
+    return img
+
+
+def get_detection_image(pil_img: Image.Image) -> tuple[Image.Image, float]:
+    """Shrink the image to the detector's input size. Returns the image and
+    the scale factor applied, for mapping coordinates back."""
+    scale = DETECTOR_INPUT_SIZE / max(pil_img.size)
+    if scale >= 1:
+        return pil_img, 1.0
+    width, height = pil_img.size
+    det_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return pil_img.resize(det_size, Image.BILINEAR, reducing_gap=2.0), scale  # type: ignore
+
+
+def get_crop_box(pil_img: Image.Image) -> tuple[tuple[int, int, int, int], str]:
+    """Work out the largest square crop of the image, centred on whatever
+    looks most interesting"""
+    width, height = pil_img.size
+    det_img, scale = get_detection_image(pil_img)
 
     try:
-        cx, cy = get_yolo_centre(pil_img)
+        cx, cy = get_yolo_centre(det_img)
         method = "yolo"
     except ImageCentreNotFound:
         try:
             # It seems like this rarely gets a result where yolo fails.
+            cv2 = get_cv2()
+            cv_img = cv2.cvtColor(np.array(det_img), cv2.COLOR_RGB2BGR)
             cx, cy = get_facial_centre(cv_img)
             method = "facial"
         except ImageCentreNotFound:
-            # Fallback to image centre
-            cx, cy = width // 2, height // 2
+            cx, cy = None, None
             method = "centre"
 
+    if cx is None or cy is None:
+        # Fallback to image centre
+        cx, cy = width // 2, height // 2
+    else:
+        # Map the detected centre back to the working image's coordinates
+        cx, cy = int(cx / scale), int(cy / scale)
+
     # Calculate square crop size (largest possible square that fits in the image)
     crop_size = min(width, height)
     half = crop_size // 2
@@ -84,13 +311,72 @@ def smart_square_thumbnail(
     cx = max(half, min(width - half, cx))
     cy = max(half, min(height - half, cy))
 
-    # Now crop the square
-    left = cx - half
-    top = cy - half
-    right = cx + half
-    bottom = cy + half
+    return (cx - half, cy - half, cx + half, cy + half), method
+
+
+def encode_variant(img: Image.Image, variant: ThumbnailVariant) -> bytes:
+    """Encode an already-resized image, stepping the quality down until it
+    fits the variant's size budget (or we hit MIN_QUALITY)"""
+    quality = variant.quality
+    while True:
+        buffer = BytesIO()
+        img.save(buffer, format=variant.format, quality=quality, optimize=True)
+        data = buffer.getvalue()
+        if variant.max_bytes is None or len(data) <= variant.max_bytes:
+            return data
+        if quality <= MIN_QUALITY:
+            print(
+                f"Couldn't get {variant.filename('thumbnail')} under {variant.max_bytes} bytes ({len(data)})"
+            )
+            return data
+        quality = max(MIN_QUALITY, quality - 10)
+
+
+def render_thumbnail_variants(
+    input_path: str | PathLike,
+    output_folder: Path,
+    stem: str,
+    variants: list[ThumbnailVariant] | None = None,
+) -> dict[str, Path]:
+    """Decode the image and find the crop once, then write each of the
+    variants. Returns the paths written, keyed by filename."""
+    if variants is None:
+        variants = THUMBNAIL_VARIANTS
+    pil_img = load_working_image(input_path, max(v.size for v in variants))
+    crop_box, method = get_crop_box(pil_img)
+    cropped = pil_img.crop(crop_box)
+
+    resized: dict[int, Image.Image] = {}
+    written = {}
+    for variant in variants:
+        if not format_supported(variant.format):
+            print(f"Skipping {variant.format} thumbnail, not supported by Pillow")
+            continue
+        if variant.size not in resized:
+            resized[variant.size] = cropped.resize(
+                (variant.size, variant.size),
+                Image.LANCZOS,  # type: ignore
+            )
+        output_path = output_folder / variant.filename(stem)
+        # Write to a temporary file and rename, so nothing reading or
+        # uploading the thumbnails sees half a file
+        fd, tmp_name = tempfile.mkstemp(dir=output_folder, prefix=stem, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(encode_variant(resized[variant.size], variant))
+        Path(tmp_name).replace(output_path)
+        written[output_path.name] = output_path
 
-    cropped = pil_img.crop((left, top, right, bottom))
+    print(f"Saved {len(written)} thumbnail variants for {stem} ({method})")
+    return written
+
+
+def smart_square_thumbnail(
+    input_path: str | PathLike, output_path: str | PathLike, size: int
+):
+    """Try to create a sensibly cropped square thumbnail from an image"""
+    pil_img = load_working_image(input_path, size)
+    crop_box, method = get_crop_box(pil_img)
+    cropped = pil_img.crop(crop_box)
     cropped = cropped.resize((size, size), Image.LANCZOS)  # type: ignore
     cropped.save(output_path)
 
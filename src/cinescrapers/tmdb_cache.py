@@ -0,0 +1,133 @@
+"""Persistent cache of TMDB API responses.
+
+The same films turn up week after week, so most of the searches grab_tmdb_ids
+does are ones we've done before. Responses are kept in sqlite, keyed on the
+endpoint and (normalized) params, and are reused until they're older than the
+TTL for their endpoint.
+"""
+
+import datetime
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from cinescrapers.utils import get_hashed
+
+TMDB_CACHE_DB = Path(__file__).parent / "tmdb_cache.db"
+# How long responses stay fresh, by endpoint group (see get_endpoint_group)
+TMDB_CACHE_TTLS = {
+    "search/movie": datetime.timedelta(days=7),
+    "movie": datetime.timedelta(days=30),
+}
+TMDB_CACHE_DEFAULT_TTL = datetime.timedelta(days=1)
+
+
+def get_endpoint_group(endpoint: str) -> str:
+    """ "search/movie" -> "search/movie", "movie/123" -> "movie" """
+    endpoint = endpoint.strip("/")
+    if endpoint.startswith("search/"):
+        return endpoint
+    return endpoint.split("/")[0]
+
+
+def normalize_params(params: dict) -> dict[str, str]:
+    """Drop the API key and tidy up values so that trivially different
+    requests share a cache entry"""
+    normalized = {}
+    for key, value in params.items():
+        if key == "api_key" or value is None:
+            continue
+        value = " ".join(str(value).split())
+        if key == "query":
+            value = value.casefold()
+        normalized[key] = value
+    return dict(sorted(normalized.items()))
+
+
+class TMDBResponseCache:
+    def __init__(self, path: Path = TMDB_CACHE_DB):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    endpoint_group TEXT NOT NULL,
+                    endpoint TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    fetched_at REAL NOT NULL
+                )
+            """
+            )
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_key(self, endpoint: str, params: dict) -> str:
+        normalized = json.dumps([endpoint.strip("/"), normalize_params(params)])
+        return get_hashed(normalized)
+
+    def get(
+        self, endpoint: str, params: dict, allow_stale: bool = False
+    ) -> dict | None:
+        """Get a cached response, or None if we don't have a fresh one"""
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT response, fetched_at FROM responses WHERE key = ?",
+                (self.get_key(endpoint, params),),
+            ).fetchone()
+        ttl = TMDB_CACHE_TTLS.get(get_endpoint_group(endpoint), TMDB_CACHE_DEFAULT_TTL)
+        fresh = row is not None and (
+            allow_stale or time.time() - row[1] < ttl.total_seconds()
+        )
+        with self.lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return json.loads(row[0]) if fresh else None
+
+    def set(self, endpoint: str, params: dict, response: dict) -> None:
+        with self.connect() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO responses (key, endpoint_group, endpoint, params, response, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """,
+                (
+                    self.get_key(endpoint, params),
+                    get_endpoint_group(endpoint),
+                    endpoint.strip("/"),
+                    json.dumps(normalize_params(params)),
+                    json.dumps(response),
+                    time.time(),
+                ),
+            )
+
+    def get_hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get_summary(self) -> list[tuple[str, int, int]]:
+        """(endpoint group, number of entries, number expired) for everything
+        in the cache"""
+        now = time.time()
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT endpoint_group, fetched_at FROM responses"
+            ).fetchall()
+        counts: dict[str, list[int]] = {}
+        for group, fetched_at in rows:
+            ttl = TMDB_CACHE_TTLS.get(group, TMDB_CACHE_DEFAULT_TTL)
+            entry = counts.setdefault(group, [0, 0])
+            entry[0] += 1
+            if now - fetched_at >= ttl.total_seconds():
+                entry[1] += 1
+        return [(group, n, expired) for group, (n, expired) in sorted(counts.items())]
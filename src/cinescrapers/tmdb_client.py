@@ -0,0 +1,166 @@
+"""A shared client for the TMDB API.
+
+All requests go through one keep-alive session and a token bucket rate
+limiter, so lots of threads can search TMDB at once without tripping its rate
+limits. If we get a 429 anyway, we wait as long as TMDB asks and try again.
+"""
+
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from rich import print
+
+from cinescrapers.exceptions import TMDBCacheMiss, TMDBNotFound
+from cinescrapers.tmdb_cache import TMDBResponseCache
+
+TMDB_BASE_URL = "https://api.themoviedb.org/3"
+# TMDB's limit is "around 50 requests per second", so stay a bit under that
+TMDB_REQUESTS_PER_SECOND = 40
+TMDB_BURST = 20
+# How many films grab_tmdb_ids matches at once
+TMDB_MAX_CONCURRENCY = 8
+TMDB_MAX_RETRIES = 5
+TMDB_TIMEOUT = 10
+# What's cached for a 404, so we don't keep asking for things that are gone
+TMDB_NOT_FOUND = {"not_found": True}
+
+
+class TokenBucket:
+    """Thread-safe token bucket: allows `rate` acquisitions per second on
+    average, and bursts of up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take a token, waiting for one if necessary"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for a while (eg. when we've been told to
+        back off)"""
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class TMDBClient:
+    def __init__(
+        self,
+        api_key: str,
+        requests_per_second: float = TMDB_REQUESTS_PER_SECOND,
+        burst: int = TMDB_BURST,
+        cache: TMDBResponseCache | None = None,
+        offline: bool = False,
+    ):
+        self.api_key = api_key
+        self.cache = cache
+        # Only serve responses from the cache, never hit the network
+        self.offline = offline
+        self.limiter = TokenBucket(requests_per_second, burst)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=TMDB_MAX_CONCURRENCY * 2)
+        self.session.mount("https://", adapter)
+
+    def get(self, endpoint: str, params: dict | None = None) -> dict:
+        """GET an API endpoint (eg. "search/movie") and return the JSON
+        response, retrying on rate limiting and server errors. Responses,
+        including not found ones, are cached if we have a cache."""
+        params = params or {}
+        if self.cache is not None:
+            cached = self.cache.get(endpoint, params, allow_stale=self.offline)
+            if cached == TMDB_NOT_FOUND:
+                raise TMDBNotFound(endpoint)
+            if cached is not None:
+                return cached
+        if self.offline:
+            raise TMDBCacheMiss(f"{endpoint} {params}")
+        try:
+            response_data = self.fetch(endpoint, params)
+        except TMDBNotFound:
+            if self.cache is not None:
+                self.cache.set(endpoint, params, TMDB_NOT_FOUND)
+            raise
+        if self.cache is not None:
+            self.cache.set(endpoint, params, response_data)
+        return response_data
+
+    def fetch(self, endpoint: str, params: dict) -> dict:
+        url = f"{TMDB_BASE_URL}/{endpoint}"
+        params = {"api_key": self.api_key, **params}
+        for attempt in range(TMDB_MAX_RETRIES):
+            self.limiter.acquire()
+            try:
+                response = self.session.get(url, params=params, timeout=TMDB_TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == TMDB_MAX_RETRIES - 1:
+                    raise
+                time.sleep(2**attempt)
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                if attempt == TMDB_MAX_RETRIES - 1:
+                    break
+                retry_after = response.headers.get("retry-after", "")
+                wait = float(retry_after) if retry_after.isdigit() else 2**attempt
+                print(f"TMDB returned {response.status_code}, waiting {wait}s")
+                # Makes every thread wait, not just this one
+                self.limiter.pause(wait)
+                continue
+            break
+        if response.status_code == 404:
+            raise TMDBNotFound(endpoint)
+        response.raise_for_status()
+        return response.json()
+
+    def get_image(self, url: str) -> bytes:
+        """Download an image (these come from TMDB's CDN, which isn't rate
+        limited, but we may as well reuse the connections)"""
+        if self.offline:
+            # Images we already have are on disk, so we'd only be asked for
+            # ones we haven't got
+            raise TMDBCacheMiss(url)
+        response = self.session.get(url, timeout=TMDB_TIMEOUT)
+        response.raise_for_status()
+        return response.content
+
+
+_tmdb_client: TMDBClient | None = None
+_tmdb_client_lock = threading.Lock()
+
+
+def get_tmdb_client(offline: bool = False) -> TMDBClient:
+    """The TMDB client everything shares. Once it's been asked for offline
+    (or CINESCRAPERS_TMDB_OFFLINE=1 is set), it stays offline."""
+    global _tmdb_client
+    offline = offline or os.environ.get("CINESCRAPERS_TMDB_OFFLINE") == "1"
+    with _tmdb_client_lock:
+        if _tmdb_client is None:
+            # We don't need an API key if we're only using the cache
+            api_key = (
+                os.environ.get("TMDB_API_KEY", "")
+                if offline
+                else os.environ["TMDB_API_KEY"]
+            )
+            _tmdb_client = TMDBClient(
+                api_key, cache=TMDBResponseCache(), offline=offline
+            )
+        elif offline:
+            _tmdb_client.offline = True
+        return _tmdb_client
@@ -0,0 +1,153 @@
+"""The TMDB IDs we've matched films (by movie key) to.
+
+This outlives the showtimes themselves, so a film that comes back to a
+cinema, or that a fresh showtimes.db is scraped for, doesn't need matching
+again. It used to be a JSON file, which was rewritten in full every 100
+matches; import_json_cache() brings one of those in.
+
+We also keep track of the films we couldn't match (live events, shorts
+programmes, quizzes...), so we don't search for them again on every run. They
+get retried after an exponentially increasing delay. A film whose description
+or image changes gets a new movie key, so is retried straight away.
+"""
+
+import datetime
+import json
+import sqlite3
+from pathlib import Path
+
+TMDB_ID_CACHE_DB = Path(__file__).parent / "tmdb_id_cache.db"
+LEGACY_TMDB_ID_CACHE = Path(__file__).parent / "tmdb_id_cache.json"
+# SQLite limits how many parameters a query can have
+LOOKUP_CHUNK_SIZE = 500
+# How long to wait before retrying a film we couldn't match, doubling after
+# each failed attempt up to the maximum
+NO_MATCH_RETRY_DELAY = datetime.timedelta(days=1)
+NO_MATCH_MAX_RETRY_DELAY = datetime.timedelta(days=64)
+
+
+def get_tmdb_id_cache_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(TMDB_ID_CACHE_DB, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tmdb_ids (
+            movie_key TEXT PRIMARY KEY,
+            tmdb_id INTEGER NOT NULL,
+            updated TEXT NOT NULL
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS no_matches (
+            movie_key TEXT PRIMARY KEY,
+            attempts INTEGER NOT NULL,
+            last_attempt TEXT NOT NULL
+        )
+    """
+    )
+    return conn
+
+
+def get_chunks(movie_keys: list[str]):
+    for i in range(0, len(movie_keys), LOOKUP_CHUNK_SIZE):
+        yield movie_keys[i : i + LOOKUP_CHUNK_SIZE]
+
+
+def get_cached_tmdb_ids(movie_keys: list[str]) -> dict[str, int]:
+    """The cached TMDB IDs for whichever of movie_keys we have them for"""
+    tmdb_ids = {}
+    with get_tmdb_id_cache_connection() as conn:
+        for chunk in get_chunks(movie_keys):
+            placeholders = ", ".join("?" * len(chunk))
+            tmdb_ids.update(
+                conn.execute(
+                    f"SELECT movie_key, tmdb_id FROM tmdb_ids WHERE movie_key IN ({placeholders})",
+                    chunk,
+                )
+            )
+    return tmdb_ids
+
+
+def cache_tmdb_ids(tmdb_ids: dict[str, int]) -> None:
+    """Save (or replace) TMDB IDs for some movie keys, and forget any failed
+    attempts to match them"""
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    with get_tmdb_id_cache_connection() as conn:
+        conn.executemany(
+            """
+            INSERT INTO tmdb_ids (movie_key, tmdb_id, updated) VALUES (?, ?, ?)
+            ON CONFLICT(movie_key) DO UPDATE SET
+                tmdb_id = excluded.tmdb_id,
+                updated = excluded.updated
+        """,
+            [(movie_key, tmdb_id, now) for movie_key, tmdb_id in tmdb_ids.items()],
+        )
+        conn.executemany(
+            "DELETE FROM no_matches WHERE movie_key = ?",
+            [(movie_key,) for movie_key in tmdb_ids],
+        )
+
+
+def record_no_match(movie_key: str) -> None:
+    """Note that we couldn't find a TMDB match for a movie key"""
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    with get_tmdb_id_cache_connection() as conn:
+        conn.execute(
+            """
+            INSERT INTO no_matches (movie_key, attempts, last_attempt) VALUES (?, 1, ?)
+            ON CONFLICT(movie_key) DO UPDATE SET
+                attempts = attempts + 1,
+                last_attempt = excluded.last_attempt
+        """,
+            (movie_key, now),
+        )
+
+
+def get_retry_delay(attempts: int) -> datetime.timedelta:
+    # Cap the exponent so a film that's failed hundreds of times doesn't
+    # overflow the timedelta
+    delay = NO_MATCH_RETRY_DELAY * 2 ** min(attempts - 1, 20)
+    return min(delay, NO_MATCH_MAX_RETRY_DELAY)
+
+
+def get_backed_off_movie_keys(
+    movie_keys: list[str], now: datetime.datetime | None = None
+) -> set[str]:
+    """Which of movie_keys we've failed to match recently enough that we
+    shouldn't try again yet"""
+    now = now or datetime.datetime.now()
+    backed_off = set()
+    with get_tmdb_id_cache_connection() as conn:
+        for chunk in get_chunks(movie_keys):
+            placeholders = ", ".join("?" * len(chunk))
+            for movie_key, attempts, last_attempt in conn.execute(
+                f"SELECT movie_key, attempts, last_attempt FROM no_matches WHERE movie_key IN ({placeholders})",
+                chunk,
+            ):
+                retry_at = datetime.datetime.fromisoformat(
+                    last_attempt
+                ) + get_retry_delay(attempts)
+                if now < retry_at:
+                    backed_off.add(movie_key)
+    return backed_off
+
+
+def count_cached_tmdb_ids() -> int:
+    with get_tmdb_id_cache_connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM tmdb_ids").fetchone()[0]
+
+
+def import_json_cache(json_path: Path = LEGACY_TMDB_ID_CACHE) -> int:
+    """Import an old JSON cache of movie key -> TMDB ID. Anything we've
+    matched since takes precedence. Returns how many IDs were imported."""
+    tmdb_ids = json.loads(json_path.read_text())
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    with get_tmdb_id_cache_connection() as conn:
+        before = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO tmdb_ids (movie_key, tmdb_id, updated) VALUES (?, ?, ?)",
+            [(movie_key, tmdb_id, now) for movie_key, tmdb_id in tmdb_ids.items()],
+        )
+        return conn.total_changes - before
@@ -0,0 +1,95 @@
+"""A local index of every film on TMDB, by normalized title.
+
+TMDB publishes a daily export of all its movie IDs and original titles
+(https://developer.themoviedb.org/docs/daily-id-exports), a gzipped file with
+one JSON object per line. Importing it lets us find the films with exactly a
+showtime's title without using the search API.
+"""
+
+import gzip
+import json
+import sqlite3
+from pathlib import Path
+
+from rich import print
+
+from cinescrapers.title_normalization import normalize_title
+
+TMDB_TITLE_INDEX_DB = Path(__file__).parent / "tmdb_titles.db"
+IMPORT_BATCH_SIZE = 10_000
+
+
+def get_title_index_connection() -> sqlite3.Connection:
+    return sqlite3.connect(TMDB_TITLE_INDEX_DB, timeout=30)
+
+
+def import_tmdb_id_export(export_path: Path) -> int:
+    """Replace the index with the films in a daily ID export file. Returns
+    how many films were imported."""
+    num_imported = 0
+    with get_title_index_connection() as conn:
+        # Build the new index alongside the old one, so lookups keep working
+        # until it's ready
+        conn.execute("DROP TABLE IF EXISTS tmdb_titles_new")
+        conn.execute(
+            """
+            CREATE TABLE tmdb_titles_new (
+                id INTEGER PRIMARY KEY,
+                original_title TEXT NOT NULL,
+                norm_title TEXT NOT NULL,
+                popularity REAL NOT NULL
+            )
+        """
+        )
+        batch = []
+        with gzip.open(export_path, "rt", encoding="utf-8") as f:
+            for line in f:
+                film = json.loads(line)
+                if film.get("adult") or film.get("video"):
+                    continue
+                try:
+                    norm_title = normalize_title(film["original_title"])
+                except AssertionError:
+                    # Titles that are all punctuation normalize to nothing
+                    continue
+                batch.append(
+                    (
+                        film["id"],
+                        film["original_title"],
+                        norm_title,
+                        film.get("popularity") or 0.0,
+                    )
+                )
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO tmdb_titles_new VALUES (?, ?, ?, ?)",
+                        batch,
+                    )
+                    num_imported += len(batch)
+                    print(f"Imported {num_imported} films")
+                    batch.clear()
+        conn.executemany(
+            "INSERT OR REPLACE INTO tmdb_titles_new VALUES (?, ?, ?, ?)", batch
+        )
+        num_imported += len(batch)
+        conn.execute("DROP TABLE IF EXISTS tmdb_titles")
+        conn.execute("ALTER TABLE tmdb_titles_new RENAME TO tmdb_titles")
+        conn.execute("CREATE INDEX tmdb_titles_norm_title ON tmdb_titles (norm_title)")
+    return num_imported
+
+
+def find_films_by_title(norm_title: str) -> list[int] | None:
+    """The IDs of films whose original title normalizes to norm_title, most
+    popular first. None if we don't have an index."""
+    if not TMDB_TITLE_INDEX_DB.exists():
+        return None
+    with get_title_index_connection() as conn:
+        try:
+            rows = conn.execute(
+                "SELECT id FROM tmdb_titles WHERE norm_title = ? ORDER BY popularity DESC",
+                (norm_title,),
+            ).fetchall()
+        except sqlite3.OperationalError:
+            # Nothing's been imported yet
+            return None
+    return [row[0] for row in rows]
@@ -5,6 +5,9 @@ import boto3
 from pathlib import Path
 from botocore.client import Config
 
+# Not all Python versions know about AVIF yet
+mimetypes.add_type("image/avif", ".avif")
+
 
 def get_s3_client():
     access_key = os.environ["R2_ACCESS_KEY_ID"]
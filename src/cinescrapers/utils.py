@@ -3,8 +3,6 @@ import datetime
 import hashlib
 import re
 
-import dateparser
-
 # Regular expression matching 1900-1999 or 2000-2029
 RELEASE_YEAR_RE = re.compile(r"\b((19\d{2})|(20[0-2]\d))\b")
 
@@ -16,6 +14,9 @@ class DateParsingError(Exception):
 def parse_date_without_year(date_str: str) -> datetime.datetime:
     """If eg. date_str eg. "February 12th" and it's now October, assume the
     date is next year"""
+    # dateparser is slow to import, and most things that use this module don't need it
+    import dateparser
+
     now = datetime.datetime.now()
     date = dateparser.parse(date_str)
     if date is None:
@@ -48,6 +49,14 @@ def extract_uk_postcode(text: str) -> str | None:
 
 
 def get_hashed(s: str) -> str:
-    digest = hashlib.sha256(s.encode("utf-8")).digest()
+    return get_hashed_bytes(s.encode("utf-8"))
+
+
+def get_hashed_bytes(b: bytes) -> str:
+    return format_digest(hashlib.sha256(b).digest())
+
+
+def format_digest(digest: bytes) -> str:
+    """Turn a sha256 digest into the string form get_hashed() returns"""
     b64 = base64.urlsafe_b64encode(digest).decode("utf-8").rstrip("=")
     return b64[:32]  # Truncate to sensible length
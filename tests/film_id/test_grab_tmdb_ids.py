@@ -0,0 +1,78 @@
+import sqlite3
+
+import pytest
+import requests
+from click.testing import CliRunner
+
+from cinescrapers import film_identification, tmdb_client, tmdb_id_cache
+from cinescrapers.__main__ import cli, ensure_showtimes_table_exists
+from cinescrapers.tmdb_cache import TMDBResponseCache
+from cinescrapers.tmdb_client import TMDBClient, get_tmdb_client
+
+
+@pytest.fixture
+def showtimes_db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(tmdb_id_cache, "TMDB_ID_CACHE_DB", tmp_path / "tmdb_ids.db")
+    ensure_showtimes_table_exists()
+    with sqlite3.connect("showtimes.db") as conn:
+        conn.executemany(
+            "INSERT INTO showtimes (id, cinema_shortcode, title, norm_title, datetime, link, description, last_updated, scraper, movie_key) VALUES (?, 'ica', ?, ?, '2025-01-01 18:00', '', '', '2025-01-01', 'ica', ?)",
+            [
+                ("1", "Vertigo", "VERTIGO", "vertigo"),
+                ("2", "Heat", "HEAT", "heat"),
+            ],
+        )
+
+
+def test_one_film_failing_doesnt_stop_the_rest(showtimes_db, monkeypatch):
+    monkeypatch.setattr(
+        tmdb_client, "get_tmdb_client", lambda offline=False: TMDBClient("key")
+    )
+
+    def fake_get_tmdb_candidates(showtime, images_cache, title_index=None):
+        if showtime.norm_title == "HEAT":
+            raise requests.HTTPError("503 Server Error")
+        return [
+            {
+                "id": 426,
+                "title": "Vertigo",
+                "release_date": "1958-05-09",
+                "overview_similarity": 0.8,
+                "image_similarity": 0.9,
+                "similarity_score": 1.7,
+            }
+        ]
+
+    monkeypatch.setattr(
+        film_identification, "get_tmdb_candidates", fake_get_tmdb_candidates
+    )
+    result = CliRunner().invoke(cli, ["grab_tmdb_ids"])
+    assert result.exit_code == 0, result.output
+    assert "Failed to match HEAT" in result.output
+    with sqlite3.connect("showtimes.db") as conn:
+        tmdb_ids = dict(conn.execute("SELECT id, tmdb_id FROM showtimes"))
+    assert tmdb_ids == {"1": 426, "2": None}
+
+
+def test_offline_without_api_key(showtimes_db, tmp_path, monkeypatch):
+    monkeypatch.delenv("TMDB_API_KEY", raising=False)
+    monkeypatch.delenv("CINESCRAPERS_TMDB_OFFLINE", raising=False)
+    monkeypatch.setattr(tmdb_client, "_tmdb_client", None)
+    monkeypatch.setattr(
+        tmdb_client, "TMDBResponseCache", lambda: TMDBResponseCache(tmp_path / "c.db")
+    )
+
+    def fake_get_tmdb_candidates(showtime, images_cache, title_index=None):
+        # Nothing's cached
+        get_tmdb_client().get("search/movie", {"query": showtime.norm_title})
+
+    monkeypatch.setattr(
+        film_identification, "get_tmdb_candidates", fake_get_tmdb_candidates
+    )
+    result = CliRunner().invoke(cli, ["grab_tmdb_ids", "--offline"])
+    assert result.exit_code == 0, result.output
+    assert "Skipping HEAT, not in the TMDB cache" in result.output
+    assert get_tmdb_client().offline
+    # Films we couldn't look up haven't been given up on
+    assert tmdb_id_cache.get_backed_off_movie_keys(["heat", "vertigo"]) == set()
@@ -0,0 +1,223 @@
+"""Do the int8 models match films the same as the float32 ones?
+
+Run with `pytest -s` to see the numbers. Offline, the test showtimes stand in
+for TMDB: a film listed at several cinemas should be matched to its listing at
+another cinema, from the similarities of the descriptions and images, scored
+the same way as TMDB candidates. Both backends should pick the same films with
+nearly the same scores, and the similarities between all the descriptions and
+all the images should barely move.
+
+With TMDB access (TMDB_API_KEY, or CINESCRAPERS_TMDB_OFFLINE=1 and a TMDB
+cache from an earlier run), each backend also runs the real film
+identification on the test showtimes, in its own process as the backend is
+picked when film_identification is imported.
+"""
+
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+from PIL import Image
+
+from cinescrapers.film_identification import get_clip_embeddings, get_similarity_model
+from cinescrapers.image_store import find_source_image
+from cinescrapers.match_scoring import get_match_score
+
+TESTDATA_ROOT = Path(__file__).parent / "test_data"
+DB_PATH = TESTDATA_ROOT / "showtimes.db"
+IMAGES_CACHE = TESTDATA_ROOT / "source_images"
+NUM_SAMPLES = 50
+# The most any similarity or best match's score may move by, and the least
+# proportion of nearest neighbours and picked films that must stay the same
+MAX_SIMILARITY_ERROR = 0.05
+MAX_SCORE_ERROR = 0.05
+MIN_NEIGHBOUR_AGREEMENT = 0.9
+MIN_PICK_AGREEMENT = 0.95
+
+
+@pytest.fixture(scope="module")
+def listings() -> list[dict]:
+    """A listing per cinema of each film that's showing at more than one"""
+    with sqlite3.connect(DB_PATH) as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(
+            """
+            SELECT norm_title, cinema_shortcode, MIN(description) AS description,
+                MIN(thumbnail) AS thumbnail
+            FROM showtimes
+            WHERE description != '' AND thumbnail IS NOT NULL
+            GROUP BY norm_title, cinema_shortcode
+            """
+        ).fetchall()
+    listings = [
+        {**row, "image": find_source_image(IMAGES_CACHE, row["thumbnail"])}
+        for row in rows
+    ]
+    listings = [listing for listing in listings if listing["image"] is not None]
+    num_cinemas: dict[str, int] = {}
+    for listing in listings:
+        num_cinemas[listing["norm_title"]] = (
+            num_cinemas.get(listing["norm_title"], 0) + 1
+        )
+    return [listing for listing in listings if num_cinemas[listing["norm_title"]] > 1]
+
+
+@pytest.fixture(scope="module")
+def embeddings(listings) -> dict[str, tuple[torch.Tensor, torch.Tensor]]:
+    """Backend -> (description embeddings, image embeddings) for the listings"""
+    texts = [listing["description"] for listing in listings]
+    images = [Image.open(listing["image"]) for listing in listings]
+    return {
+        backend: (
+            torch.nn.functional.normalize(
+                get_similarity_model(backend).encode(
+                    texts, convert_to_tensor=True, device="cpu"
+                ),
+                dim=-1,
+            ),
+            get_clip_embeddings(images, backend).float().cpu(),
+        )
+        for backend in ("float32", "int8")
+    }
+
+
+def compare_embeddings(name: str, float32: torch.Tensor, int8: torch.Tensor) -> None:
+    float32_similarities = float32 @ float32.T
+    int8_similarities = int8 @ int8.T
+    error = (float32_similarities - int8_similarities).abs()
+    # Nearest neighbour other than itself
+    float32_similarities.fill_diagonal_(-1)
+    int8_similarities.fill_diagonal_(-1)
+    agreement = (
+        (float32_similarities.argmax(dim=1) == int8_similarities.argmax(dim=1))
+        .float()
+        .mean()
+        .item()
+    )
+    print(
+        f"{name}: mean similarity error {error.mean():.4f}, max {error.max():.4f}, "
+        f"nearest neighbour agreement {agreement * 100:.1f}%"
+    )
+    assert error.max() < MAX_SIMILARITY_ERROR
+    assert agreement >= MIN_NEIGHBOUR_AGREEMENT
+
+
+def test_int8_text_embeddings(embeddings):
+    compare_embeddings("Text", embeddings["float32"][0], embeddings["int8"][0])
+
+
+def test_int8_image_embeddings(embeddings):
+    compare_embeddings("Image", embeddings["float32"][1], embeddings["int8"][1])
+
+
+def get_best_matches(
+    listings: list[dict], text: torch.Tensor, image: torch.Tensor
+) -> list[tuple[str, float]]:
+    """For each listing, the film of the best scoring listing at another
+    cinema, and its score"""
+    overview_similarities = (text @ text.T).tolist()
+    image_similarities = (image @ image.T).tolist()
+    best_matches = []
+    for i, listing in enumerate(listings):
+        score, j = max(
+            (
+                get_match_score(
+                    overview_similarities[i][j], image_similarities[i][j], None
+                ),
+                j,
+            )
+            for j, candidate in enumerate(listings)
+            if candidate["cinema_shortcode"] != listing["cinema_shortcode"]
+        )
+        best_matches.append((listings[j]["norm_title"], score))
+    return best_matches
+
+
+def test_int8_picks_the_same_films(listings, embeddings):
+    float32 = get_best_matches(listings, *embeddings["float32"])
+    int8 = get_best_matches(listings, *embeddings["int8"])
+    agreement = sum(a[0] == b[0] for a, b in zip(float32, int8)) / len(listings)
+    score_errors = [abs(a[1] - b[1]) for a, b in zip(float32, int8)]
+    correct = sum(
+        title == listing["norm_title"] for (title, _), listing in zip(float32, listings)
+    )
+    print(
+        f"{len(listings)} listings, float32 finds the same film for {correct}, "
+        f"pick agreement {agreement * 100:.1f}%, "
+        f"mean score error {sum(score_errors) / len(score_errors):.4f}, "
+        f"max {max(score_errors):.4f}"
+    )
+    assert agreement >= MIN_PICK_AGREEMENT
+    assert max(score_errors) < MAX_SCORE_ERROR
+
+
+MATCH_SCRIPT = """
+import json, sqlite3, sys
+from cinescrapers.cinescrapers_types import EnrichedShowTime
+from cinescrapers.film_identification import get_best_tmdb_match
+
+with sqlite3.connect(DB_PATH) as conn:
+    conn.row_factory = sqlite3.Row
+    rows = conn.execute(
+        "SELECT * FROM showtimes WHERE rowid IN "
+        "(SELECT MIN(rowid) FROM showtimes GROUP BY norm_title) LIMIT ?",
+        (NUM_SAMPLES,),
+    ).fetchall()
+matches = {}
+for row in rows:
+    match = get_best_tmdb_match(EnrichedShowTime(**dict(row)), IMAGES_CACHE)
+    if match:
+        matches[row["id"]] = [match["id"], match["similarity_score"]]
+sys.stdout.write("\\n" + json.dumps(matches) + "\\n")
+"""
+
+
+def get_tmdb_matches(backend: str) -> dict[str, list]:
+    """Showtime ID -> [TMDB ID, score] for the test showtimes"""
+    script = (
+        f"from pathlib import Path\n"
+        f"DB_PATH = Path({str(DB_PATH)!r})\n"
+        f"IMAGES_CACHE = Path({str(IMAGES_CACHE)!r})\n"
+        f"NUM_SAMPLES = {NUM_SAMPLES}\n"
+        f"{MATCH_SCRIPT}"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={
+            **os.environ,
+            "PYTHONPATH": ":".join(sys.path),
+            "CINESCRAPERS_EMBEDDING_BACKEND": backend,
+        },
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.skipif(
+    "TMDB_API_KEY" not in os.environ
+    and os.environ.get("CINESCRAPERS_TMDB_OFFLINE") != "1",
+    reason="Needs TMDB_API_KEY or CINESCRAPERS_TMDB_OFFLINE=1",
+)
+def test_int8_matches_tmdb_films_like_float32():
+    float32 = get_tmdb_matches("float32")
+    int8 = get_tmdb_matches("int8")
+    score_errors = [
+        abs(float32[showtime_id][1] - int8[showtime_id][1])
+        for showtime_id in float32.keys() & int8.keys()
+    ]
+    print(
+        f"{len(float32)} matches, mean score error "
+        f"{sum(score_errors) / max(len(score_errors), 1):.4f}, "
+        f"max {max(score_errors, default=0):.4f}"
+    )
+    assert float32.keys() == int8.keys()
+    for showtime_id, (tmdb_id, score) in float32.items():
+        assert int8[showtime_id][0] == tmdb_id, showtime_id
+        assert int8[showtime_id][1] == pytest.approx(score, abs=MAX_SCORE_ERROR)
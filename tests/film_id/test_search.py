@@ -0,0 +1,230 @@
+from types import SimpleNamespace
+
+import pytest
+
+from cinescrapers import film_identification
+from cinescrapers.exceptions import TMDBNotFound
+from cinescrapers.film_identification import (
+    get_fuzzy_candidates,
+    get_local_candidates,
+    get_tmdb_candidates,
+    search_tmdb_by_title,
+    search_tmdb_by_title_and_year,
+)
+from cinescrapers.fuzzy_title_index import FuzzyTitleIndex
+
+
+class FakeClient:
+    def __init__(self, pages: list[list[str]]):
+        self.pages = pages
+        self.requested_pages = []
+
+    def get(self, endpoint, params):
+        page = params.get("page", 1)
+        self.requested_pages.append(page)
+        return {
+            "total_pages": len(self.pages),
+            "results": [{"title": title} for title in self.pages[page - 1]],
+        }
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    def install(pages):
+        client = FakeClient(pages)
+        monkeypatch.setattr(film_identification, "get_tmdb_client", lambda: client)
+        return client
+
+    return install
+
+
+def test_search_caps_pages(fake_client):
+    client = fake_client([["Homeward"], ["Home Alone"]] * 10)
+    results = search_tmdb_by_title("Home", max_pages=3)
+    # The first page is only fetched once
+    assert client.requested_pages == [1, 2, 3]
+    assert len(results) == 3
+    with pytest.raises(ValueError):
+        search_tmdb_by_title("Home", max_pages=0)
+
+
+def test_search_stops_after_exact_matches(fake_client):
+    client = fake_client([["Home", "Home"], ["Home", "Home Alone"], ["Homeward"]])
+    results = search_tmdb_by_title("Home")
+    assert client.requested_pages == [1, 2]
+    assert [r["title"] for r in results] == ["Home", "Home", "Home", "Home Alone"]
+
+
+def test_search_without_stopping(fake_client):
+    client = fake_client([["Home", "Home Alone"], ["Homeward"]])
+    search_tmdb_by_title("Home", stop_on_exact_match=False)
+    assert client.requested_pages == [1, 2]
+
+
+def test_local_candidates_filter_by_year(monkeypatch):
+    details = {
+        653: {"id": 653, "title": "Nosferatu", "release_date": "1922-02-16"},
+        426063: {"id": 426063, "title": "Nosferatu", "release_date": "2024-12-25"},
+    }
+    monkeypatch.setattr(
+        film_identification, "find_films_by_title", lambda title: [426063, 653]
+    )
+    monkeypatch.setattr(film_identification, "get_tmdb_movie_details", details.get)
+    showtime = SimpleNamespace(norm_title="NOSFERATU", release_year=2025)
+    assert get_local_candidates(showtime) == [details[426063]]
+    showtime.release_year = None
+    assert len(get_local_candidates(showtime)) == 2
+
+
+def test_fuzzy_candidates(monkeypatch):
+    details = {194: {"id": 194, "title": "Amélie", "release_date": "2001-04-25"}}
+    monkeypatch.setattr(film_identification, "get_tmdb_movie_details", details.get)
+    title_index = FuzzyTitleIndex()
+    title_index.add("AMELIE THE FABULOUS DESTINY OF AMELIE POULAIN", 194)
+    showtime = SimpleNamespace(norm_title="AMELIE", release_year=2001)
+    assert get_fuzzy_candidates(showtime, title_index) == [details[194]]
+    assert get_fuzzy_candidates(showtime, None) == []
+    showtime.norm_title = "AMERICAN PSYCHO"
+    assert get_fuzzy_candidates(showtime, title_index) == []
+
+
+class FakeYearClient:
+    """Search results for films released in various years"""
+
+    def __init__(self, release_years: list[int], page_size: int = 2):
+        self.films = [
+            {"id": i, "title": "Hamlet", "release_date": f"{year}-01-01"}
+            for i, year in enumerate(release_years)
+        ]
+        self.page_size = page_size
+        self.requests = []
+
+    def get(self, endpoint, params):
+        self.requests.append(params)
+        films = self.films
+        if "primary_release_year" in params:
+            year = params["primary_release_year"]
+            films = [f for f in films if f["release_date"].startswith(year)]
+        page = params.get("page", 1)
+        start = (page - 1) * self.page_size
+        return {
+            "total_pages": -(-len(films) // self.page_size),
+            "results": films[start : start + self.page_size],
+        }
+
+
+def test_year_window_search_filters_locally(monkeypatch):
+    client = FakeYearClient([1948, 1990, 1996, 1997, 2000])
+    monkeypatch.setattr(film_identification, "get_tmdb_client", lambda: client)
+    results = search_tmdb_by_title_and_year("Hamlet", 1996)
+    assert [r["release_date"][:4] for r in results] == ["1996", "1997"]
+    # One search, paged through, with no year pinned
+    assert [r.get("page", 1) for r in client.requests] == [1, 2, 3]
+    assert not any("primary_release_year" in r for r in client.requests)
+
+
+def test_year_window_search_falls_back_to_pinned_years(monkeypatch):
+    client = FakeYearClient(
+        [1995, 1996, 1997] + [1900 + i for i in range(20)], page_size=1
+    )
+    monkeypatch.setattr(film_identification, "get_tmdb_client", lambda: client)
+    results = search_tmdb_by_title_and_year("Hamlet", 1996, max_pages=3)
+    assert sorted(r["release_date"][:4] for r in results) == ["1995", "1996", "1997"]
+    assert [r.get("primary_release_year") for r in client.requests] == [
+        None,
+        "1995",
+        "1996",
+        "1997",
+    ]
+
+
+@pytest.fixture
+def fake_scoring(monkeypatch):
+    """Candidates score whatever their "fake_score" is, without any models"""
+
+    def score_candidates(showtime, candidates, images_cache):
+        for candidate in candidates:
+            candidate["similarity_score"] = candidate["fake_score"]
+
+    monkeypatch.setattr(film_identification, "score_candidates", score_candidates)
+    monkeypatch.setattr(film_identification, "prefetch_tmdb_images", lambda c: None)
+    monkeypatch.setattr(film_identification, "index_candidate_images", lambda c: None)
+    monkeypatch.setattr(
+        film_identification, "get_fuzzy_candidates", lambda showtime, title_index: []
+    )
+
+
+def test_local_candidates_that_dont_look_right_fall_through_to_search(
+    fake_scoring, monkeypatch
+):
+    # Listed under its English title, but there's another film whose
+    # original title is "Parasite"
+    local = [{"id": 1, "title": "Parasite", "fake_score": 0.05}]
+    searched = [
+        {"id": 496243, "title": "Parasite", "fake_score": 0.8},
+        {"id": 1, "title": "Parasite", "fake_score": 0.05},
+    ]
+    monkeypatch.setattr(
+        film_identification, "get_local_candidates", lambda showtime: local
+    )
+    monkeypatch.setattr(
+        film_identification, "search_candidates", lambda showtime: searched
+    )
+    showtime = SimpleNamespace(norm_title="PARASITE", release_year=2019)
+    candidates = get_tmdb_candidates(showtime, images_cache=None)
+    assert [c["id"] for c in candidates] == [1, 496243]
+
+
+def test_local_candidates_that_look_right_skip_search(fake_scoring, monkeypatch):
+    local = [{"id": 426, "title": "Vertigo", "fake_score": 0.9}]
+    monkeypatch.setattr(
+        film_identification, "get_local_candidates", lambda showtime: local
+    )
+
+    def search_candidates(showtime):
+        raise AssertionError("Shouldn't need to search")
+
+    monkeypatch.setattr(film_identification, "search_candidates", search_candidates)
+    showtime = SimpleNamespace(norm_title="VERTIGO", release_year=1958)
+    assert get_tmdb_candidates(showtime, images_cache=None) == local
+
+
+def test_fuzzy_candidates_that_dont_look_right_fall_through_to_search(
+    fake_scoring, monkeypatch
+):
+    title_index = FuzzyTitleIndex()
+    title_index.add("HOME ALONE", 771)
+    details = {771: {"id": 771, "title": "Home Alone", "fake_score": 0.1}}
+    searched = [{"id": 1000, "title": "Home", "fake_score": 0.7}]
+    monkeypatch.setattr(film_identification, "get_tmdb_movie_details", details.get)
+    monkeypatch.setattr(film_identification, "get_local_candidates", lambda s: [])
+    monkeypatch.setattr(
+        film_identification, "get_fuzzy_candidates", get_fuzzy_candidates
+    )
+    monkeypatch.setattr(film_identification, "search_candidates", lambda s: searched)
+    showtime = SimpleNamespace(norm_title="HOME", release_year=None)
+    candidates = get_tmdb_candidates(showtime, None, title_index)
+    assert [c["id"] for c in candidates] == [771, 1000]
+
+
+def test_deleted_films_are_skipped(fake_scoring, monkeypatch):
+    """IDs in our indexes that TMDB has since deleted don't stop us searching"""
+    details = {426: {"id": 426, "title": "Vertigo", "fake_score": 0.1}}
+
+    def get_tmdb_movie_details(tmdb_id):
+        if tmdb_id not in details:
+            raise TMDBNotFound(f"movie/{tmdb_id}")
+        return details[tmdb_id]
+
+    searched = [{"id": 1958, "title": "Vertigo", "fake_score": 0.9}]
+    monkeypatch.setattr(
+        film_identification, "get_tmdb_movie_details", get_tmdb_movie_details
+    )
+    monkeypatch.setattr(
+        film_identification, "find_films_by_title", lambda title: [404, 426]
+    )
+    monkeypatch.setattr(film_identification, "search_candidates", lambda s: searched)
+    showtime = SimpleNamespace(norm_title="VERTIGO", release_year=None)
+    assert get_local_candidates(showtime) == [details[426]]
+    candidates = get_tmdb_candidates(showtime, images_cache=None)
+    assert [c["id"] for c in candidates] == [426, 1958]
@@ -0,0 +1,84 @@
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+import torch
+from PIL import Image
+
+from cinescrapers import film_identification
+from cinescrapers.film_identification import (
+    get_similarity_features,
+    prefetch_tmdb_images,
+)
+
+TEST_IMAGE = Path(__file__).parents[1] / "thumbnails" / "test_input_image.jpg"
+
+
+class FakeClient:
+    def __init__(self):
+        self.urls = []
+        self.lock = threading.Lock()
+
+    def get_image(self, url):
+        with self.lock:
+            self.urls.append(url)
+        return b"image from " + url.encode()
+
+
+def test_prefetch_downloads_missing_images(tmp_path, monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(film_identification, "get_tmdb_client", lambda: client)
+    monkeypatch.setattr(film_identification, "TMDB_IMAGE_PATH", tmp_path)
+    (tmp_path / "have.jpg").write_bytes(b"already downloaded")
+
+    prefetch_tmdb_images(
+        [
+            {"poster_path": "/a.jpg", "backdrop_path": "/b.jpg"},
+            {"poster_path": "/have.jpg", "backdrop_path": None},
+            {"poster_path": "/a.jpg"},
+        ]
+    )
+
+    assert sorted(client.urls) == [
+        "https://image.tmdb.org/t/p/w500/a.jpg",
+        "https://image.tmdb.org/t/p/w500/b.jpg",
+    ]
+    assert (tmp_path / "b.jpg").read_bytes().endswith(b"/b.jpg")
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.jpg", "b.jpg", "have.jpg"]
+
+
+def test_same_poster_needs_clip_to_agree(tmp_path, monkeypatch):
+    """A poster that looks like the showtime's image by perceptual hash only
+    counts as the same picture if CLIP thinks they're similar too"""
+    monkeypatch.setattr(film_identification, "TMDB_IMAGE_PATH", tmp_path)
+    showtime_image = tmp_path / "showtime.jpg"
+    with Image.open(TEST_IMAGE) as im:
+        im.save(showtime_image)
+        for name in ("same.jpg", "lookalike.jpg"):
+            im.resize((im.width // 2, im.height // 2)).save(tmp_path / name)
+    similarities = {"same.jpg": 0.95, "lookalike.jpg": 0.5}
+
+    def get_image_embeddings(paths):
+        return torch.tensor(
+            [[1.0, 0.0]]
+            + [
+                [s, (1 - s**2) ** 0.5]
+                for s in (similarities[p.name] for p in paths[1:])
+            ]
+        )
+
+    monkeypatch.setattr(
+        film_identification, "get_image_embeddings", get_image_embeddings
+    )
+    monkeypatch.setattr(
+        film_identification, "get_sentence_embeddings", lambda t: torch.zeros(len(t), 2)
+    )
+    monkeypatch.setattr(
+        film_identification, "find_source_image", lambda cache, t: showtime_image
+    )
+    showtime = SimpleNamespace(description="", thumbnail="showtime")
+    candidates = [{"poster_path": "/same.jpg"}, {"poster_path": "/lookalike.jpg"}]
+    features = get_similarity_features(showtime, candidates, tmp_path)
+    assert features[0][1] == 1.0
+    assert features[1][1] == pytest.approx(0.5)
@@ -0,0 +1,83 @@
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from cinescrapers import embedding_server
+from cinescrapers.embedding_server import (
+    EmbeddingServer,
+    get_default_socket_path,
+    request_embeddings,
+)
+
+
+def broken_image_encoder(paths):
+    raise OSError(f"cannot identify image file {paths[0]}")
+
+
+@pytest.fixture
+def server(tmp_path):
+    socket_path = tmp_path / "embeddings.sock"
+    encoders = {
+        "text": ("text-model", lambda texts: [[len(t), 1.0] for t in texts]),
+        "image": ("image-model", broken_image_encoder),
+        "slow": ("slow-model", lambda texts: time.sleep(2) or [[1.0]]),
+    }
+    server = EmbeddingServer(socket_path, encoders)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield socket_path
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_request_embeddings(server):
+    vectors = request_embeddings("text", "text-model", ["abc", "de"], server)
+    assert vectors.dtype == np.float32
+    np.testing.assert_array_equal(vectors, [[3, 1], [2, 1]])
+
+
+def test_request_falls_back(server, tmp_path):
+    # Wrong model, encoder errors, and no server at all
+    assert request_embeddings("text", "other-model", ["abc"], server) is None
+    assert request_embeddings("image", "image-model", ["a.jpg"], server) is None
+    assert request_embeddings("text", "text-model", ["abc"], tmp_path / "x") is None
+
+
+def test_request_times_out(server, monkeypatch):
+    monkeypatch.setattr(embedding_server, "EMBEDDING_SERVER_TIMEOUT", 0.1)
+    t = time.perf_counter()
+    assert request_embeddings("slow", "slow-model", ["abc"], server) is None
+    assert time.perf_counter() - t < 1
+
+
+def test_socket_is_private(server):
+    assert server.stat().st_mode & 0o777 == 0o600
+
+
+def test_only_our_stale_sockets_are_removed(tmp_path):
+    socket_path = tmp_path / "embeddings.sock"
+    # Left behind by a server that crashed
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(str(socket_path))
+    EmbeddingServer(socket_path, {}).server_close()
+    # Not a socket, so not something we left behind
+    socket_path.unlink(missing_ok=True)
+    socket_path.write_text("important")
+    with pytest.raises(PermissionError):
+        EmbeddingServer(socket_path, {})
+    assert socket_path.read_text() == "important"
+
+
+def test_default_socket_is_in_a_private_folder(monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", "/run/user/1000")
+    assert get_default_socket_path() == Path(
+        "/run/user/1000/cinescrapers-embeddings.sock"
+    )
+    monkeypatch.delenv("XDG_RUNTIME_DIR")
+    assert get_default_socket_path().parent.name == f"cinescrapers-{os.getuid()}"
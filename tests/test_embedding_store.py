@@ -0,0 +1,74 @@
+import concurrent.futures
+
+import numpy as np
+import pytest
+
+from cinescrapers import embedding_store
+from cinescrapers.embedding_store import ImageEmbeddingStore, get_text_embeddings
+
+
+@pytest.fixture(autouse=True)
+def temp_embeddings_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_store, "EMBEDDINGS_DB", tmp_path / "embeddings.db")
+
+
+class FakeEncoder:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(texts)
+        return np.array([[len(text), 0.5, -1.0] for text in texts], dtype=np.float32)
+
+
+def test_text_embeddings_are_cached():
+    encode = FakeEncoder()
+    first = get_text_embeddings(["A film about a cat", "Dogs"], "model-a", encode)
+    second = get_text_embeddings(
+        ["Dogs", "A film about a cat", "Dogs", "Mice"], "model-a", encode
+    )
+    # Only the new text is encoded, and only once
+    assert encode.calls == [["A film about a cat", "Dogs"], ["Mice"]]
+    assert second.dtype == np.float32
+    np.testing.assert_allclose(second[1], first[0])
+    np.testing.assert_allclose(
+        second, [[4, 0.5, -1], [18, 0.5, -1], [4, 0.5, -1], [4, 0.5, -1]]
+    )
+
+
+def test_text_embeddings_are_per_model():
+    encode = FakeEncoder()
+    get_text_embeddings(["A film about a cat"], "model-a", encode)
+    get_text_embeddings(["A film about a cat"], "model-b", encode)
+    assert len(encode.calls) == 2
+
+
+def test_image_embedding_store(tmp_path):
+    store = ImageEmbeddingStore("ViT-B/32", 4, folder=tmp_path)
+    assert store.get("abc") is None
+    store.add("abc", np.array([1, 0, 0, 0]))
+    store.add("def", np.array([0, 0.5, 0.25, 0]))
+    np.testing.assert_allclose(store.get("def"), [0, 0.5, 0.25, 0])
+    assert "abc" in store
+
+    # A fresh store picks up the vectors from disk
+    reopened = ImageEmbeddingStore("ViT-B/32", 4, folder=tmp_path)
+    np.testing.assert_allclose(reopened.get("abc"), [1, 0, 0, 0])
+    reopened.add("ghi", np.array([0, 0, 0, 1]))
+    # ...and the original notices vectors added after it mapped the file
+    np.testing.assert_allclose(store.get("ghi"), [0, 0, 0, 1])
+
+
+def test_image_embedding_store_concurrent_adds(tmp_path):
+    # Separate stores don't share a lock, like separate processes
+    stores = [ImageEmbeddingStore("ViT-B/32", 4, folder=tmp_path) for _ in range(8)]
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        jobs = [
+            executor.submit(stores[i % 8].add, f"image{i}", np.full(4, i))
+            for i in range(400)
+        ]
+        for job in jobs:
+            job.result()
+    reopened = ImageEmbeddingStore("ViT-B/32", 4, folder=tmp_path)
+    for i in range(400):
+        np.testing.assert_allclose(reopened.get(f"image{i}"), np.full(4, i))
@@ -0,0 +1,60 @@
+import sqlite3
+
+from cinescrapers.fuzzy_title_index import FuzzyTitleIndex, load_fuzzy_title_index
+
+
+def test_search():
+    index = FuzzyTitleIndex()
+    index.add("AMELIE THE FABULOUS DESTINY OF AMELIE POULAIN", 194)
+    index.add("THE GODFATHER", 238)
+    index.add("THE GODFATHER PART II", 240)
+    index.add("THE GODFATHER", 238)
+    index.add("GODZILLA", 1678)
+
+    assert [title for _, title in index.search("AMELIE")] == [
+        "AMELIE THE FABULOUS DESTINY OF AMELIE POULAIN"
+    ]
+    results = index.search("THE GODFATHER")
+    assert results[0] == (1.0, "THE GODFATHER")
+    assert "THE GODFATHER PART II" in [title for _, title in results]
+    # One letter out
+    assert index.search("THE GODFATHR")[0][1] == "THE GODFATHER"
+    assert index.search("NOSFERATU") == []
+    assert index.get_tmdb_ids("THE GODFATHER") == {238}
+    assert len(index) == 4
+
+
+def test_load_from_db():
+    conn = sqlite3.connect(":memory:")
+    conn.execute(
+        "CREATE TABLE showtimes (norm_title TEXT, movie_key TEXT, tmdb_id INTEGER)"
+    )
+    conn.execute(
+        "CREATE TABLE tmdb_candidates (movie_key TEXT, title TEXT, tmdb_id INTEGER)"
+    )
+    conn.executemany(
+        "INSERT INTO showtimes VALUES (?, ?, ?)",
+        [
+            ("NOSFERATU", "nosferatu", 426063),
+            ("NOSFERATU", "nosferatu", 426063),
+            ("VERTIGO", "vertigo", None),
+            ("AMELIE", "amelie", 194),
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO tmdb_candidates VALUES (?, ?, ?)",
+        [
+            ("nosferatu", "Nosferatu", 426063),
+            # Candidates that lost, or for films we never matched, don't count
+            ("nosferatu", "Nosferatu the Vampyre", 6404),
+            ("vertigo", "Vertigo", 426),
+            ("amelie", "Amélie", 194),
+            ("amelie", "...", 1),
+        ],
+    )
+    index = load_fuzzy_title_index(conn)
+    assert index.get_tmdb_ids("NOSFERATU") == {426063}
+    assert index.get_tmdb_ids("AMELIE") == {194}
+    assert index.get_tmdb_ids("NOSFERATU THE VAMPYRE") == set()
+    assert index.get_tmdb_ids("VERTIGO") == set()
+    assert len(index) == 2
@@ -0,0 +1,95 @@
+import datetime
+
+import pytest
+
+from cinescrapers import image_store
+from cinescrapers.exceptions import ImageDownloadError
+from cinescrapers.image_store import (
+    collect_garbage,
+    download_source_image,
+    get_source_image_path,
+    get_thumbnail_folder,
+    lookup_source_url,
+    store_source_image,
+)
+
+
+@pytest.fixture(autouse=True)
+def temp_image_store(tmp_path, monkeypatch):
+    """Point the image store at an empty temporary directory"""
+    monkeypatch.setattr(image_store, "IMAGES_CACHE", tmp_path / "source_images")
+    monkeypatch.setattr(image_store, "THUMBNAILS_FOLDER", tmp_path / "thumbnails")
+    monkeypatch.setattr(image_store, "IMAGE_INDEX_DB", tmp_path / "index.db")
+    image_store.IMAGES_CACHE.mkdir()
+    image_store.THUMBNAILS_FOLDER.mkdir()
+
+
+def test_store_is_content_addressed():
+    content_hash = store_source_image("https://example.com/a.jpg", b"poster")
+    assert store_source_image("https://example.com/a.jpg?w=500", b"poster") == (
+        content_hash
+    )
+    path = get_source_image_path(content_hash)
+    assert path.parent.name == content_hash[:2]
+    assert path.read_bytes() == b"poster"
+    assert lookup_source_url("https://example.com/a.jpg") == content_hash
+    assert lookup_source_url("https://example.com/b.jpg") is None
+
+
+def test_collect_garbage(monkeypatch):
+    monkeypatch.setattr(image_store, "GC_GRACE_PERIOD", datetime.timedelta(days=-1))
+    keep = store_source_image("https://example.com/keep.jpg", b"keep")
+    evict = store_source_image("https://example.com/evict.jpg", b"evict")
+    thumbnail = get_thumbnail_folder(evict) / f"{evict}@2x.webp"
+    thumbnail.write_bytes(b"thumb")
+
+    assert collect_garbage({keep}) == (1, len(b"evict") + len(b"thumb"))
+    assert get_source_image_path(keep).exists()
+    assert not get_source_image_path(evict).exists()
+    assert not thumbnail.exists()
+    assert lookup_source_url("https://example.com/evict.jpg") is None
+
+
+class FakeResponse:
+    def __init__(self, chunks, headers=None, status_code=200):
+        self.chunks = chunks
+        self.headers = headers or {}
+        self.status_code = status_code
+        self.ok = status_code < 400
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield from self.chunks
+
+
+def test_download_source_image(monkeypatch):
+    png = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+    monkeypatch.setattr(
+        image_store.requests, "get", lambda *a, **kw: FakeResponse([png[:5], png[5:]])
+    )
+    content_hash = download_source_image("https://example.com/a.png", {})
+    assert get_source_image_path(content_hash).read_bytes() == png
+    assert lookup_source_url("https://example.com/a.png") == content_hash
+
+
+@pytest.mark.parametrize(
+    "response",
+    [
+        FakeResponse([b"<html><body>Not found</body></html>"]),
+        FakeResponse([b"\xff\xd8\xff"], headers={"content-length": "999999999"}),
+        FakeResponse([b"\xff\xd8\xff" + b"\x00" * 1000] * 100),
+        FakeResponse([], status_code=404),
+    ],
+)
+def test_download_source_image_rejects(monkeypatch, response):
+    monkeypatch.setattr(image_store, "MAX_IMAGE_BYTES", 10_000)
+    monkeypatch.setattr(image_store.requests, "get", lambda *a, **kw: response)
+    with pytest.raises(ImageDownloadError):
+        download_source_image("https://example.com/a.jpg", {})
+    # No partial downloads left lying around
+    assert list(image_store.IMAGES_CACHE.iterdir()) == []
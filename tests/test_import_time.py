@@ -0,0 +1,42 @@
+import subprocess
+import sys
+
+# Modules that are slow to import and only needed by some commands
+HEAVY_MODULES = [
+    "boto3",
+    "clip",
+    "cv2",
+    "dateparser",
+    "folium",
+    "onnxruntime",
+    "playwright",
+    "sentence_transformers",
+    "torch",
+    "ultralytics",
+]
+
+CHECK_SCRIPT = """
+import sys, time
+t = time.perf_counter()
+import cinescrapers.__main__
+elapsed = time.perf_counter() - t
+from cinescrapers.__main__ import cli
+cli(["list-scrapers"], standalone_mode=False)
+loaded = [m for m in HEAVY_MODULES if m in sys.modules]
+sys.stdout.write(f"\\n{elapsed}|{','.join(loaded)}\\n")
+"""
+
+
+def test_cli_doesnt_import_heavy_modules():
+    """Lightweight commands shouldn't pay for torch, CLIP, OpenCV etc. or need
+    a TMDB API key"""
+    result = subprocess.run(
+        [sys.executable, "-c", f"HEAVY_MODULES = {HEAVY_MODULES!r}\n{CHECK_SCRIPT}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={"PYTHONPATH": ":".join(sys.path)},
+    )
+    elapsed, loaded = result.stdout.strip().splitlines()[-1].split("|")
+    assert loaded == ""
+    assert float(elapsed) < 1.0
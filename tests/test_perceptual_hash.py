@@ -0,0 +1,129 @@
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from PIL import Image, ImageDraw, ImageOps
+
+from cinescrapers import image_store
+from cinescrapers.image_store import get_source_image_path, store_source_image
+from cinescrapers.perceptual_hash import (
+    PerceptualHashIndex,
+    dhashes_match,
+    get_canonical_image,
+    get_canonical_index,
+    get_dhash,
+    get_file_fingerprint,
+    is_distinctive,
+)
+
+TEST_IMAGE = Path(__file__).parent / "thumbnails" / "test_input_image.jpg"
+
+
+def test_dhash_survives_resizing():
+    with Image.open(TEST_IMAGE) as im:
+        original = get_dhash(im)
+        smaller = get_dhash(im.resize((im.width // 3, im.height // 3)))
+        flipped = get_dhash(ImageOps.mirror(im))
+    assert dhashes_match(original, smaller)
+    assert not dhashes_match(original, flipped)
+
+
+def test_perceptual_hash_index():
+    index = PerceptualHashIndex(max_distance=4)
+    index.add("a", 0)
+    index.add("b", 0b1111)  # 4 bits away from a
+    index.add("c", 0b11111 << 40)  # 5 bits away from a
+
+    assert index.find(0) == [(0, "a"), (4, "b")]
+    assert index.find(0b11111 << 40) == [(0, "c")]
+    index.remove("a")
+    assert index.find(0) == [(4, "b")]
+
+
+@pytest.fixture
+def temp_image_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_store, "IMAGES_CACHE", tmp_path / "source_images")
+    monkeypatch.setattr(image_store, "IMAGE_INDEX_DB", tmp_path / "index.db")
+    image_store.IMAGES_CACHE.mkdir()
+    get_canonical_index.cache_clear()
+    yield
+    get_canonical_index.cache_clear()
+
+
+def get_jpeg_bytes(im: Image.Image) -> bytes:
+    buffer = BytesIO()
+    im.save(buffer, "JPEG", quality=70)
+    return buffer.getvalue()
+
+
+def test_get_canonical_image(temp_image_store):
+    with Image.open(TEST_IMAGE) as im:
+        im = im.convert("RGB")
+        original = store_source_image(
+            "https://a.com/poster.jpg", TEST_IMAGE.read_bytes()
+        )
+        resized = store_source_image(
+            "https://b.com/poster.jpg?w=300",
+            get_jpeg_bytes(im.resize((im.width // 2, im.height // 2))),
+        )
+        different = store_source_image(
+            "https://c.com/other.jpg", get_jpeg_bytes(ImageOps.mirror(im))
+        )
+
+    assert get_canonical_image(original) == original
+    # The resized copy collapses onto the first one we saw
+    assert get_canonical_image(resized) == original
+    assert get_canonical_image(different) == different
+    # And the answers are remembered
+    get_canonical_index.cache_clear()
+    assert get_canonical_image(resized) == original
+
+    # If the canonical image is garbage collected, the next copy takes over
+    get_source_image_path(original).unlink()
+    get_canonical_index.cache_clear()
+    assert get_canonical_image(resized) == resized
+
+
+def test_plain_images_are_never_the_same(temp_image_store):
+    """Dark or minimal posters have nearly the same dHash as each other"""
+    posters = []
+    for size, text, position in [
+        ((500, 750), "NOSFERATU", (200, 600)),
+        ((500, 750), "VERTIGO", (100, 100)),
+        ((750, 500), "HEAT", (300, 250)),
+    ]:
+        im = Image.new("RGB", size, "black")
+        ImageDraw.Draw(im).text(position, text, fill="white")
+        posters.append(im)
+    assert dhashes_match(get_dhash(posters[0]), get_dhash(posters[1]))
+    assert dhashes_match(get_dhash(posters[0]), get_dhash(posters[2]))
+    # Lots of contrast, but no left/right differences
+    two_tone = Image.new("RGB", (500, 750), "navy")
+    ImageDraw.Draw(two_tone).rectangle((0, 500, 500, 750), fill="red")
+    posters.append(two_tone)
+    # Even a resized copy of a plain image gets its own thumbnail
+    posters.append(posters[0].resize((250, 375)))
+    content_hashes = [
+        store_source_image(f"https://a.com/{i}.jpg", get_jpeg_bytes(im))
+        for i, im in enumerate(posters)
+    ]
+    assert [get_canonical_image(ch) for ch in content_hashes] == content_hashes
+    assert not is_distinctive(
+        get_file_fingerprint(get_source_image_path(content_hashes[3]))
+    )
+
+
+def test_different_shapes_are_never_the_same(temp_image_store):
+    with Image.open(TEST_IMAGE) as im:
+        im = im.convert("RGB")
+        original = store_source_image("https://a.com/poster.jpg", get_jpeg_bytes(im))
+        squashed = store_source_image(
+            "https://b.com/poster.jpg",
+            get_jpeg_bytes(im.resize((im.width, im.height * 3 // 4))),
+        )
+    assert dhashes_match(
+        get_file_fingerprint(get_source_image_path(original)).dhash,
+        get_file_fingerprint(get_source_image_path(squashed)).dhash,
+    )
+    assert get_canonical_image(original) == original
+    assert get_canonical_image(squashed) == squashed
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from cinescrapers import poster_index
+from cinescrapers.embedding_store import ImageEmbeddingStore
+from cinescrapers.poster_index import PosterIndex
+
+
+def random_vectors(rng, num, dimensions=16):
+    vectors = rng.normal(size=(num, dimensions))
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def index(tmp_path):
+    store = ImageEmbeddingStore("test-model", 16, folder=tmp_path)
+    return PosterIndex(store)
+
+
+def add_posters(index, vectors, first_id=0):
+    for i, vector in enumerate(vectors, first_id):
+        index.store.add(f"hash{i}", vector)
+        # Posters and backdrops, so several images per film
+        index.add(f"hash{i}", i // 2)
+
+
+def test_search(index):
+    rng = np.random.default_rng(1)
+    vectors = random_vectors(rng, 40)
+    add_posters(index, vectors)
+    assert len(index) == 40
+    # A slightly different copy of image 7 (film 3)
+    query = vectors[7] + rng.normal(scale=0.05, size=16)
+    results = index.search(query / np.linalg.norm(query), k=3)
+    assert len(results) == 3
+    assert results[0][1] == 3
+    assert results[0][0] > 0.9
+    # Each film only appears once
+    assert len({tmdb_id for _, tmdb_id in results}) == 3
+
+
+def test_search_clustered(index, monkeypatch):
+    monkeypatch.setattr(poster_index, "MIN_CLUSTERED_SIZE", 100)
+    monkeypatch.setattr(poster_index, "NUM_PROBES", 3)
+    rng = np.random.default_rng(2)
+    vectors = random_vectors(rng, 150)
+    add_posters(index, vectors[:120])
+    assert index.centroids_path.exists()
+    # Added after clustering, so assigned to existing clusters
+    add_posters(index, vectors[120:], first_id=120)
+
+    # Still finds the exact images, from a fresh copy of the index on disk
+    reopened = PosterIndex(index.store)
+    for i in (5, 130):
+        assert reopened.search(vectors[i], k=1)[0][1] == i // 2
+
+
+def test_unknown_images_are_ignored(index):
+    index.add("never-embedded", 1)
+    assert len(index) == 0
+    assert index.search(np.ones(16) / 4) == []
+
+
+def test_concurrent_adds_cluster_once(index, monkeypatch):
+    monkeypatch.setattr(poster_index, "MIN_CLUSTERED_SIZE", 100)
+    clusterings = []
+    cluster = index.cluster
+
+    def counting_cluster():
+        clusterings.append(len(index))
+        # Slow enough for the other threads to cross the threshold too
+        time.sleep(0.2)
+        cluster()
+
+    monkeypatch.setattr(index, "cluster", counting_cluster)
+    rng = np.random.default_rng(3)
+    vectors = random_vectors(rng, 108)
+    add_posters(index, vectors[:96])
+    threads = [
+        threading.Thread(target=add_posters, args=(index, vectors[i : i + 1], i))
+        for i in range(96, 108)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(clusterings) == 1
+    assert index.load_centroids() is not None
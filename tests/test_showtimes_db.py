@@ -0,0 +1,134 @@
+import concurrent.futures
+import datetime
+import sqlite3
+
+from click.testing import CliRunner
+
+from cinescrapers import __main__ as cli_module
+from cinescrapers import tmdb_id_cache
+from cinescrapers.__main__ import (
+    cli,
+    ensure_showtimes_table_exists,
+    get_movie_key,
+    get_thumbnail_variants,
+    scrape_to_sqlite,
+)
+from cinescrapers.cinescrapers_types import ShowTime
+from cinescrapers.match_scoring import get_match_score
+from cinescrapers.tmdb_id_cache import get_cached_tmdb_ids
+
+
+def test_movie_key_is_added_to_old_databases(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with sqlite3.connect("showtimes.db") as conn:
+        conn.execute(
+            """
+            CREATE TABLE showtimes (
+                id TEXT PRIMARY KEY,
+                cinema_shortcode TEXT NOT NULL,
+                title TEXT NOT NULL,
+                norm_title TEXT,
+                datetime TEXT NOT NULL,
+                link TEXT NOT NULL,
+                description TEXT,
+                image_src TEXT,
+                thumbnail TEXT,
+                release_year INTEGER,
+                last_updated TEXT NOT NULL,
+                scraper TEXT NOT NULL,
+                tmdb_id INTEGER
+            )
+        """
+        )
+        conn.executemany(
+            "INSERT INTO showtimes (id, cinema_shortcode, title, norm_title, datetime, link, description, image_src, last_updated, scraper) VALUES (?, 'ica', ?, ?, ?, '', ?, ?, '', 'ica')",
+            [
+                ("1", "Nosferatu", "nosferatu", "2025-01-01 18:00", "Vampire", None),
+                ("2", "Nosferatu", "nosferatu", "2025-01-02 18:00", "Vampire", None),
+                ("3", "Vertigo", "vertigo", "2025-01-02 18:00", "Heights", "v.jpg"),
+            ],
+        )
+
+    ensure_showtimes_table_exists()
+
+    with sqlite3.connect("showtimes.db") as conn:
+        keys = dict(conn.execute("SELECT id, movie_key FROM showtimes"))
+    assert keys["1"] == keys["2"] == get_movie_key("nosferatu", "Vampire", None)
+    assert keys["3"] == get_movie_key("vertigo", "Heights", "v.jpg")
+
+
+def test_rescore(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(tmdb_id_cache, "TMDB_ID_CACHE_DB", tmp_path / "tmdb_ids.db")
+    ensure_showtimes_table_exists()
+    with sqlite3.connect("showtimes.db") as conn:
+        conn.executemany(
+            "INSERT INTO showtimes (id, cinema_shortcode, title, datetime, link, last_updated, scraper, movie_key, tmdb_id) VALUES (?, 'ica', '', '', '', '', 'ica', ?, ?)",
+            [("1", "nosferatu", 653), ("2", "nosferatu", 653), ("3", "vertigo", 426)],
+        )
+        conn.executemany(
+            "INSERT INTO tmdb_candidates VALUES (?, ?, '', ?, ?, ?)",
+            [
+                ("nosferatu", 653, 1922, 0.5, 0.7),
+                ("nosferatu", 426063, 2024, 0.9, 0.95),
+                ("vertigo", 426, 1958, 0.8, 0.9),
+                ("vertigo", 1, 1958, 0.1, 0.1),
+            ],
+        )
+
+    result = CliRunner().invoke(cli, ["rescore"])
+    assert result.exit_code == 0, result.output
+    with sqlite3.connect("showtimes.db") as conn:
+        tmdb_ids = dict(conn.execute("SELECT id, tmdb_id FROM showtimes"))
+    assert tmdb_ids == {"1": 426063, "2": 426063, "3": 426}
+    assert get_cached_tmdb_ids(["nosferatu", "vertigo"]) == {"nosferatu": 426063}
+
+
+def test_match_score():
+    assert get_match_score(0.2, 0.65, None) == 0
+    assert get_match_score(1.0, 1.0, None) == get_match_score(1.0, 0.0, None) * 2
+    assert get_match_score(1.0, 1.0, datetime.date.today().year) == 1.0
+
+
+def test_thumbnail_variant_names_match_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli_module, "get_thumbnail_path", lambda name: tmp_path / name)
+    for name in ("abc.jpg", "abc@2x.jpg", "abc.webp"):
+        (tmp_path / name).touch()
+    variants = get_thumbnail_variants("abc")
+    assert [(v["name"], v["file"]) for v in variants] == [
+        (".jpg", "abc.jpg"),
+        ("@2x.jpg", "abc@2x.jpg"),
+        (".webp", "abc.webp"),
+    ]
+
+
+def test_failed_thumbnail_render_drops_only_that_thumbnail(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    showtimes = [
+        ShowTime(
+            cinema_shortcode="XX",
+            title=title,
+            link=f"https://example.com/{title}",
+            datetime=datetime.datetime(2030, 1, 1, 20, 0),
+            description="",
+            image_src=f"https://example.com/{poster}.jpg",
+        )
+        for title, poster in [("Nosferatu", "good"), ("Vertigo", "broken")]
+    ]
+    monkeypatch.setattr(cli_module, "get_scraper", lambda name: lambda: showtimes)
+
+    def fake_get_thumbnail(showtime, pending):
+        thumbnail = showtime.image_src.rsplit("/", 1)[1][:-4]
+        job = concurrent.futures.Future()
+        if thumbnail == "broken":
+            job.set_exception(OSError("cannot identify image file"))
+        else:
+            job.set_result({})
+        pending[thumbnail] = job
+        return thumbnail
+
+    monkeypatch.setattr(cli_module, "get_thumbnail", fake_get_thumbnail)
+    scrape_to_sqlite("test")
+    with sqlite3.connect("showtimes.db") as conn:
+        thumbnails = dict(conn.execute("SELECT title, thumbnail FROM showtimes"))
+    assert thumbnails == {"Nosferatu": "good", "Vertigo": None}
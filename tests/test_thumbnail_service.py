@@ -0,0 +1,110 @@
+import concurrent.futures
+import threading
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from cinescrapers import thumbnail_service, thumbnailing
+from cinescrapers.thumbnail_service import submit_thumbnail_job
+from cinescrapers.thumbnailing import ThumbnailVariant
+
+INPUT_IMAGE = Path(__file__).parent / "thumbnails" / "test_input_image.jpg"
+
+
+def fake_render(input_path, output_folder, stem, variants):
+    if input_path == "broken.jpg":
+        raise OSError("cannot identify image file")
+    path = Path(output_folder) / f"{stem}.jpg"
+    return {path.name: path}
+
+
+@pytest.fixture
+def fake_renderer(monkeypatch):
+    monkeypatch.setattr(thumbnail_service, "render_thumbnail_variants", fake_render)
+
+
+def test_render_in_calling_thread(fake_renderer, monkeypatch, tmp_path):
+    monkeypatch.setattr(thumbnail_service, "THUMBNAIL_WORKERS", 0)
+    job = submit_thumbnail_job("poster.jpg", tmp_path, "abc")
+    assert job.result() == {"abc.jpg": tmp_path / "abc.jpg"}
+    job = submit_thumbnail_job("broken.jpg", tmp_path, "abc")
+    with pytest.raises(OSError, match="cannot identify"):
+        job.result()
+
+
+def test_render_in_pool(fake_renderer, monkeypatch, tmp_path):
+    # A thread pool stands in for the process pool, which would need the
+    # real renderer
+    monkeypatch.setattr(thumbnail_service, "THUMBNAIL_WORKERS", 2)
+    monkeypatch.setattr(
+        thumbnail_service, "_pool", concurrent.futures.ThreadPoolExecutor(2)
+    )
+    jobs = [
+        submit_thumbnail_job(name, tmp_path, stem)
+        for name, stem in [("a.jpg", "a"), ("broken.jpg", "b"), ("c.jpg", "c")]
+    ]
+    assert jobs[0].result() == {"a.jpg": tmp_path / "a.jpg"}
+    with pytest.raises(OSError):
+        jobs[1].result()
+    assert jobs[2].result() == {"c.jpg": tmp_path / "c.jpg"}
+    thumbnail_service.shutdown()
+    assert thumbnail_service._pool is None
+
+
+def test_same_thumbnail_is_only_rendered_once(monkeypatch, tmp_path):
+    """Showtimes that share a poster get the job that's already running"""
+    started = threading.Event()
+    release = threading.Event()
+    renders = []
+
+    def slow_render(input_path, output_folder, stem, variants):
+        renders.append(stem)
+        started.set()
+        release.wait()
+        return {}
+
+    monkeypatch.setattr(thumbnail_service, "render_thumbnail_variants", slow_render)
+    monkeypatch.setattr(thumbnail_service, "THUMBNAIL_WORKERS", 2)
+    monkeypatch.setattr(
+        thumbnail_service, "_pool", concurrent.futures.ThreadPoolExecutor(2)
+    )
+    jobs = [submit_thumbnail_job("a.jpg", tmp_path, "a") for _ in range(5)]
+    started.wait()
+    assert all(job is jobs[0] for job in jobs)
+    release.set()
+    jobs[0].result()
+    assert renders == ["a"]
+    assert thumbnail_service._in_flight == {}
+    # Once it's finished, asking again renders again
+    submit_thumbnail_job("a.jpg", tmp_path, "a").result()
+    assert renders == ["a", "a"]
+    thumbnail_service.shutdown()
+
+
+def test_one_worker_without_onnx_model(monkeypatch, tmp_path):
+    monkeypatch.setattr(thumbnail_service, "THUMBNAIL_WORKERS", 4)
+    monkeypatch.setattr(thumbnailing, "DETECTOR_BACKEND", "onnx")
+    monkeypatch.setattr(thumbnailing, "YOLO_ONNX_PATH", tmp_path / "missing.onnx")
+    assert thumbnail_service.get_pool()._max_workers == 1
+    thumbnail_service.shutdown()
+
+
+def test_render_in_process_pool(monkeypatch, tmp_path):
+    """The real worker processes, which load the detector when they start"""
+    monkeypatch.setattr(thumbnail_service, "THUMBNAIL_WORKERS", 2)
+    variants = [ThumbnailVariant(name="", size=150, format="JPEG")]
+    jobs = [
+        submit_thumbnail_job(INPUT_IMAGE, tmp_path, "thumb", variants) for _ in range(3)
+    ]
+    assert all(job is jobs[0] for job in jobs)
+    assert jobs[0].result() == {"thumb.jpg": tmp_path / "thumb.jpg"}
+    with Image.open(tmp_path / "thumb.jpg") as img:
+        assert img.size == (150, 150)
+    # Only the finished thumbnail, no temporary files
+    assert [path.name for path in tmp_path.iterdir()] == ["thumb.jpg"]
+    broken = tmp_path / "broken.jpg"
+    broken.write_bytes(b"not an image")
+    with pytest.raises(OSError):
+        submit_thumbnail_job(broken, tmp_path, "broken", variants).result()
+    thumbnail_service.shutdown()
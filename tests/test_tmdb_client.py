@@ -0,0 +1,155 @@
+import datetime
+import time
+
+import pytest
+import requests
+
+from cinescrapers import tmdb_cache, tmdb_client
+from cinescrapers.exceptions import TMDBCacheMiss, TMDBNotFound
+from cinescrapers.tmdb_cache import TMDBResponseCache
+from cinescrapers.tmdb_client import TMDBClient, TokenBucket, get_tmdb_client
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(rate=100, capacity=5)
+    t = time.monotonic()
+    for _ in range(15):
+        bucket.acquire()
+    # 5 from the initial burst, then 10 more at 100 per second
+    assert time.monotonic() - t >= 0.09
+
+
+class FakeResponse:
+    def __init__(self, status_code, json_data=None, headers=None):
+        self.status_code = status_code
+        self.json_data = json_data
+        self.headers = headers or {}
+
+    def json(self):
+        return self.json_data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+
+def test_client_retries_after_rate_limiting(monkeypatch):
+    responses = [
+        FakeResponse(429, headers={"retry-after": "2"}),
+        FakeResponse(200, {"results": []}),
+    ]
+    client = TMDBClient("key", requests_per_second=1000, burst=10)
+    pauses = []
+    monkeypatch.setattr(client.limiter, "pause", pauses.append)
+    calls = []
+
+    def fake_get(url, params, timeout):
+        calls.append((url, params))
+        return responses.pop(0)
+
+    monkeypatch.setattr(client.session, "get", fake_get)
+    assert client.get("search/movie", {"query": "Heat"}) == {"results": []}
+    assert pauses == [2.0]
+    assert calls[0] == (
+        "https://api.themoviedb.org/3/search/movie",
+        {"api_key": "key", "query": "Heat"},
+    )
+
+
+def test_client_gives_up(monkeypatch):
+    client = TMDBClient("key", requests_per_second=1000, burst=10)
+    monkeypatch.setattr(client.limiter, "pause", lambda seconds: None)
+    monkeypatch.setattr(
+        client.session, "get", lambda url, params, timeout: FakeResponse(503)
+    )
+    with pytest.raises(requests.HTTPError):
+        client.get("movie/1")
+
+
+def test_client_retries_timeouts(monkeypatch):
+    client = TMDBClient("key", requests_per_second=1000, burst=10)
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    responses = [requests.ReadTimeout(), FakeResponse(200, {"id": 1})]
+
+    def fake_get(url, params, timeout):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(client.session, "get", fake_get)
+    assert client.get("movie/1") == {"id": 1}
+
+
+def test_cache_serves_repeat_requests(tmp_path, monkeypatch):
+    cache = TMDBResponseCache(tmp_path / "cache.db")
+    client = TMDBClient("key", cache=cache)
+    calls = []
+
+    def fake_fetch(endpoint, params):
+        calls.append(params)
+        return {"results": [{"id": 1}]}
+
+    monkeypatch.setattr(client, "fetch", fake_fetch)
+    client.get("search/movie", {"query": "Nosferatu", "year": 1922})
+    # Different api_key, whitespace and case are the same request
+    data = client.get(
+        "search/movie", {"query": " nosferatu ", "year": "1922", "api_key": "x"}
+    )
+    assert data == {"results": [{"id": 1}]}
+    assert len(calls) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_expires(tmp_path, monkeypatch):
+    cache = TMDBResponseCache(tmp_path / "cache.db")
+    cache.set("movie/1", {}, {"id": 1})
+    assert cache.get("movie/1", {}) == {"id": 1}
+    monkeypatch.setattr(tmdb_cache, "TMDB_CACHE_TTLS", {"movie": datetime.timedelta(0)})
+    assert cache.get("movie/1", {}) is None
+    # Offline, stale is better than nothing
+    assert cache.get("movie/1", {}, allow_stale=True) == {"id": 1}
+
+
+def test_not_found_is_cached(tmp_path, monkeypatch):
+    """Films deleted from TMDB stay deleted, so only ask once"""
+    client = TMDBClient(
+        "key",
+        requests_per_second=1000,
+        burst=10,
+        cache=TMDBResponseCache(tmp_path / "cache.db"),
+    )
+    calls = []
+
+    def fake_get(url, params, timeout):
+        calls.append(url)
+        return FakeResponse(404, {"status_code": 34})
+
+    monkeypatch.setattr(client.session, "get", fake_get)
+    for _ in range(2):
+        with pytest.raises(TMDBNotFound):
+            client.get("movie/1")
+    assert len(calls) == 1
+
+
+def test_offline_miss(tmp_path):
+    client = TMDBClient(
+        "", cache=TMDBResponseCache(tmp_path / "cache.db"), offline=True
+    )
+    with pytest.raises(TMDBCacheMiss):
+        client.get("movie/1")
+
+
+def test_offline_client_doesnt_need_api_key(tmp_path, monkeypatch):
+    monkeypatch.delenv("TMDB_API_KEY", raising=False)
+    monkeypatch.delenv("CINESCRAPERS_TMDB_OFFLINE", raising=False)
+    monkeypatch.setattr(tmdb_client, "_tmdb_client", None)
+    monkeypatch.setattr(
+        tmdb_client, "TMDBResponseCache", lambda: TMDBResponseCache(tmp_path / "c.db")
+    )
+    client = get_tmdb_client(offline=True)
+    assert client.offline
+    # Everyone else gets the same, offline, client
+    assert get_tmdb_client() is client
+    with pytest.raises(TMDBCacheMiss):
+        client.get_image("https://image.tmdb.org/t/p/w500/poster.jpg")
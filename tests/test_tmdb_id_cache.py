@@ -0,0 +1,51 @@
+import datetime
+import json
+
+import pytest
+
+from cinescrapers import tmdb_id_cache
+from cinescrapers.tmdb_id_cache import (
+    cache_tmdb_ids,
+    get_backed_off_movie_keys,
+    get_cached_tmdb_ids,
+    import_json_cache,
+    record_no_match,
+)
+
+
+@pytest.fixture(autouse=True)
+def temp_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(tmdb_id_cache, "TMDB_ID_CACHE_DB", tmp_path / "tmdb_ids.db")
+    monkeypatch.setattr(tmdb_id_cache, "LOOKUP_CHUNK_SIZE", 2)
+
+
+def test_cache_tmdb_ids():
+    cache_tmdb_ids({"a": 1, "b": 2, "c": 3})
+    cache_tmdb_ids({"b": 20})
+    assert get_cached_tmdb_ids(["a", "b", "c", "d"]) == {"a": 1, "b": 20, "c": 3}
+    assert get_cached_tmdb_ids([]) == {}
+
+
+def test_import_json_cache(tmp_path):
+    cache_tmdb_ids({"a": 10})
+    json_path = tmp_path / "tmdb_id_cache.json"
+    json_path.write_text(json.dumps({"a": 1, "b": 2}))
+    # Newer matches win over the old file
+    assert import_json_cache(json_path) == 1
+    assert get_cached_tmdb_ids(["a", "b"]) == {"a": 10, "b": 2}
+
+
+def test_no_match_backoff():
+    record_no_match("a")
+    record_no_match("b")
+    record_no_match("b")
+    record_no_match("b")
+    now = datetime.datetime.now()
+    keys = ["a", "b", "c"]
+    assert get_backed_off_movie_keys(keys, now) == {"a", "b"}
+    # 1 day for one failure, 4 days for three
+    assert get_backed_off_movie_keys(keys, now + datetime.timedelta(days=2)) == {"b"}
+    assert get_backed_off_movie_keys(keys, now + datetime.timedelta(days=5)) == set()
+    # Matching a film forgets it ever failed
+    cache_tmdb_ids({"b": 2})
+    assert get_backed_off_movie_keys(keys, now) == {"a"}
@@ -0,0 +1,77 @@
+import gzip
+import json
+
+import pytest
+
+from cinescrapers import tmdb_title_index
+from cinescrapers.tmdb_title_index import find_films_by_title, import_tmdb_id_export
+
+
+@pytest.fixture(autouse=True)
+def temp_title_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(tmdb_title_index, "TMDB_TITLE_INDEX_DB", tmp_path / "titles.db")
+
+
+def write_export(path, films):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for film in films:
+            f.write(json.dumps(film) + "\n")
+
+
+def test_import_and_find(tmp_path):
+    assert find_films_by_title("NOSFERATU") is None
+
+    export_path = tmp_path / "movie_ids.json.gz"
+    write_export(
+        export_path,
+        [
+            {
+                "adult": False,
+                "id": 653,
+                "original_title": "Nosferatu",
+                "popularity": 5.0,
+                "video": False,
+            },
+            {
+                "adult": False,
+                "id": 426063,
+                "original_title": "Nosferatu",
+                "popularity": 50.0,
+                "video": False,
+            },
+            {
+                "adult": False,
+                "id": 1,
+                "original_title": "Nosferatu",
+                "popularity": 1.0,
+                "video": True,
+            },
+            {
+                "adult": False,
+                "id": 2,
+                "original_title": "Vertigo",
+                "popularity": 20.0,
+                "video": False,
+            },
+            {"adult": False, "id": 3, "original_title": "...", "popularity": 1.0},
+        ],
+    )
+    assert import_tmdb_id_export(export_path) == 3
+    assert find_films_by_title("NOSFERATU") == [426063, 653]
+    assert find_films_by_title("THE THIRD MAN") == []
+
+    # Importing again replaces the index
+    write_export(
+        export_path,
+        [
+            {
+                "adult": False,
+                "id": 2,
+                "original_title": "Vertigo",
+                "popularity": 20.0,
+                "video": False,
+            }
+        ],
+    )
+    assert import_tmdb_id_export(export_path) == 1
+    assert find_films_by_title("NOSFERATU") == []
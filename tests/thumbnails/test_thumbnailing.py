@@ -1,6 +1,20 @@
 from pathlib import Path
+
+import numpy as np
+import pytest
 from PIL import Image
-from cinescrapers.utils import smart_square_thumbnail
+
+from cinescrapers.thumbnailing import (
+    DETECTOR_INPUT_SIZE,
+    YOLO_ONNX_PATH,
+    OnnxDetector,
+    ThumbnailVariant,
+    UltralyticsDetector,
+    letterbox,
+    load_working_image,
+    render_thumbnail_variants,
+    smart_square_thumbnail,
+)
 
 
 def test_smart_square_thumbnail():
@@ -17,3 +31,86 @@ def test_smart_square_thumbnail():
     # Check dimensions
     with Image.open(output_path) as img:
         assert img.size == (size, size)
+
+
+def test_render_thumbnail_variants(tmp_path):
+    input_path = Path(__file__).parent / "test_input_image.jpg"
+    variants = [
+        ThumbnailVariant(name="", size=150, format="JPEG"),
+        ThumbnailVariant(name="@2x", size=300, format="JPEG", max_bytes=20_000),
+        ThumbnailVariant(name="@2x", size=300, format="WEBP"),
+    ]
+    written = render_thumbnail_variants(input_path, tmp_path, "thumb", variants)
+
+    assert set(written) == {"thumb.jpg", "thumb@2x.jpg", "thumb@2x.webp"}
+    with Image.open(written["thumb.jpg"]) as img:
+        assert img.size == (150, 150)
+    with Image.open(written["thumb@2x.webp"]) as img:
+        assert img.size == (300, 300)
+        assert img.format == "WEBP"
+    assert written["thumb@2x.jpg"].stat().st_size <= 20_000
+
+
+def test_load_working_image_reduces_large_images(tmp_path):
+    """Big posters get decoded at reduced size, but never smaller than the
+    thumbnail or the detector need"""
+    for suffix in ("jpg", "png"):
+        big_path = tmp_path / f"big.{suffix}"
+        Image.new("RGB", (3000, 4500), "red").save(big_path)
+        img = load_working_image(big_path, 300)
+        assert min(img.size) >= 300
+        assert max(img.size) >= DETECTOR_INPUT_SIZE
+        assert max(img.size) < 4500 // 2
+
+
+def test_onnx_detector_postprocessing():
+    """Check the ONNX output decoding (NMS, ordering and undoing the
+    letterbox) without needing the model file"""
+
+    class FakeSession:
+        def run(self, output_names, feed):
+            output = np.zeros((1, 84, 8400), dtype=np.float32)
+            # cx, cy, w, h in letterboxed coordinates, then class scores
+            output[0, :4, 0] = [320, 320, 100, 200]
+            output[0, 4, 0] = 0.8
+            output[0, :4, 1] = [322, 320, 100, 200]  # Overlaps box 0
+            output[0, 4, 1] = 0.7
+            output[0, :4, 2] = [500, 100, 50, 50]
+            output[0, 5, 2] = 0.9
+            return [output]
+
+    detector = OnnxDetector.__new__(OnnxDetector)
+    detector.session = FakeSession()
+    detector.input_name = "images"
+    detector.rect = False
+
+    # A 320x640 image gets scaled by 1.0 and padded by 160px on the left
+    boxes = detector.detect(Image.new("RGB", (320, 640)))
+    assert boxes.shape == (2, 4)
+    assert np.allclose(boxes[0], [315, 75, 320, 125])  # Clipped to the image
+    assert np.allclose(boxes[1], [110, 220, 210, 420])
+
+
+def test_letterbox_rect():
+    # A portrait poster scales to 427x640, then gets padded to 448 wide (a
+    # multiple of the stride) rather than to a 640 square
+    tensor, ratio, left, top = letterbox(Image.new("RGB", (1000, 1500)))
+    assert tensor.shape == (1, 3, 640, 448)
+    assert ratio == pytest.approx(640 / 1500)
+    assert (left, top) == (10, 0)
+    tensor, _, left, top = letterbox(Image.new("RGB", (1000, 1500)), rect=False)
+    assert tensor.shape == (1, 3, 640, 640)
+    assert (left, top) == (106, 0)
+
+
+@pytest.mark.skipif(
+    not YOLO_ONNX_PATH.exists(), reason="Needs export-yolo-onnx to have been run"
+)
+def test_onnx_detector_matches_ultralytics():
+    input_path = Path(__file__).parent / "test_input_image.jpg"
+    with Image.open(input_path) as img:
+        img = img.convert("RGB")
+        onnx_boxes = OnnxDetector().detect(img)
+        ultralytics_boxes = UltralyticsDetector().detect(img)
+    assert len(onnx_boxes) == len(ultralytics_boxes)
+    assert np.allclose(onnx_boxes, ultralytics_boxes, atol=2)